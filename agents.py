@@ -7,26 +7,116 @@ Classes that represent agents with general, additive and binary preferences.
 
 from abc import ABC, abstractmethod        # Abstract Base Class
 from utils import plural
-import math, itertools
+import math, itertools, weakref
 import partitions
 from fractions import  Fraction
 
 
+class Valuation:
+    """
+    The immutable valuation of an agent, along with data derived from it.
+    A valuation is shared by all agents with an equal valuation function (see Valuation.interned),
+    so that families with many equal members, and many families with the same members,
+    keep and precompute each valuation only once.
+
+    >>> BinaryAgent("xy").valuation is BinaryAgent("yx", cardinality=2).valuation
+    True
+    >>> AdditiveAgent({"x":1, "y":2}).valuation is AdditiveAgent({"y":2, "x":1}).valuation
+    True
+    >>> AdditiveAgent({"x":1, "y":2}).valuation is AdditiveAgent({"x":1, "y":3}).valuation
+    False
+    """
+    __slots__ = ("key", "desired_goods", "total_value", "data", "derived", "__weakref__")
+
+    _interned = weakref.WeakValueDictionary()   # a valuation is kept as long as some agent uses it
+
+    def __init__(self, key:tuple, desired_goods:frozenset, data=None):
+        """
+        :param key: a hashable description of the valuation function, e.g. ("binary", desired_goods).
+        :param desired_goods: the set of all goods that are desired.
+        :param data: the valuation data of the agent type (e.g. a map from goods to values).
+        """
+        self.key = key
+        self.desired_goods = desired_goods
+        self.data = data
+        self.total_value = None    # set by the agent, using its value function
+        self.derived = {}          # derived data, e.g. the sorted list of desired goods or the MMS value
+
+    @staticmethod
+    def interned(key:tuple, create)->'Valuation':
+        """
+        :return: the shared valuation with the given key; if there is none, a new one is created by calling create().
+        """
+        valuation = Valuation._interned.get(key)
+        if valuation is None:
+            valuation = create()
+            Valuation._interned[key] = valuation
+        return valuation
+
+    def cached(self, name, compute):
+        """
+        :return: the derived data with the given name; if it was not calculated yet, it is calculated by calling compute().
+        """
+        derived = self.derived
+        if name not in derived:
+            derived[name] = compute()
+        return derived[name]
+
+    def __reduce__(self):
+        # An unpickled valuation (e.g. in a worker process) is interned in its new process too.
+        return (_unpickle_valuation, (self.key, self.desired_goods, self.data, self.total_value))
+
+
+def _unpickle_valuation(key, desired_goods, data, total_value)->Valuation:
+    def create():
+        valuation = Valuation(key, desired_goods, data)
+        valuation.total_value = total_value
+        return valuation
+    return Valuation.interned(key, create)
+
+
 class Agent(ABC):
     """
     An abstract class.
     Represents an agent or several agents with the same valuation function.
+    The agent classes use __slots__, to save memory in families with many members,
+    and agents with equal valuations share a single Valuation object.
     """
+    __slots__ = ("valuation", "cardinality")
 
-    def __init__(self, desired_goods:set, cardinality:int=1):
+    def __init__(self, valuation:Valuation, cardinality:int=1):
         """
-        :param desired_goods: the set of all goods that are desired by this agent/s.
+        :param valuation: the (shared) valuation of this agent/s.
         :param cardinality: the number of agent/s with the same valuation function.
         """
-        self.desired_goods_list = sorted(desired_goods)
-        self.desired_goods = set(desired_goods)
-        self.total_value = self.value(self.desired_goods)
+        self.valuation = valuation
         self.cardinality = cardinality
+        if valuation.total_value is None:
+            valuation.total_value = self.value(valuation.desired_goods)
+
+    @property
+    def desired_goods(self)->frozenset:
+        """
+        The set of all goods that are desired by this agent/s.
+        """
+        return self.valuation.desired_goods
+
+    @property
+    def total_value(self):
+        """
+        The value of all desired goods.
+        """
+        return self.valuation.total_value
+
+    @property
+    def desired_goods_list(self)->list:
+        """
+        The desired goods in a sorted list (shared by all agents with the same valuation - do not modify it).
+
+        >>> BinaryAgent("zxy").desired_goods_list
+        ['x', 'y', 'z']
+        """
+        return self.valuation.cached("desired_goods_list", lambda: sorted(self.valuation.desired_goods))
 
     @abstractmethod
     def value(self, bundle:set)->int:
@@ -38,6 +128,17 @@ class Agent(ABC):
         4
         """
 
+    @abstractmethod
+    def canonical_valuation(self):
+        """
+        Returns a JSON-serializable description of the valuation function,
+        which is the same for all agents with the same valuation (regardless of the order of goods or the cardinality).
+        Used for caching values that depend only on the valuation.
+
+        >>> MonotoneAgent({"y": 2, "x": 1, "xy": 4}).canonical_valuation()
+        [[[], 0], [['x'], 1], [['x', 'y'], 4], [['y'], 2]]
+        """
+
     def best_index(self, partition:list)->int:
         """
         Returns an index of a bundle that is most-valuable for the agent.
@@ -53,6 +154,18 @@ class Agent(ABC):
         """
         return max(range(len(partition)), key=lambda i:self.value(partition[i]))
 
+    def has_integer_values(self)->bool:
+        """
+        :return: True iff all the values of this agent are known to be integers,
+                 so that a fractional target value can be rounded up (see FairnessCriterion.threshold_for_agent).
+
+        >>> AdditiveAgent({"x": 1, "y": 2}).has_integer_values(), AdditiveAgent({"x": 0.5, "y": 2}).has_integer_values()
+        (True, False)
+        >>> MonotoneAgent({"x": 1, "y": 2, "xy": 4}).has_integer_values()
+        True
+        """
+        return False
+
 
     def value_except_best_c_goods(self, bundle:set, c:int=1)->int:
         """
@@ -129,7 +242,8 @@ class Agent(ABC):
         if c > len(self.desired_goods):
             return 0
         else:
-            return max(self.values_1_of_c_partitions(c))*approximation_factor
+            return self.valuation.cached(("value_1_of_c_MMS", c, approximation_factor),
+                                         lambda: max(self.values_1_of_c_partitions(c))*approximation_factor)
 
     def value_proportional_except_c(self, num_of_agents:int, c:int):
         """
@@ -238,16 +352,23 @@ class MonotoneAgent(Agent):
     2 agents with monotone valuations. Desired goods: ['x', 'y']
 
     """
+    __slots__ = ()
+
     def __init__(self, map_bundle_to_value:dict, cardinality:int=1):
         """
         Initializes an agent with a given valuation function.
         :param map_bundle_to_value: a dict that maps each subset of goods to its value.
         :param cardinality: the number of agents with the same valuation.
         """
-        self.map_bundle_to_value = {frozenset(bundle):value for bundle,value in  map_bundle_to_value.items()}
-        self.map_bundle_to_value[frozenset()] = 0   # normalization: the value of the empty bundle is always 0
-        desired_goods = max(map_bundle_to_value.keys(), key=lambda k:map_bundle_to_value[k])
-        super().__init__(desired_goods, cardinality=cardinality)
+        normalized = {frozenset(bundle):value for bundle,value in  map_bundle_to_value.items()}
+        normalized[frozenset()] = 0   # normalization: the value of the empty bundle is always 0
+        key = ("monotone", frozenset(normalized.items()))
+        desired_goods = frozenset(max(map_bundle_to_value.keys(), key=lambda k:map_bundle_to_value[k]))
+        super().__init__(Valuation.interned(key, lambda: Valuation(key, desired_goods, normalized)), cardinality=cardinality)
+
+    @property
+    def map_bundle_to_value(self)->dict:
+        return self.valuation.data
 
     def value(self, goods:set)->int:
         """
@@ -259,6 +380,12 @@ class MonotoneAgent(Agent):
         else:
             raise ValueError("The value of {} is not specified in the valuation function".format(goods))
 
+    def has_integer_values(self)->bool:
+        return self.valuation.cached("has_integer_values", lambda: _are_integers(self.map_bundle_to_value.values()))
+
+    def canonical_valuation(self):
+        return sorted([[sorted(bundle), value] for bundle,value in self.map_bundle_to_value.items()])
+
     def __repr__(self):
         return "{} agent{} with monotone valuations. Desired goods: {}".format(self.cardinality, plural(self.cardinality), sorted(self.desired_goods))
 
@@ -306,15 +433,24 @@ class AdditiveAgent(Agent):
     2 agents with additive valuations: x=1 y=2 z=4
 
     """
+    __slots__ = ()
+
     def __init__(self, map_good_to_value:dict, cardinality:int=1):
         """
         Initializes an agent with a given additive valuation function.
         :param map_good_to_value: a dict that maps each single good to its value.
         :param cardinality: the number of agents with the same valuation.
         """
-        self.map_good_to_value = map_good_to_value
-        desired_goods = set([g for g,v in map_good_to_value.items() if v>0])
-        super().__init__(desired_goods, cardinality=cardinality)
+        key = ("additive", frozenset(map_good_to_value.items()))
+        super().__init__(Valuation.interned(key, lambda: Valuation(key,
+            frozenset([g for g,v in map_good_to_value.items() if v>0]), dict(map_good_to_value))), cardinality=cardinality)
+
+    @property
+    def map_good_to_value(self)->dict:
+        """
+        A dict that maps each single good to its value (shared by all agents with the same valuation - do not modify it).
+        """
+        return self.valuation.data
 
     def value(self, goods:set)->int:
         """
@@ -322,6 +458,9 @@ class AdditiveAgent(Agent):
         """
         return sum([self.map_good_to_value[g] for g in goods])
 
+    def has_integer_values(self)->bool:
+        return self.valuation.cached("has_integer_values", lambda: _are_integers(self.map_good_to_value.values()))
+
     def value_except_best_c_goods(self, bundle:set, c:int=1)->int:
         """
         Calculates the value of the given bundle when the "best" (at most) c goods are removed from it.
@@ -390,15 +529,120 @@ class AdditiveAgent(Agent):
         if c > len(self.desired_goods):
             return 0
         else:
-            sorted_values = sorted(self.map_good_to_value.values(), reverse=True)
+            sorted_values = self.valuation.cached("sorted_values", lambda: sorted(self.map_good_to_value.values(), reverse=True))
             return sorted_values[c-1]
 
+    def canonical_valuation(self):
+        """
+        >>> AdditiveAgent({"y": 2, "x": 1, "w": 0}).canonical_valuation()
+        [['x', 1], ['y', 2]]
+        """
+        return sorted([[good, value] for good,value in self.map_good_to_value.items() if value != 0])
+
     def __repr__(self):
         vals = " ".join(["{}={}".format(k,v) for k,v in sorted(self.map_good_to_value.items())])
         return "{} agent{} with additive valuations: {}".format(self.cardinality, plural(self.cardinality), vals)
 
 
 
+class SparseAdditiveAgent(AdditiveAgent):
+    """
+    Represents an agent or several agents with an additive valuation function over a large catalog of goods,
+    of which only a few have a non-zero value. Goods that are not in map_good_to_value have value 0.
+    The non-zero values are kept in a list sorted from best to worst, for c-th-best-good and EFc queries.
+
+    >>> a = SparseAdditiveAgent({"x": 1, "y": 2, "z": 4, "w": 0})
+    >>> a
+    1 agent  with sparse additive valuations: x=1 y=2 z=4
+    >>> a.value({"x", "v", "u"})
+    1
+    >>> a.value(set("xyz") | set(range(100)))
+    7
+    >>> a.value_of_cth_best_good(2), a.value_of_cth_best_good(4)
+    (2, 0)
+    >>> a.value_except_best_c_goods({"x", "z", "v"}, c=1), a.value_except_best_c_goods({"x", "z", "v"}, c=2)
+    (1, 0)
+    >>> a.value_except_worst_c_goods({"x", "z", "v"}, c=1), a.value_except_worst_c_goods({"x", "z", "v"}, c=2)
+    (5, 4)
+    >>> a.is_EF1({"x"}, [{"y", "z", "v"}]), a.is_EF1({"y"}, [{"x", "z", "v"}])
+    (False, True)
+    >>> a.value_1_of_c_MMS(c=2)
+    3
+    >>> b = SparseAdditiveAgent({"x": 3, "y": -2})
+    >>> b.value_except_best_c_goods({"x", "y", "v"}, c=2), b.value_except_worst_c_goods({"x", "y", "v"}, c=2)
+    (-2, 3)
+    """
+    __slots__ = ()
+
+    def __init__(self, map_good_to_value:dict, cardinality:int=1):
+        """
+        :param map_good_to_value: a dict that maps goods to their values; goods with value 0 may be omitted.
+        """
+        map_good_to_value = {good: value for good,value in map_good_to_value.items() if value != 0}
+        key = ("sparse additive", frozenset(map_good_to_value.items()))
+        Agent.__init__(self, Valuation.interned(key, lambda: Valuation(key,
+            frozenset([g for g,v in map_good_to_value.items() if v>0]), map_good_to_value)), cardinality=cardinality)
+
+    @property
+    def sorted_items(self)->list:
+        """
+        The non-zero (good, value) pairs, from best to worst.
+        """
+        return self.valuation.cached("sorted_items", lambda: sorted(self.map_good_to_value.items(), key=lambda item: -item[1]))
+
+    def _values_in(self, goods)->list:
+        """
+        The non-zero values of the given goods. Iterates over the goods or over the agent's non-zero goods,
+        whichever is smaller.
+        """
+        map_good_to_value = self.map_good_to_value
+        if not isinstance(goods, (set, frozenset)):
+            goods = set(goods)
+        if len(goods) < len(map_good_to_value):
+            return [map_good_to_value[good] for good in goods if good in map_good_to_value]
+        else:
+            return [value for good,value in map_good_to_value.items() if good in goods]
+
+    def value(self, goods:set)->int:
+        return sum(self._values_in(goods))
+
+    def _sorted_bundle_values(self, bundle:set)->list:
+        # The values of all goods in the bundle, from best to worst, including the zeros.
+        values = self._values_in(bundle)
+        num_of_zeros = len(bundle) - len(values)
+        positive = sorted([value for value in values if value > 0], reverse=True)
+        negative = sorted([value for value in values if value < 0], reverse=True)
+        return positive + [0] * num_of_zeros + negative
+
+    def value_except_best_c_goods(self, bundle:set, c:int=1)->int:
+        if len(bundle) <= c: return 0
+        if self.sorted_items[-1:] and self.sorted_items[-1][1] > 0:   # no negative values - scan the best goods only
+            if not isinstance(bundle, (set, frozenset)):
+                bundle = set(bundle)
+            removed_value, num_of_removed = 0, 0
+            for good, value in self.sorted_items:
+                if num_of_removed == c:
+                    break
+                if good in bundle:
+                    removed_value += value
+                    num_of_removed += 1
+            return self.value(bundle) - removed_value
+        return sum(self._sorted_bundle_values(bundle)[c:])
+
+    def value_except_worst_c_goods(self, bundle:set, c:int=1)->int:
+        if len(bundle) <= c: return 0
+        return sum(self._sorted_bundle_values(bundle)[:len(bundle)-c])
+
+    def value_of_cth_best_good(self, c:int)->int:
+        if c > len(self.desired_goods):
+            return 0
+        return self.sorted_items[c-1][1]
+
+    def __repr__(self):
+        vals = " ".join(["{}={}".format(k,v) for k,v in sorted(self.map_good_to_value.items())])
+        return "{} agent{} with sparse additive valuations: {}".format(self.cardinality, plural(self.cardinality), vals)
+
+
 class BinaryAgent(Agent):
     """
     Represents an agent with binary valuations, or several agents with the same binary valuations.
@@ -427,6 +671,7 @@ class BinaryAgent(Agent):
     >>> BinaryAgent({"x","y","z"}, 2)
     2 binary agents who want ['x', 'y', 'z']
     """
+    __slots__ = ()
 
     def __init__(self, desired_goods:set, cardinality:int=1):
         """
@@ -434,7 +679,9 @@ class BinaryAgent(Agent):
         :param desired_goods: a set of strings - each string is a good.
         :param cardinality: the number of agents with the same set of desired goods.
         """
-        super().__init__(desired_goods, cardinality=cardinality)
+        desired_goods = frozenset(desired_goods)
+        key = ("binary", desired_goods)
+        super().__init__(Valuation.interned(key, lambda: Valuation(key, desired_goods)), cardinality=cardinality)
 
     def value(self, goods:set)->int:
         """
@@ -473,11 +720,22 @@ class BinaryAgent(Agent):
     def value_1_of_c_MMS(self, c:int=1, approximation_factor:float=1)->int:
         return math.floor(self.total_value / c)
 
+    def has_integer_values(self)->bool:
+        return True
+
+    def canonical_valuation(self):
+        return self.desired_goods_list
+
     def __repr__(self):
         return "{} binary agent{} who want {}".format(self.cardinality, plural(self.cardinality), sorted(self.desired_goods))
 
 
 
+def _are_integers(values)->bool:
+    return all([value == math.floor(value) for value in values])
+
+
+
 if __name__ == "__main__":
     import doctest
     (failures,tests) = doctest.testmod(report=True)
@@ -0,0 +1,417 @@
+#!python3
+
+"""
+A local asyncio service that runs the allocation protocols on instances given in JSON.
+
+Requests are queued, grouped into small batches, and dispatched to a pool of worker processes.
+The workers stay alive between batches, so their caches
+(e.g. the RWAV weight tables and the compiled thresholds of recurring families) remain warm.
+The service works fully offline. It can be used in-process (AllocationService.allocate),
+or served over HTTP on a TCP port or a Unix socket (POST /allocate).
+
+An instance is a JSON object such as:
+
+    {"protocol": "rwav",
+     "goods": ["w","x","y","z"],
+     "families": [
+        {"name": "Family 1", "criterion": {"type": "OneOfBestC", "c": 2},
+         "members": [{"desired_goods": ["w","x"], "cardinality": 1}, {"values": {"y":2, "z":1}}]}],
+     "options": {},
+     "deadline": 10}
+
+The reply contains the bundles and the happiness statistics of each family.
+"""
+
+from agents import *
+from families import Family, min_fraction_of_happy_members
+import fairness_criteria
+import rwav_protocol, enhanced_rwav_protocol, line_protocol, twothirds_protocol, optimal_protocol, local_search_protocol
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import asyncio, json, multiprocessing, time
+
+import logging, sys
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler(sys.stdout))
+# To enable tracing, logger.setLevel(logging.INFO)
+
+
+PROTOCOLS = {
+    "rwav": rwav_protocol.allocate,
+    "enhanced_rwav": enhanced_rwav_protocol.allocate,
+    "line": line_protocol.allocate,
+    "twothirds": twothirds_protocol.allocate,
+    "optimal": optimal_protocol.allocate,
+    "local_search": local_search_protocol.allocate,
+}
+PROTOCOLS_WITH_TIME_LIMIT = {"optimal", "local_search"}
+
+
+### Encoding and decoding
+
+def agent_from_json(member:dict)->Agent:
+    """
+    >>> agent_from_json({"desired_goods": ["x","y"], "cardinality": 2})
+    2 binary agents who want ['x', 'y']
+    >>> agent_from_json({"values": {"x":1, "y":3}})
+    1 agent  with additive valuations: x=1 y=3
+    """
+    cardinality = member.get("cardinality", 1)
+    if "desired_goods" in member:
+        return BinaryAgent(member["desired_goods"], cardinality)
+    elif "values" in member:
+        return AdditiveAgent(member["values"], cardinality)
+    else:
+        raise ValueError("A member should have either 'desired_goods' or 'values': {}".format(member))
+
+
+def criterion_from_json(criterion:dict)->fairness_criteria.FairnessCriterion:
+    """
+    >>> criterion_from_json({"type": "MaximinShareOneOfC", "c": 3}).name
+    '1-out-of-3-maximin-share'
+    >>> criterion_from_json({"type": "Unknown"})
+    Traceback (most recent call last):
+    ...
+    ValueError: Unknown fairness criterion: Unknown
+    """
+    arguments = dict(criterion)
+    criterion_class = getattr(fairness_criteria, arguments.pop("type", ""), None)
+    if not (isinstance(criterion_class, type) and issubclass(criterion_class, fairness_criteria.FairnessCriterion)):
+        raise ValueError("Unknown fairness criterion: {}".format(criterion.get("type")))
+    return criterion_class(**arguments)
+
+
+@lru_cache(maxsize=1024)
+def family_from_json(family_json:str)->Family:
+    """
+    Decodes a family from its canonical JSON string.
+    Decoded families are cached, so a family that recurs in many requests
+    is decoded, and its thresholds are compiled, only once per worker.
+    """
+    family = json.loads(family_json)
+    return Family([agent_from_json(member) for member in family["members"]],
+                  criterion_from_json(family["criterion"]), name=family.get("name", "Anonymous Family"))
+
+
+def allocation_to_json(families:list, bundles:list)->dict:
+    """
+    >>> family1 = Family([BinaryAgent("xy",1), BinaryAgent("yz",2)], fairness_criteria.OneOfBestC(2), name="Family 1")
+    >>> family2 = Family([BinaryAgent("xz",1)], fairness_criteria.OneOfBestC(2), name="Family 2")
+    >>> allocation_to_json([family1, family2], [set("y"), set("xz")])
+    {'bundles': [['y'], ['x', 'z']], 'happy_members': [3, 1], 'num_of_members': [3, 1], 'min_fraction': 1.0}
+    """
+    return {
+        "bundles": [sorted(bundle) for bundle in bundles],
+        "happy_members": [family.num_of_happy_members(bundle, bundles) for family,bundle in zip(families, bundles)],
+        "num_of_members": [family.num_of_members for family in families],
+        "min_fraction": min_fraction_of_happy_members(families, bundles),
+    }
+
+
+def validate_instance(instance:dict):
+    """
+    Checks the structure of the given instance, so that invalid instances are rejected before they are queued.
+    :raise ValueError if the instance is invalid.
+
+    >>> validate_instance({"goods": "xy", "families": [{"criterion": {"type": "OneOfBestC", "c": 2}, "members": []}]})
+    >>> validate_instance({"goods": "xy", "families": [1]})
+    Traceback (most recent call last):
+    ...
+    ValueError: Each family should be an object with 'criterion' and 'members': 1
+    >>> validate_instance({"goods": "xy", "families": [], "deadline": "soon"})
+    Traceback (most recent call last):
+    ...
+    ValueError: The deadline should be a positive number of seconds: 'soon'
+    """
+    if not isinstance(instance, dict):
+        raise ValueError("An instance should be an object: {!r}".format(instance))
+    if not isinstance(instance.get("goods"), (str, list)):
+        raise ValueError("The goods should be a string or a list: {!r}".format(instance.get("goods")))
+    families = instance.get("families")
+    if not isinstance(families, list):
+        raise ValueError("The families should be a list: {!r}".format(families))
+    for family in families:
+        if not (isinstance(family, dict) and isinstance(family.get("criterion"), dict) and isinstance(family.get("members"), list)):
+            raise ValueError("Each family should be an object with 'criterion' and 'members': {!r}".format(family))
+        for member in family["members"]:
+            if not isinstance(member, dict):
+                raise ValueError("Each member should be an object: {!r}".format(member))
+    if "deadline" in instance:
+        deadline = instance["deadline"]
+        if isinstance(deadline, bool) or not isinstance(deadline, (int, float)) or deadline <= 0:
+            raise ValueError("The deadline should be a positive number of seconds: {!r}".format(deadline))
+    if not isinstance(instance.get("options", {}), dict):
+        raise ValueError("The options should be an object: {!r}".format(instance.get("options")))
+
+
+def run_instance(instance:dict, time_limit:float=None)->dict:
+    """
+    Runs the protocol requested in the given instance.
+    :param time_limit: the time left until the request's deadline; passed to protocols that support a time limit.
+
+    >>> run_instance({"protocol": "rwav", "goods": "wxyz", "families": [
+    ...     {"criterion": {"type": "OneOfBestC", "c": 2}, "members": [{"desired_goods": "wx"}, {"desired_goods": "yz"}]},
+    ...     {"criterion": {"type": "OneOfBestC", "c": 2}, "members": [{"desired_goods": "wz"}]}]})
+    {'bundles': [['w', 'y'], ['x', 'z']], 'happy_members': [2, 1], 'num_of_members': [2, 1], 'min_fraction': 1.0}
+    """
+    protocol_name = instance.get("protocol", "rwav")
+    if protocol_name not in PROTOCOLS:
+        raise ValueError("Unknown protocol: {}".format(protocol_name))
+    families = [family_from_json(json.dumps(family, sort_keys=True)) for family in instance["families"]]
+    options = dict(instance.get("options", {}))
+    if protocol_name in PROTOCOLS_WITH_TIME_LIMIT and time_limit is not None:
+        options.setdefault("time_limit", time_limit)
+    bundles = PROTOCOLS[protocol_name](families, list(instance["goods"]), **options)
+    return allocation_to_json(families, bundles)
+
+
+### Worker side
+
+def _warm_up():
+    """
+    Runs once in each worker process: pre-computes the RWAV weight tables for 2 to 8 families.
+    """
+    for k in range(2, 9):
+        rwav_protocol.weight_table(k).extend(64)
+
+
+def _run_batch(batch:list)->list:
+    """
+    Runs a batch of instances in a worker process.
+    :param batch: a list of (instance, expiration_time) pairs.
+    :return a list of (status, result) pairs, where status is "ok", "error" or "expired".
+    """
+    results = []
+    for (instance, expiration_time) in batch:
+        time_left = expiration_time - time.time()
+        if time_left <= 0:
+            results.append(("expired", "The deadline expired before the request was processed"))
+            continue
+        try:
+            results.append(("ok", run_instance(instance, time_left)))
+        except Exception as error:
+            results.append(("error", "{}: {}".format(type(error).__name__, error)))
+    return results
+
+
+### Service side
+
+class AllocationService:
+    """
+    An asyncio service that batches allocation requests and dispatches them to worker processes.
+
+    >>> async def main():
+    ...     async with AllocationService(num_of_workers=0) as service:
+    ...         return await asyncio.gather(*[service.allocate({"protocol": "line", "goods": "xyz", "families": [
+    ...             {"criterion": {"type": "ProportionalExceptC", "num_of_agents": 2, "c": 1}, "members": [{"values": {"x":1, "y":1, "z":4}}]},
+    ...             {"criterion": {"type": "ProportionalExceptC", "num_of_agents": 2, "c": 1}, "members": [{"desired_goods": "xy"}]}]})
+    ...             for i in range(3)])
+    >>> results = asyncio.run(main())
+    >>> len(results)
+    3
+    >>> results[0]
+    {'bundles': [['x'], ['y', 'z']], 'happy_members': [1, 1], 'num_of_members': [1, 1], 'min_fraction': 1.0}
+
+    Invalid instances raise a ValueError:
+    >>> async def main():
+    ...     async with AllocationService(num_of_workers=0) as service:
+    ...         return await service.allocate({"protocol": "unknown", "goods": "", "families": []})
+    >>> asyncio.run(main())
+    Traceback (most recent call last):
+    ...
+    ValueError: ValueError: Unknown protocol: unknown
+
+    A malformed instance fails alone, without affecting the following requests:
+    >>> async def main():
+    ...     async with AllocationService(num_of_workers=0) as service:
+    ...         return await asyncio.gather(service.allocate({"goods": "xy", "families": [1]}),
+    ...             service.allocate({"goods": "wxyz", "families": [
+    ...                 {"criterion": {"type": "OneOfBestC", "c": 2}, "members": [{"desired_goods": "wx"}]},
+    ...                 {"criterion": {"type": "OneOfBestC", "c": 2}, "members": [{"desired_goods": "yz"}]}]}),
+    ...             return_exceptions=True)
+    >>> (error, result) = asyncio.run(main())
+    >>> error
+    ValueError("Each family should be an object with 'criterion' and 'members': 1")
+    >>> result["min_fraction"]
+    1.0
+    """
+
+    def __init__(self, num_of_workers:int=2, batch_size:int=16, batch_delay:float=0.005,
+                 max_batched_size:int=1000, max_pending:int=1000, default_deadline:float=60):
+        """
+        :param num_of_workers: the number of worker processes. If 0, batches run in a thread of the current process.
+        :param batch_size: the maximum number of requests in a batch.
+        :param batch_delay: how long (in seconds) to wait for more requests before dispatching a partial batch.
+        :param max_batched_size: instances with more goods*members than this are dispatched alone, not batched.
+        :param max_pending: the maximum number of queued requests; when the queue is full,
+            in-process callers wait and HTTP requests are rejected with status 503 (backpressure).
+        :param default_deadline: the deadline (in seconds) of requests that do not specify one.
+        """
+        self.num_of_workers = num_of_workers
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.max_batched_size = max_batched_size
+        self.max_pending = max_pending
+        self.default_deadline = default_deadline
+        self.executor = None
+        self.queue = None
+        self.servers = []
+
+    async def start(self):
+        if self.num_of_workers > 0:
+            # "spawn" rather than "fork", so that the workers do not inherit the sockets of open connections.
+            self.executor = ProcessPoolExecutor(self.num_of_workers, initializer=_warm_up,
+                                                mp_context=multiprocessing.get_context("spawn"))
+        self.queue = asyncio.Queue(maxsize=self.max_pending)
+        self.free_workers = asyncio.Semaphore(max(1, self.num_of_workers))
+        self.batcher = asyncio.ensure_future(self._batcher())
+        return self
+
+    async def close(self):
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
+        self.batcher.cancel()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def allocate(self, instance:dict)->dict:
+        """
+        The in-process client: submits an instance and waits for its allocation.
+        :raise ValueError if the instance is invalid; asyncio.TimeoutError if its deadline expires.
+        """
+        validate_instance(instance)
+        deadline = instance.get("deadline", self.default_deadline)
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((instance, time.time() + deadline, future))
+        (status, result) = await asyncio.wait_for(future, deadline)
+        if status == "expired":
+            raise asyncio.TimeoutError(result)
+        elif status == "error":
+            raise ValueError(result)
+        return result
+
+    def _is_small(self, instance:dict)->bool:
+        num_of_members = sum([len(family.get("members", [])) for family in instance.get("families", [])])
+        return len(instance.get("goods", [])) * num_of_members <= self.max_batched_size
+
+    def _is_small_or_fail(self, item:tuple)->bool:
+        """
+        Checks if the instance of the given queued item is small; if the check fails, the item's request fails alone.
+        """
+        (instance, expiration_time, future) = item
+        try:
+            return self._is_small(instance)
+        except Exception as error:
+            if not future.done():
+                future.set_result(("error", "{}: {}".format(type(error).__name__, error)))
+            return False
+
+    async def _batcher(self):
+        """
+        Collects small requests into batches, and dispatches each batch when a worker is free.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            if self._is_small_or_fail(batch[0]):
+                batch_deadline = loop.time() + self.batch_delay
+                while len(batch) < self.batch_size:
+                    timeout = batch_deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                    if self._is_small_or_fail(item):
+                        batch.append(item)
+                    else:
+                        await self._dispatch([item])
+            await self._dispatch(batch)
+
+    async def _dispatch(self, batch:list):
+        await self.free_workers.acquire()
+        asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch:list):
+        try:
+            logger.info("Dispatching a batch of {} requests".format(len(batch)))
+            arguments = [(instance, expiration_time) for (instance, expiration_time, future) in batch]
+            try:
+                results = await asyncio.get_running_loop().run_in_executor(self.executor, _run_batch, arguments)
+            except Exception as error:
+                results = [("error", "{}: {}".format(type(error).__name__, error))] * len(batch)
+            for (instance, expiration_time, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            self.free_workers.release()
+
+    async def serve(self, host:str="127.0.0.1", port:int=8000, unix_path:str=None):
+        """
+        Serves the allocation requests over HTTP - on a TCP port, or on a Unix socket if unix_path is given.
+        """
+        if unix_path is not None:
+            server = await asyncio.start_unix_server(self._handle_http, path=unix_path)
+        else:
+            server = await asyncio.start_server(self._handle_http, host=host, port=port)
+        self.servers.append(server)
+        return server
+
+    async def _handle_http(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+        try:
+            (method, path, version) = (await reader.readline()).decode().split(" ", 2)
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode()
+                if line.strip() == "":
+                    break
+                (key, value) = line.split(":", 1)
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+            if method != "POST" or path != "/allocate":
+                (status, reply) = (404, {"error": "Use POST /allocate"})
+            elif self.queue.full():
+                (status, reply) = (503, {"error": "The service is overloaded"})
+            else:
+                try:
+                    (status, reply) = (200, await self.allocate(json.loads(body)))
+                except asyncio.TimeoutError:
+                    (status, reply) = (504, {"error": "The deadline expired"})
+                except ValueError as error:
+                    (status, reply) = (400, {"error": str(error)})
+        except (ValueError, asyncio.IncompleteReadError) as error:
+            (status, reply) = (400, {"error": "Malformed request: {}".format(error)})
+        body = json.dumps(reply).encode()
+        writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: close\r\n\r\n".format(
+            status, HTTP_REASONS[status], len(body)).encode() + body)
+        await writer.drain()
+        writer.close()
+
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 503: "Service Unavailable", 504: "Gateway Timeout"}
+
+
+async def serve_forever(host:str="127.0.0.1", port:int=8000, unix_path:str=None, **kwargs):
+    """
+    Runs the service until it is interrupted, e.g.:
+        asyncio.run(allocation_service.serve_forever(port=8000, num_of_workers=4))
+    NOTE: the worker processes are spawned, so the calling script should be guarded by  if __name__ == "__main__".
+    """
+    async with AllocationService(**kwargs) as service:
+        server = await service.serve(host, port, unix_path)
+        await server.serve_forever()
+
+
+
+if __name__ == "__main__":
+    import doctest
+    (failures,tests) = doctest.testmod(report=True)
+    print ("{} failures, {} tests".format(failures,tests))
@@ -0,0 +1,255 @@
+#!python3
+
+"""
+A mutable allocation of goods to families, for protocols and search algorithms that change an allocation step by step.
+
+The state keeps the value of each member to its family's bundle, and the (weighted) number of happy members in each family.
+Moving a good touches only the members who want this good, in the two families involved,
+so moves, swaps and their evaluation take time proportional to the number of these members.
+
+It supports agents with additive valuations (binary or additive).
+The happy counts are kept only for families whose fairness criterion is based on a target value (e.g. 1-of-best-c, MMS, PROPc);
+for other families (e.g. EF1) only the members' values are kept, and their number of happy members is None.
+"""
+
+from agents import *
+from families import Family
+import fairness_criteria
+from optimal_protocol import good_values
+from collections import defaultdict
+
+import logging, sys
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler(sys.stdout))
+# To enable tracing, logger.setLevel(logging.INFO)
+
+
+class AllocationState:
+    """
+    An allocation of goods to families, with incremental happiness counts.
+
+    >>> fairness_1_of_best_2 = fairness_criteria.OneOfBestC(2)
+    >>> family1 = Family([BinaryAgent({"w","x"},1),BinaryAgent({"x","y"},2),BinaryAgent({"y","z"},3), BinaryAgent({"z","w"},4)], fairness_1_of_best_2)
+    >>> family2 = Family([BinaryAgent({"w","z"},2),BinaryAgent({"z","y"},3)], fairness_1_of_best_2)
+    >>> state = AllocationState([family1, family2], "wxyz", [set("wx"), set("yz")])
+    >>> state.num_of_happy, state.fractions()
+    ([7, 5], [0.7, 1.0])
+    >>> state.delta_if_moved("y", 0)
+    {1: 0, 0: 3}
+    >>> state.move("y", 0)
+    >>> state.num_of_happy, sorted(state.bundles[0])
+    ([10, 5], ['w', 'x', 'y'])
+    >>> position = state.snapshot()
+    >>> state.delta_if_swapped("w", "z")
+    {0: 0, 1: -3}
+    >>> state.swap("w", "z")
+    >>> state.num_of_happy, sorted(state.bundles[0])
+    ([10, 2], ['x', 'y', 'z'])
+    >>> state.rollback(position)
+    >>> state.num_of_happy, sorted(state.bundles[0])
+    ([10, 5], ['w', 'x', 'y'])
+    >>> family3 = Family([BinaryAgent({"w","x"},1), BinaryAgent({"y","z"},2)], fairness_criteria.EnvyFreeExceptC(1))
+    >>> state = AllocationState([family1, family3], "wxyz", [set("wx"), set("yz")])
+    >>> state.num_of_happy, state.fractions(), state.own_values[1]
+    ([7, None], [0.7, None], [0, 2])
+    >>> state.delta_if_moved("y", 0)
+    {0: 3}
+    >>> state.move("y", 0)
+    >>> state.num_of_happy, state.own_values[1]
+    ([10, None], [0, 1])
+    """
+
+    def __init__(self, families:list, goods:list, bundles:list=None):
+        """
+        :param families: a list of k Family objects.
+        :param goods: a list of goods.
+        :param bundles: the initial bundle of each family; goods that are not in any bundle are given to the first family.
+        """
+        self.families = families
+        self.num_of_families = len(families)
+        self.goods = list(goods)
+        self.map_good_to_owner = {}
+        for f,bundle in enumerate(bundles or []):
+            for good in bundle:
+                self.map_good_to_owner[good] = f
+        self.bundles = [set() for f in families]
+        for good in self.goods:
+            self.map_good_to_owner.setdefault(good, 0)
+            self.bundles[self.map_good_to_owner[good]].add(good)
+
+        self.targets = []         # targets[f] = the compiled thresholds of the members of family f, or None if it has none
+        self.cardinalities = []
+        self.own_values = []
+        self.num_of_happy = []
+        # map_good_to_wanters[good][f] = list of (member_index, value) for members of family f who want the good.
+        self.map_good_to_wanters = {good: [[] for f in families] for good in self.goods}
+        for f,family in enumerate(families):
+            thresholds = family.thresholds()
+            self.targets.append(None if None in thresholds else thresholds)
+            self.cardinalities.append([member.cardinality for member in family.members])
+            own_values = [0] * len(family.members)
+            for i,member in enumerate(family.members):
+                for good,value in good_values(member).items():
+                    if good in self.map_good_to_wanters:
+                        self.map_good_to_wanters[good][f].append((i, value))
+                        if self.map_good_to_owner[good] == f:
+                            own_values[i] += value
+            self.own_values.append(own_values)
+            if self.targets[f] is None:
+                self.num_of_happy.append(None)
+            else:
+                self.num_of_happy.append(sum([self.cardinalities[f][i] for i in range(len(family.members))
+                                              if own_values[i] >= self.targets[f][i]]))
+        self._journal = None   # the list of (good, from_family) of the moves since the first snapshot, for rollback
+
+    def fractions(self, num_of_happy:list=None)->list:
+        """
+        :return: the fraction of happy members in each family (by default, with the current numbers of happy members),
+                 or None for families without happy counts.
+        """
+        if num_of_happy is None:
+            num_of_happy = self.num_of_happy
+        return [None if num_of_happy[f] is None else num_of_happy[f] / self.families[f].num_of_members
+                for f in range(self.num_of_families)]
+
+    def bundles_copy(self)->list:
+        return [set(bundle) for bundle in self.bundles]
+
+    def value_changes(self, moves:list)->dict:
+        """
+        :param moves: a list of (good, to_family) pairs.
+        :return: a dict that maps (family_index, member_index) to the change in the member's value.
+        """
+        changes = defaultdict(int)
+        for (good, to_family) in moves:
+            from_family = self.map_good_to_owner[good]
+            if from_family == to_family:
+                continue
+            for (i, value) in self.map_good_to_wanters[good][from_family]:
+                changes[(from_family, i)] -= value
+            for (i, value) in self.map_good_to_wanters[good][to_family]:
+                changes[(to_family, i)] += value
+        return changes
+
+    def happy_deltas(self, changes:dict)->dict:
+        """
+        :param changes: a dict of value changes (see value_changes).
+        :return: a dict that maps each family index, whose members' values change, to the change in its number of happy members
+                 (families without happy counts are skipped).
+        """
+        deltas = {}
+        for (f, i), change in changes.items():
+            if self.targets[f] is None:
+                continue
+            old_value = self.own_values[f][i]
+            target = self.targets[f][i]
+            delta = deltas.get(f, 0)
+            if old_value < target <= old_value + change:
+                delta += self.cardinalities[f][i]
+            elif old_value + change < target <= old_value:
+                delta -= self.cardinalities[f][i]
+            deltas[f] = delta
+        return deltas
+
+    def num_of_happy_after(self, moves:list)->list:
+        """
+        :return: the number of happy members in each family, if the given (good, to_family) moves were applied.
+        """
+        num_of_happy = list(self.num_of_happy)
+        for f, delta in self.happy_deltas(self.value_changes(moves)).items():
+            num_of_happy[f] += delta
+        return num_of_happy
+
+    def delta_if_moved(self, good, to_family:int)->dict:
+        """
+        :return: a dict that maps each affected family index to the change in its number of happy members,
+                 if the given good were moved to the given family.
+        """
+        return self.happy_deltas(self.value_changes([(good, to_family)]))
+
+    def delta_if_swapped(self, good1, good2)->dict:
+        """
+        :return: a dict that maps each affected family index to the change in its number of happy members,
+                 if the owners of the given goods were exchanged.
+        """
+        return self.happy_deltas(self.value_changes(self._swap_moves(good1, good2)))
+
+    def move(self, good, to_family:int):
+        """
+        Move the given good to the given family.
+        """
+        from_family = self.map_good_to_owner[good]
+        if from_family == to_family:
+            return
+        if self._journal is not None:
+            self._journal.append((good, from_family))
+        self._apply([(good, to_family)])
+
+    def swap(self, good1, good2):
+        """
+        Exchange the owners of the given goods.
+        """
+        for (good, to_family) in self._swap_moves(good1, good2):
+            self.move(good, to_family)
+
+    def apply(self, moves:list):
+        """
+        Apply several (good, to_family) moves.
+        """
+        for (good, to_family) in moves:
+            self.move(good, to_family)
+
+    def _swap_moves(self, good1, good2)->list:
+        return [(good1, self.map_good_to_owner[good2]), (good2, self.map_good_to_owner[good1])]
+
+    def _apply(self, moves:list):
+        changes = self.value_changes(moves)
+        for f, delta in self.happy_deltas(changes).items():
+            self.num_of_happy[f] += delta
+        for (f, i), change in changes.items():
+            self.own_values[f][i] += change
+        for (good, to_family) in moves:
+            self.bundles[self.map_good_to_owner[good]].remove(good)
+            self.bundles[to_family].add(good)
+            self.map_good_to_owner[good] = to_family
+
+    def snapshot(self)->int:
+        """
+        Starts recording the moves (if they are not recorded yet), so that the current allocation can be restored.
+        :return: a position, for rollback.
+        """
+        if self._journal is None:
+            self._journal = []
+        return len(self._journal)
+
+    def rollback(self, position:int):
+        """
+        Undo the moves since the snapshot that returned the given position, in time proportional to the number of these moves.
+
+        >>> family = Family([BinaryAgent("xy",1)], fairness_criteria.OneOfBestC(2))
+        >>> state = AllocationState([family, family], "xy")
+        >>> position = state.snapshot()
+        >>> state.commit()
+        >>> state.rollback(position)
+        Traceback (most recent call last):
+        ...
+        ValueError: There is no snapshot to roll back to
+        """
+        if self._journal is None or position > len(self._journal):
+            raise ValueError("There is no snapshot to roll back to")
+        while len(self._journal) > position:
+            (good, from_family) = self._journal.pop()
+            self._apply([(good, from_family)])
+
+    def commit(self):
+        """
+        Stops recording the moves; all earlier snapshots become invalid.
+        """
+        self._journal = None
+
+
+
+if __name__ == "__main__":
+    import doctest
+    (failures,tests) = doctest.testmod(report=True)
+    print ("{} failures, {} tests".format(failures,tests))
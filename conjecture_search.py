@@ -0,0 +1,375 @@
+#!python3
+
+"""
+An exhaustive search engine for conjectures on democratic fairness, of the form:
+"for every k families of agents of the given types, there is an allocation of the goods
+ in which at least a fraction 'threshold' of the members of each family are happy".
+
+A conjecture is described by a Configuration: the goods, the number of families,
+the agent types (e.g. all agents that approve r goods, or all small additive valuations),
+the maximum number of agents of each type in a family, the fairness criterion and the threshold.
+For example, the 2/3 conjecture of twothirds_exhaustive_search is
+Configuration(goods, 2, ("approval", 2), fairness_criteria.OneOfBestC(2), 2/3).
+
+Each family is a vector of multiplicities of the agent types, and each allocation of the goods
+to k families is a vector of m digits in base k; both are enumerated by mixed-radix Gray-code counters
+(see partitions.mixed_radix_gray_code_moves), so the happy counts and the bundles are updated incrementally.
+The happy agent types of every bundle are computed once per goods, agent types and fairness criterion,
+and shared by all configurations that differ only in the number of families, the multiplicities or the threshold.
+"""
+
+from agents import BinaryAgent, AdditiveAgent
+from families import Family
+import fairness_criteria
+from fairness_criteria import FairnessCriterion
+from partitions import mixed_radix_gray_code_moves
+from fractions import Fraction
+from array import array
+import copy, itertools, math, multiprocessing
+
+import logging, sys
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler(sys.stdout))
+# To enable tracing, logger.setLevel(logging.INFO)
+
+
+def approval_types(goods:list, r:int)->list:
+    """
+    :return: all agents that want exactly r of the given goods.
+
+    >>> approval_types("wxyz", 2)[:3]
+    [1 binary agent  who want ['w', 'x'], 1 binary agent  who want ['w', 'y'], 1 binary agent  who want ['w', 'z']]
+    >>> len(approval_types("wxyz", 3))
+    4
+    """
+    return [BinaryAgent(desired_goods, 1) for desired_goods in itertools.combinations(goods, r)]
+
+
+def additive_types(goods:list, max_value:int)->list:
+    """
+    :return: all agents with additive valuations, in which the value of each good is at most max_value.
+       Valuations that are multiples of other valuations are omitted, since the fairness criteria are scale-invariant.
+
+    >>> additive_types("xy", 2)
+    [1 agent  with additive valuations: x=1 y=0, 1 agent  with additive valuations: x=0 y=1, 1 agent  with additive valuations: x=1 y=1, 1 agent  with additive valuations: x=2 y=1, 1 agent  with additive valuations: x=1 y=2]
+    """
+    result = []
+    for values in itertools.product(range(max_value + 1), repeat=len(goods)):
+        values = values[::-1]   # the first good changes fastest
+        if math.gcd(*values) == 1:
+            result.append(AdditiveAgent(dict(zip(goods, values)), 1))
+    return result
+
+
+AGENT_TYPE_GENERATORS = {"approval": approval_types, "additive": additive_types}
+
+
+class Configuration:
+    """
+    A conjecture to check.
+
+    >>> Configuration("wxyz", 2, ("approval", 2), fairness_criteria.OneOfBestC(2), 2/3)
+    2/3 conjecture for 2 families of approval-2 agents on 4 goods, with one-of-best-2
+    >>> Configuration("xyz", 3, ("additive", 1), fairness_criteria.MaximinShareOneOfC(3), 1/3, max_multiplicity=2)
+    1/3 conjecture for 3 families of additive-1 agents (at most 2 of each type) on 3 goods, with 1-out-of-3-maximin-share
+    """
+
+    def __init__(self, goods:list, num_of_families:int=2, agent_types:tuple=("approval", 2),
+                 fairness_criterion:FairnessCriterion=fairness_criteria.OneOfBestC(2), threshold:float=2/3,
+                 max_multiplicity:int=1):
+        """
+        :param goods: a list of goods.
+        :param num_of_families: the number of families (k).
+        :param agent_types: a pair (generator, parameter), where generator is a key of AGENT_TYPE_GENERATORS,
+           e.g. ("approval", 2) for the agents that want exactly two goods.
+        :param fairness_criterion: the fairness criterion of all families (it must be based on a target value).
+        :param threshold: the fraction of happy members required in each family.
+        :param max_multiplicity: the largest number of agents of each type in a family.
+        """
+        if agent_types[0] not in AGENT_TYPE_GENERATORS:
+            raise ValueError("Unknown agent types: {}".format(agent_types[0]))
+        self.goods = list(goods)
+        self.num_of_families = num_of_families
+        self.agent_types = tuple(agent_types)
+        self.fairness_criterion = fairness_criterion
+        self.threshold = threshold
+        self.max_multiplicity = max_multiplicity
+
+    def __repr__(self):
+        multiplicity = "" if self.max_multiplicity == 1 else " (at most {} of each type)".format(self.max_multiplicity)
+        return "{} conjecture for {} families of {}-{} agents{} on {} goods, with {}".format(
+            Fraction(self.threshold).limit_denominator(1000), self.num_of_families, self.agent_types[0], self.agent_types[1],
+            multiplicity, len(self.goods), self.fairness_criterion.name)
+
+
+class TypeIndex:
+    """
+    The happy agent types of every bundle, and the families of these agent types.
+    Each bundle is represented by a mask over the goods, and each family by a vector of multiplicities of the agent types.
+
+    >>> index = type_index("xyz", ("approval", 2), fairness_criteria.OneOfBestC(2))
+    >>> index.agent_types
+    [1 binary agent  who want ['x', 'y'], 1 binary agent  who want ['x', 'z'], 1 binary agent  who want ['y', 'z']]
+    >>> index.happy_bundles
+    [[1, 2, 3, 5, 6, 7], [1, 3, 4, 5, 6, 7], [2, 3, 4, 5, 6, 7]]
+    >>> index.families(1)[1]
+    [(1, 0, 0), (1, 1, 0), (0, 1, 0), (0, 1, 1), (1, 1, 1), (1, 0, 1), (0, 0, 1)]
+    >>> list(index.happy_counts(1)[4])
+    [0, 2, 2, 3, 2, 3, 3, 3]
+    >>> bin(index.fair_bundles(1, 2/3)[4]), bin(index.fair_bundles(1, 1)[4])
+    ('0b11111110', '0b11101000')
+    >>> index.family(1, 4)
+    5 seeks one-of-best-2 and has:
+     * 1 binary agent  who want ['x', 'y']
+     * 1 binary agent  who want ['x', 'z']
+     * 1 binary agent  who want ['y', 'z']
+    """
+
+    def __init__(self, goods:list, agent_types:tuple, fairness_criterion:FairnessCriterion):
+        self.goods = list(goods)
+        self.fairness_criterion = fairness_criterion
+        (generator, parameter) = agent_types
+        self.agent_types = AGENT_TYPE_GENERATORS[generator](self.goods, parameter)
+        thresholds = fairness_criterion.compile(self.agent_types)
+        if None in thresholds:
+            raise ValueError("The fairness criterion {} is not based on a target value".format(fairness_criterion.name))
+        all_bundles = [{good for g,good in enumerate(self.goods) if bundle_mask & (1 << g)}
+                       for bundle_mask in range(1 << len(self.goods))]
+        # happy_bundles[t] = the masks of the bundles with which agents of type t are happy.
+        self.happy_bundles = [[bundle_mask for bundle_mask,bundle in enumerate(all_bundles) if agent.value(bundle) >= threshold]
+                              for agent,threshold in zip(self.agent_types, thresholds)]
+        self._families = {}
+        self._fair_bundles = {}
+        self._hardest_families = {}
+
+    def families(self, max_multiplicity:int)->tuple:
+        """
+        Enumerates the families with at most max_multiplicity agents of each type, in a Gray-code order,
+        updating the happy counts with each bundle incrementally.
+        :return: a triple (num_of_members, vectors, happy_counts) of lists, with an element per family.
+        """
+        if max_multiplicity not in self._families:
+            num_of_bundles = 1 << len(self.goods)
+            vector = [0] * len(self.agent_types)
+            counts = array("q", [0] * num_of_bundles)
+            (sizes, vectors, all_counts) = ([], [], [])
+            for (t, old_multiplicity, new_multiplicity) in mixed_radix_gray_code_moves([max_multiplicity + 1] * len(self.agent_types)):
+                vector[t] = new_multiplicity
+                for bundle_mask in self.happy_bundles[t]:
+                    counts[bundle_mask] += new_multiplicity - old_multiplicity
+                if any(vector):
+                    sizes.append(sum(vector))
+                    vectors.append(tuple(vector))
+                    all_counts.append(array("q", counts))
+            self._families[max_multiplicity] = (sizes, vectors, all_counts)
+        return self._families[max_multiplicity]
+
+    def happy_counts(self, max_multiplicity:int)->list:
+        """
+        :return: the number of happy members of each family with each bundle, indexed by the bundle mask.
+        """
+        return self.families(max_multiplicity)[2]
+
+    def fair_bundles(self, max_multiplicity:int, threshold:float)->list:
+        """
+        :return: for each family, a mask over all bundle masks: bit b is set iff at least a fraction "threshold"
+           of the family members are happy with the bundle whose mask is b.
+        """
+        key = (max_multiplicity, threshold)
+        if key not in self._fair_bundles:
+            (sizes, vectors, all_counts) = self.families(max_multiplicity)
+            self._fair_bundles[key] = [
+                sum([1 << bundle_mask for bundle_mask,num_of_happy in enumerate(counts) if num_of_happy / num_of_members >= threshold])
+                for num_of_members,counts in zip(sizes, all_counts)]
+        return self._fair_bundles[key]
+
+    def hardest_families(self, max_multiplicity:int, threshold:float)->list:
+        """
+        :return: the indices of the families whose sets of fair bundles are minimal by inclusion, with one family per set.
+           If a fair allocation exists for some families, then it exists whenever a family is replaced by a family
+           with a superset of fair bundles; hence it is sufficient to check the conjecture for these families.
+
+        >>> index = type_index("xyz", ("approval", 2), fairness_criteria.OneOfBestC(2))
+        >>> index.hardest_families(1, 2/3)
+        [1, 3, 5]
+        """
+        key = (max_multiplicity, threshold)
+        if key not in self._hardest_families:
+            fair_bundles = self.fair_bundles(max_multiplicity, threshold)
+            map_fair_bundles_to_family = {}
+            for family_index,bundles in enumerate(fair_bundles):
+                map_fair_bundles_to_family.setdefault(bundles, family_index)
+            minimal = []
+            for bundles in sorted(map_fair_bundles_to_family, key=lambda bundles: bundles.bit_count()):
+                if all([other & ~bundles != 0 for other in minimal]):
+                    minimal.append(bundles)
+            self._hardest_families[key] = sorted([map_fair_bundles_to_family[bundles] for bundles in minimal])
+        return self._hardest_families[key]
+
+    def family(self, max_multiplicity:int, family_index:int)->Family:
+        """
+        Creates a Family object for the family in the given index.
+        """
+        vector = self.families(max_multiplicity)[1][family_index]
+        members = []
+        for agent,multiplicity in zip(self.agent_types, vector):
+            if multiplicity > 0:
+                member = copy.copy(agent)
+                member.cardinality = multiplicity
+                members.append(member)
+        return Family(members, self.fairness_criterion, name=family_index + 1)
+
+
+_type_indices = {}
+
+def type_index(goods:list, agent_types:tuple, fairness_criterion:FairnessCriterion)->TypeIndex:
+    """
+    Returns the type index of the given goods, agent types and fairness criterion.
+    It is computed once per process (and inherited by forked processes).
+    """
+    key = (tuple(goods), tuple(agent_types), type(fairness_criterion).__name__, tuple(sorted(vars(fairness_criterion).items())))
+    if key not in _type_indices:
+        _type_indices[key] = TypeIndex(goods, agent_types, fairness_criterion)
+    return _type_indices[key]
+
+
+def fair_assignment_exists(fair_bundles:list, num_of_goods:int)->bool:
+    """
+    Checks whether the goods can be allocated to k families, such that the bundle of each family is fair for it.
+    The k^m assignments are visited in a Gray-code order, in which consecutive assignments differ by moving a single good.
+    :param fair_bundles: for each family, a mask over the fair bundle masks (see TypeIndex.fair_bundles).
+    :param num_of_goods: the number of goods (m).
+
+    >>> fair_assignment_exists([0b0110, 0b0110], 2)   # each family should get exactly one of the two goods
+    True
+    >>> fair_assignment_exists([0b0010, 0b0010], 2)   # both families should get the first good
+    False
+    """
+    if 0 in fair_bundles:
+        return False
+    num_of_families = len(fair_bundles)
+    bundle_masks = [(1 << num_of_goods) - 1] + [0] * (num_of_families - 1)   # initially, all goods are in bundle 0
+    is_fair = [(fair_bundles[f] >> bundle_masks[f]) & 1 for f in range(num_of_families)]
+    num_of_fair = sum(is_fair)
+    if num_of_fair == num_of_families:
+        return True
+    for (good_index, from_family, to_family) in mixed_radix_gray_code_moves([num_of_families] * num_of_goods):
+        for f in (from_family, to_family):
+            bundle_masks[f] ^= 1 << good_index
+            new_is_fair = (fair_bundles[f] >> bundle_masks[f]) & 1
+            num_of_fair += new_is_fair - is_fair[f]
+            is_fair[f] = new_is_fair
+        if num_of_fair == num_of_families:
+            return True
+    return False
+
+
+def search_from(configuration:Configuration, first_position:int)->tuple:
+    """
+    Checks the conjecture for all k-tuples of the hardest families (see TypeIndex.hardest_families),
+    in which the first family is in the given position, and the other families are not in smaller positions.
+    :return: the indices of the families in the first counterexample, or None if there is no counterexample.
+    """
+    index = type_index(configuration.goods, configuration.agent_types, configuration.fairness_criterion)
+    fair_bundles = index.fair_bundles(configuration.max_multiplicity, configuration.threshold)
+    families = index.hardest_families(configuration.max_multiplicity, configuration.threshold)
+    for others in itertools.combinations_with_replacement(families[first_position:], configuration.num_of_families - 1):
+        family_indices = (families[first_position],) + others
+        if not fair_assignment_exists([fair_bundles[i] for i in family_indices], len(index.goods)):
+            return family_indices
+    logger.info("{}: no counterexample with family {}".format(configuration, families[first_position] + 1))
+    return None
+
+
+def check_conjectures(configurations:list, num_of_workers:int=1)->list:
+    """
+    Checks several conjectures, with a single pool of worker processes.
+    The work is split by the first family of each k-tuple; the precomputation is done once, before the workers start
+    (and it is inherited by the forked workers).
+    :return: a list with an element per configuration: a list of the families in the first counterexample,
+       or None if the conjecture is true.
+
+    >>> configurations = [Configuration("wxyz", 2, ("approval", 2), fairness_criteria.OneOfBestC(2), threshold)
+    ...                   for threshold in (2/3, 0.7)]
+    >>> results = check_conjectures(configurations)
+    >>> results[0] is None
+    True
+    >>> for family in results[1]: print(family)
+    9 seeks one-of-best-2 and has:
+     * 1 binary agent  who want ['w', 'x']
+     * 1 binary agent  who want ['w', 'z']
+     * 1 binary agent  who want ['x', 'y']
+    29 seeks one-of-best-2 and has:
+     * 1 binary agent  who want ['w', 'x']
+     * 1 binary agent  who want ['w', 'y']
+     * 1 binary agent  who want ['x', 'z']
+    >>> str(check_conjectures(configurations, num_of_workers=2)) == str(results)
+    True
+    """
+    indices = []
+    tasks = []
+    for configuration in configurations:
+        index = type_index(configuration.goods, configuration.agent_types, configuration.fairness_criterion)
+        num_of_families = len(index.hardest_families(configuration.max_multiplicity, configuration.threshold))
+        indices.append(index)
+        tasks.append([(configuration, first_position) for first_position in range(num_of_families)])
+    if num_of_workers == 1:
+        results = []
+        for configuration_tasks in tasks:
+            result = None
+            for task in configuration_tasks:
+                result = search_from(*task)
+                if result is not None:
+                    break
+            results.append([result])
+    else:
+        all_tasks = [task for configuration_tasks in tasks for task in configuration_tasks]
+        with multiprocessing.Pool(num_of_workers) as pool:
+            all_results = pool.starmap(search_from, all_tasks, chunksize=max(1, len(all_tasks) // (4 * num_of_workers)))
+        results = []
+        for configuration_tasks in tasks:
+            results.append(all_results[:len(configuration_tasks)])
+            all_results = all_results[len(configuration_tasks):]
+    counterexamples = []
+    for configuration,index,configuration_results in zip(configurations, indices, results):
+        family_indices = next((result for result in configuration_results if result is not None), None)
+        counterexamples.append(None if family_indices is None else
+            [index.family(configuration.max_multiplicity, i) for i in family_indices])
+    return counterexamples
+
+
+def check_conjecture(configuration:Configuration, num_of_workers:int=1):
+    """
+    Checks a single conjecture, and prints the result.
+
+    >>> check_conjecture(Configuration("wxyz", 2, ("approval", 2), fairness_criteria.OneOfBestC(2), 2/3))
+    Checking the 2/3 conjecture for 2 families of approval-2 agents on 4 goods, with one-of-best-2...
+    The conjecture is true
+    >>> check_conjecture(Configuration("wxyz", 3, ("approval", 2), fairness_criteria.OneOfBestC(3), 1/3))   # see line_protocol
+    Checking the 1/3 conjecture for 3 families of approval-2 agents on 4 goods, with one-of-best-3...
+    The conjecture is true
+    >>> check_conjecture(Configuration("xyz", 3, ("approval", 2), fairness_criteria.OneOfBestC(2), 1/3))
+    Checking the 1/3 conjecture for 3 families of approval-2 agents on 3 goods, with one-of-best-2...
+    The conjecture is false for the following families:
+    1 seeks one-of-best-2 and has:
+     * 1 binary agent  who want ['x', 'y']
+    1 seeks one-of-best-2 and has:
+     * 1 binary agent  who want ['x', 'y']
+    1 seeks one-of-best-2 and has:
+     * 1 binary agent  who want ['x', 'y']
+    """
+    print("Checking the {}...".format(configuration))
+    counterexample = check_conjectures([configuration], num_of_workers)[0]
+    if counterexample is None:
+        print("The conjecture is true")
+    else:
+        print("The conjecture is false for the following families:")
+        for family in counterexample:
+            print(family)
+
+
+
+if __name__ == "__main__":
+    import doctest
+    (failures,tests) = doctest.testmod(report=True)
+    print ("{} failures, {} tests".format(failures,tests))
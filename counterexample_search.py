@@ -0,0 +1,259 @@
+#!python3
+
+"""
+A randomized search for counterexamples to the two-thirds conjecture,
+for numbers of goods that are too large for twothirds_exhaustive_search (e.g. 7 to 12 goods).
+
+Each search chain walks over pairs of families by simulated annealing:
+a step adds, removes or replaces a single agent (a pair of goods) in one of the families,
+and the objective is the best fraction of the pair (see twothirds_exhaustive_search.best_fraction),
+which the chain tries to push below 2/3.
+Each family is represented by a vector of multiplicities of the agent types,
+and its happy counts with all bundles are updated incrementally.
+The chains run independently on a process pool; each chain is determined by its seed,
+so every near-counterexample can be reproduced from the seed and step number in the log.
+"""
+
+from families import Family
+from agents import BinaryAgent
+from twothirds_exhaustive_search import FamilyIndex, FRACTION_THRESHOLD, best_fraction, sorted_bundles, fairness_1_of_best_2
+from fractions import Fraction
+import json, math, multiprocessing, random
+
+import logging, sys
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler(sys.stdout))
+# To enable tracing, logger.setLevel(logging.INFO)
+
+
+def search(goods:str, num_of_chains:int=1, num_of_steps:int=1000, seed:int=None, num_of_workers:int=1,
+           max_multiplicity:int=1, num_of_near_counterexamples:int=10, log_path:str=None,
+           initial_temperature:float=0.05, final_temperature:float=0.001)->list:
+    """
+    Searches for pairs of families with a small best fraction.
+    :param goods: the goods.
+    :param num_of_chains: the number of independent annealing chains; chain c uses the random seed seed+c.
+    :param num_of_steps: the number of steps in each chain.
+    :param seed: a random seed, for reproducibility.
+    :param num_of_workers: the number of worker processes.
+    :param max_multiplicity: the largest number of agents of each type in a family.
+    :param num_of_near_counterexamples: the number of pairs with the smallest best fractions to return.
+    :param log_path: an optional file, to which the near-counterexamples are appended as JSON lines,
+       with the arguments of replay_chain that reproduce them.
+    :param initial_temperature, final_temperature: the annealing temperatures (0 for hill climbing).
+    :return: a list of tuples (fraction, vector1, vector2, chain_seed, step), from the smallest fraction.
+
+    >>> results = search("vwxyz", num_of_chains=2, num_of_steps=200, seed=1, num_of_near_counterexamples=3)
+    >>> [result[0] for result in results]
+    [Fraction(2, 3), Fraction(2, 3), Fraction(3, 4)]
+    >>> results == search("vwxyz", num_of_chains=2, num_of_steps=200, seed=1, num_of_near_counterexamples=3, num_of_workers=2)
+    True
+    >>> import tempfile
+    >>> log_file = tempfile.NamedTemporaryFile(suffix=".jsonl")
+    >>> results = search("vwxyz", num_of_chains=2, num_of_steps=200, seed=1, num_of_near_counterexamples=3, log_path=log_file.name)
+    >>> record = json.loads(open(log_file.name).readline())
+    >>> record["fraction"]
+    '2/3'
+    >>> replay_chain(record["goods"], record["seed"], record["num_of_steps"], record["step"]) == (tuple(record["family1"]), tuple(record["family2"]))
+    True
+    """
+    if seed is None:
+        seed = random.randrange(2**32)
+    arguments = [(goods, seed + chain, num_of_steps, max_multiplicity, num_of_near_counterexamples,
+                  initial_temperature, final_temperature)
+                 for chain in range(num_of_chains)]
+    if num_of_workers == 1:
+        results = [run_chain(*argument) for argument in arguments]
+    else:
+        with multiprocessing.Pool(num_of_workers) as pool:
+            results = pool.starmap(run_chain, arguments)
+    near_counterexamples = _smallest([result for chain_results in results for result in chain_results],
+                                     num_of_near_counterexamples)
+    for (fraction, vector1, vector2, chain_seed, step) in near_counterexamples:
+        logger.info("Best fraction {} in chain {} step {}: {} vs {}".format(fraction, chain_seed, step, vector1, vector2))
+        if fraction < FRACTION_THRESHOLD:
+            print("The 2/3 conjecture is false for the following families:")
+            print(vector_family(goods, vector1, name="Family 1"))
+            print(vector_family(goods, vector2, name="Family 2"))
+    if log_path is not None:
+        with open(log_path, "a") as file:
+            for (fraction, vector1, vector2, chain_seed, step) in near_counterexamples:
+                file.write(json.dumps({"goods": goods, "fraction": str(fraction), "seed": chain_seed, "step": step,
+                                       "num_of_steps": num_of_steps, "max_multiplicity": max_multiplicity,
+                                       "initial_temperature": initial_temperature, "final_temperature": final_temperature,
+                                       "family1": vector1, "family2": vector2}) + "\n")
+    return near_counterexamples
+
+
+def run_chain(goods:str, seed:int, num_of_steps:int, max_multiplicity:int=1, num_of_near_counterexamples:int=10,
+              initial_temperature:float=0.05, final_temperature:float=0.001)->list:
+    """
+    Runs a single annealing chain. The chain depends only on its arguments (see replay_chain).
+    :return: a list of tuples (fraction, vector1, vector2, seed, step) of the distinct pairs with the smallest best fractions.
+
+    >>> results = run_chain("wxyz", seed=1, num_of_steps=200, num_of_near_counterexamples=2)
+    >>> [result[0] for result in results]
+    [Fraction(2, 3), Fraction(3, 4)]
+    >>> results == run_chain("wxyz", seed=1, num_of_steps=200, num_of_near_counterexamples=2)
+    True
+    """
+    map_pair_to_result = {}
+    for (step, chain) in _chain_steps(goods, seed, num_of_steps, max_multiplicity, initial_temperature, final_temperature):
+        pair = chain.pair()
+        if pair not in map_pair_to_result and (pair[1], pair[0]) not in map_pair_to_result:
+            map_pair_to_result[pair] = (chain.best_fraction(), pair[0], pair[1], seed, step)
+            if len(map_pair_to_result) > 2 * num_of_near_counterexamples:
+                map_pair_to_result = {(result[1], result[2]): result
+                                      for result in _smallest(map_pair_to_result.values(), num_of_near_counterexamples)}
+    return _smallest(map_pair_to_result.values(), num_of_near_counterexamples)
+
+
+def replay_chain(goods:str, seed:int, num_of_steps:int, step:int, max_multiplicity:int=1,
+                 initial_temperature:float=0.05, final_temperature:float=0.001)->tuple:
+    """
+    Reproduces the pair of families of a chain at the given step.
+    :return: a pair of multiplicity vectors.
+
+    >>> (fraction, vector1, vector2, seed, step) = run_chain("wxyz", seed=1, num_of_steps=100, num_of_near_counterexamples=1)[0]
+    >>> replay_chain("wxyz", seed, 100, step) == (vector1, vector2)
+    True
+    """
+    for (current_step, chain) in _chain_steps(goods, seed, num_of_steps, max_multiplicity, initial_temperature, final_temperature):
+        if current_step == step:
+            return chain.pair()
+    raise ValueError("The chain has only {} steps".format(num_of_steps))
+
+
+def _chain_steps(goods:str, seed:int, num_of_steps:int, max_multiplicity:int,
+                 initial_temperature:float, final_temperature:float):
+    """
+    Generates pairs (step, chain) for the initial state (step 0) and the state after each step.
+    The temperature decreases geometrically from the initial temperature to the final one.
+    """
+    chain = _AnnealingChain(FamilyIndex(goods), max_multiplicity, random.Random(seed))
+    yield (0, chain)
+    for step in range(1, num_of_steps + 1):
+        if initial_temperature > 0 and final_temperature > 0:
+            temperature = initial_temperature * (final_temperature / initial_temperature) ** (step / num_of_steps)
+        else:
+            temperature = 0
+        chain.step(temperature)
+        yield (step, chain)
+
+
+def _smallest(results, num_of_results:int)->list:
+    return sorted(results)[:num_of_results]
+
+
+def vector_family(goods:str, vector:tuple, name:str="Anonymous Family")->Family:
+    """
+    Creates a Family object from a vector of multiplicities of the agent types (pairs of goods, in lexicographic order).
+
+    >>> vector_family("xyz", (2, 0, 1))
+    Anonymous Family seeks one-of-best-2 and has:
+     * 2 binary agents who want ['x', 'y']
+     * 1 binary agent  who want ['y', 'z']
+    """
+    index = FamilyIndex(goods)
+    members = [BinaryAgent(desired_goods, multiplicity)
+               for desired_goods,multiplicity in zip(index.agent_types, vector) if multiplicity > 0]
+    return Family(members, fairness_1_of_best_2, name=name)
+
+
+class _AnnealingChain:
+    """
+    The current pair of families: the multiplicity vector of each family,
+    and the number of happy members of each family with each bundle.
+
+    The energy of the pair is its best fraction, with ties broken by the number of partitions that attain it
+    (a pair with fewer such partitions is closer to a counterexample).
+    The tie-breaker is scaled so that it never outweighs a difference between two best fractions.
+    """
+
+    def __init__(self, index:FamilyIndex, max_multiplicity:int, rand:random.Random):
+        self.index = index
+        self.max_multiplicity = max_multiplicity
+        self.rand = rand
+        num_of_goods = len(index.goods)
+        self.num_of_types = len(index.agent_types)
+        self.num_of_bundles = 1 << num_of_goods
+        # happy_bundles[t] = the bundle masks with which an agent of type t is happy.
+        self.happy_bundles = [[bundle for bundle,happy_types in enumerate(index.happy_types) if happy_types & (1 << t)]
+                              for t in range(self.num_of_types)]
+        max_members = self.num_of_types * max_multiplicity
+        self.tie_scale = 1 / (self.num_of_bundles * (max_members * max_members + 1))
+        self.vectors = []
+        self.counts = []
+        for f in range(2):
+            # A small random family, with about one agent type per good:
+            vector = [rand.randint(1, max_multiplicity) if rand.randrange(self.num_of_types) < len(index.goods) else 0
+                      for t in range(self.num_of_types)]
+            if sum(vector) == 0:
+                vector[rand.randrange(self.num_of_types)] = 1
+            self.vectors.append(vector)
+            counts = [0] * self.num_of_bundles
+            for t,multiplicity in enumerate(vector):
+                self._add(counts, t, multiplicity)
+            self.counts.append(counts)
+        self.energy = self._energy()
+
+    def _add(self, counts:list, agent_type:int, multiplicity:int):
+        for bundle in self.happy_bundles[agent_type]:
+            counts[bundle] += multiplicity
+
+    def _change(self, f:int, agent_type:int, delta:int):
+        self.vectors[f][agent_type] += delta
+        self._add(self.counts[f], agent_type, delta)
+
+    def _energy(self)->float:
+        (size1, size2) = (sum(self.vectors[0]), sum(self.vectors[1]))
+        # The complement of bundle b is the bundle (num_of_bundles - 1 - b), so the second counts are reversed.
+        values = [min(count1 / size1, count2 / size2)
+                  for count1,count2 in zip(self.counts[0], reversed(self.counts[1]))][1:-1]
+        best = max(values)
+        return best + values.count(best) * self.tie_scale
+
+    def step(self, temperature:float):
+        """
+        Adds an agent to one of the families, removes an agent from it, or replaces an agent by an agent of another type.
+        The change is kept if it does not increase the energy, or with the annealing probability.
+        """
+        f = self.rand.randrange(2)
+        vector = self.vectors[f]
+        kind = self.rand.randrange(3)   # 0: add, 1: remove, 2: replace
+        changes = []
+        if kind != 0:
+            removed_type = self.rand.choice([t for t,multiplicity in enumerate(vector) if multiplicity > 0])
+            changes.append((removed_type, -1))
+        if kind != 1:
+            added_type = self.rand.randrange(self.num_of_types)
+            if vector[added_type] - (kind == 2 and added_type == removed_type) < self.max_multiplicity:
+                changes.append((added_type, 1))
+        if sum(vector) + sum([delta for (t, delta) in changes]) == 0:
+            return   # the family must not become empty
+        for (agent_type, delta) in changes:
+            self._change(f, agent_type, delta)
+        new_energy = self._energy()
+        if new_energy <= self.energy or \
+                (temperature > 0 and self.rand.random() < math.exp((self.energy - new_energy) / temperature)):
+            self.energy = new_energy
+        else:
+            for (agent_type, delta) in changes:
+                self._change(f, agent_type, -delta)
+
+    def pair(self)->tuple:
+        return (tuple(self.vectors[0]), tuple(self.vectors[1]))
+
+    def best_fraction(self)->Fraction:
+        (size1, size2) = (sum(self.vectors[0]), sum(self.vectors[1]))
+        return best_fraction(self.counts[0], size1, sorted_bundles(self.counts[0], len(self.index.goods)),
+                             self.counts[1], size2)
+
+
+
+if __name__ == "__main__":
+    import doctest
+    (failures,tests) = doctest.testmod(report=True)
+    print ("{} failures, {} tests".format(failures,tests))
+    logger.setLevel(logging.INFO)     # comment-out this line for a silent run; uncomment for tracing
+    # search("stuvwxyz", num_of_chains=8, num_of_steps=10000, seed=0, num_of_workers=8, log_path="near_counterexamples.jsonl")
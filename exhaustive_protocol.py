@@ -0,0 +1,146 @@
+#!python3
+
+"""
+An exhaustive allocator for small instances, that visits all k^m assignments of m goods to k families.
+
+The assignments are visited in a Gray-code order (see partitions.gray_code_moves),
+so consecutive assignments differ by moving a single good.
+The number of happy members in each family is updated incrementally by an AllocationState:
+moving a good touches only the members who want this good, in the two families involved.
+
+It supports agents with additive valuations (binary or additive),
+and fairness criteria that are based on a target value (e.g. 1-of-best-c, MMS, PROPc).
+"""
+
+from agents import *
+from families import Family
+import fairness_criteria
+from optimal_protocol import compiled_thresholds
+from allocation_state import AllocationState
+from partitions import gray_code_moves
+
+import logging, sys
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler(sys.stdout))
+# To enable tracing, logger.setLevel(logging.INFO)
+
+
+def allocate(families:list, goods:list)->list:
+    """
+    Find an allocation that maximizes the minimum fraction of happy members over all families.
+    :param families: a list of k Family objects.
+    :param goods: a list of goods.
+    :return a list of bundles - a bundle per family.
+
+    >>> fairness_1_of_best_2 = fairness_criteria.OneOfBestC(2)
+    >>> family1 = Family([BinaryAgent({"w","x"},1),BinaryAgent({"x","y"},2),BinaryAgent({"y","z"},3), BinaryAgent({"z","w"},4)], fairness_1_of_best_2)
+    >>> family2 = Family([BinaryAgent({"w","z"},2),BinaryAgent({"z","y"},3)], fairness_1_of_best_2)
+    >>> (bundle1,bundle2) = allocate([family1, family2], ["w","x","y","z"])
+    >>> from families import min_fraction_of_happy_members
+    >>> min_fraction_of_happy_members([family1, family2], [bundle1, bundle2])
+    1.0
+    >>> family3 = Family([BinaryAgent("xy",1), BinaryAgent("yz",1), BinaryAgent("zx",1)], fairness_1_of_best_2)
+    >>> bundles = allocate([family3, family3], "xyz")
+    >>> min_fraction_of_happy_members([family3, family3], bundles)
+    0.6666666666666666
+    """
+    traversal = _GrayCodeTraversal(families, list(goods))
+    best_value, best_bundles = -1, None
+    for _ in traversal.assignments():
+        value = min(traversal.fractions())
+        if value > best_value:
+            best_value, best_bundles = value, traversal.bundles()
+            if best_value >= 1:
+                break
+    logger.info("Best value: {}".format(best_value))
+    return best_bundles
+
+
+def fair_allocation(families:list, goods:list, threshold:float, nonempty_bundles:bool=False)->list:
+    """
+    Find an allocation in which at least a fraction "threshold" of the members of each family are happy.
+    :param families: a list of k Family objects.
+    :param goods: a list of goods.
+    :param threshold: the required fraction of happy members in each family.
+    :param nonempty_bundles: if True, only allocations in which every family gets at least one good are considered.
+    :return a list of bundles - a bundle per family, or None if there is no such allocation.
+
+    >>> fairness_1_of_best_2 = fairness_criteria.OneOfBestC(2)
+    >>> family3 = Family([BinaryAgent("xy",1), BinaryAgent("yz",1), BinaryAgent("zx",1)], fairness_1_of_best_2)
+    >>> fair_allocation([family3, family3], "xyz", 2/3) is None
+    False
+    >>> fair_allocation([family3, family3], "xyz", 1) is None
+    True
+    """
+    traversal = _GrayCodeTraversal(families, list(goods))
+    for _ in traversal.assignments():
+        if nonempty_bundles and 0 in traversal.bundle_sizes:
+            continue
+        if all([fraction >= threshold for fraction in traversal.fractions()]):
+            return traversal.bundles()
+    return None
+
+
+def is_supported(families:list)->bool:
+    """
+    :return: True iff all members have additive valuations (binary or additive),
+             and all fairness criteria are based on a target value.
+
+    >>> family1 = Family([BinaryAgent("xy",1), AdditiveAgent({"x":1, "z":2},1)], fairness_criteria.OneOfBestC(2))
+    >>> family2 = Family([BinaryAgent("xy",1)], fairness_criteria.EnvyFreeExceptC(1))
+    >>> family3 = Family([MonotoneAgent({"x":1, "y":2, "xy":4})], fairness_criteria.OneOfBestC(2))
+    >>> is_supported([family1, family1]), is_supported([family1, family2]), is_supported([family1, family3])
+    (True, False, False)
+    """
+    for family in families:
+        if not all([isinstance(member, (BinaryAgent, AdditiveAgent)) for member in family.members]):
+            return False
+        if None in family.thresholds():
+            return False
+    return True
+
+
+class _GrayCodeTraversal:
+    """
+    The current assignment of goods to families, kept in an AllocationState
+    (with the value of each member to its family's bundle and the (weighted) number of happy members in each family),
+    along with the owner of each good index and the size of each bundle.
+    """
+
+    def __init__(self, families:list, goods:list):
+        for family in families:
+            compiled_thresholds(family)    # raises an error if the family's criterion is not based on a target value
+        self.families = families
+        self.num_of_families = len(families)
+        self.goods = goods
+        self.state = AllocationState(families, goods)      # initially, all goods are in bundle 0
+        self.map_good_index_to_owner = [0] * len(goods)
+        self.bundle_sizes = [len(goods)] + [0] * (self.num_of_families - 1)
+
+    def move(self, good_index:int, from_family:int, to_family:int):
+        self.state.move(self.goods[good_index], to_family)
+        self.map_good_index_to_owner[good_index] = to_family
+        self.bundle_sizes[from_family] -= 1
+        self.bundle_sizes[to_family] += 1
+
+    def assignments(self):
+        """
+        Visits all assignments of the goods to the families, updating the state in-place.
+        Yields the current map from good index to family index (which must not be modified).
+        """
+        yield self.map_good_index_to_owner
+        for (good_index, from_family, to_family) in gray_code_moves(len(self.goods), self.num_of_families):
+            self.move(good_index, from_family, to_family)
+            yield self.map_good_index_to_owner
+
+    def fractions(self)->list:
+        return self.state.fractions()
+
+    def bundles(self)->list:
+        return self.state.bundles_copy()
+
+
+if __name__ == "__main__":
+    import doctest
+    (failures,tests) = doctest.testmod(report=True)
+    print ("{} failures, {} tests".format(failures,tests))
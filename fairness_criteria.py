@@ -5,8 +5,9 @@ Defines various useful fairness criteria to use with fair allocation algorithms.
 """
 
 from abc import ABC, abstractmethod        # Abstract Base Class
-from agents import Agent, BinaryAgent
-import math
+from agents import Agent, BinaryAgent, AdditiveAgent
+from fractions import Fraction
+import math, mms_cache
 
 
 class FairnessCriterion(ABC):
@@ -50,6 +51,48 @@ class FairnessCriterion(ABC):
         """
         return agent.value(own_bundle) >= self.target_value_for_agent(agent)
 
+    def threshold_for_agent(self, agent:Agent)->int:
+        """
+        The smallest value that satisfies the agent's target value.
+        A member with threshold t is happy with a bundle iff the bundle's value is at least t.
+        :param agent:   an Agent object.
+        :return: an int if the agent's values are integers (the target value rounded up);
+                 the exact target value (a Fraction) if they are not;
+                 or None if the criterion is not based on a target value (e.g. envy-freeness).
+
+        >>> agent = AdditiveAgent({"x": 0.5, "y": 0.7, "z": 0.2})
+        >>> MaximinShareOneOfC(2).threshold_for_agent(agent) == 0.7
+        True
+        >>> MaximinShareOneOfC(2).threshold_for_agent(AdditiveAgent({"x": 5, "y": 7, "z": 2}))
+        7
+        """
+        if self._has_own_fairness_check():
+            return None
+        target = Fraction(self.target_value_for_agent(agent))
+        return math.ceil(target) if agent.has_integer_values() else target
+
+    def _has_own_fairness_check(self)->bool:
+        """
+        :return: True iff the criterion overrides is_fair_for, so it cannot be reduced to a threshold.
+        """
+        return type(self).is_fair_for is not FairnessCriterion.is_fair_for
+
+    def compile(self, members:list)->list:
+        """
+        Calculates the threshold of each of the given members once,
+        so that later fairness checks are single integer comparisons.
+
+        >>> MaximinShareOneOfC(2).compile([BinaryAgent("xyz"), BinaryAgent("wxyz")])
+        [1, 2]
+        >>> ProportionalExceptC(num_of_agents=3, c=1).compile([BinaryAgent("xyz"), BinaryAgent("wxyz")])
+        [1, 1]
+        >>> EnvyFreeExceptC(1).compile([BinaryAgent("xyz")])
+        [None]
+        """
+        if self._has_own_fairness_check():
+            return [None] * len(members)
+        return [self.threshold_for_agent(member) for member in members]
+
 
 class OneOfBestC(FairnessCriterion):
     """
@@ -92,7 +135,14 @@ class MaximinShareOneOfC(FairnessCriterion):
         self.approximation_factor = approximation_factor
 
     def target_value_for_agent(self, agent: Agent)->int:
-        return agent.value_1_of_c_MMS(c=self.c, approximation_factor=self.approximation_factor)
+        cache = mms_cache.default_cache()
+        if cache is None or isinstance(agent, BinaryAgent):   # the MMS of a binary agent is computed in O(1)
+            return agent.value_1_of_c_MMS(c=self.c, approximation_factor=self.approximation_factor)
+        value = cache.get(agent, self.c, self.approximation_factor)
+        if value is None:
+            value = agent.value_1_of_c_MMS(c=self.c, approximation_factor=self.approximation_factor)
+            cache.put(agent, value, self.c, self.approximation_factor)
+        return value
 
     def target_value_for_binary(self, total_value: int)->int:
         return math.floor(total_value/self.c)*self.approximation_factor
@@ -114,6 +164,9 @@ class EnvyFreeExceptC(FairnessCriterion):
     def target_value_for_binary(self, total_value: int)->int:
         raise ValueError("target value is not relevant for envy-freeness concepts")
 
+    def threshold_for_agent(self, agent: Agent)->int:
+        return None
+
     def is_fair_for(self, agent:Agent, own_bundle: set, all_bundles: list)->bool:
         return agent.is_EFc(own_bundle, all_bundles, self.c)
 
@@ -137,6 +190,13 @@ class ProportionalExceptC(FairnessCriterion):
     def target_value_for_agent(self, agent: Agent)->int:
         return agent.value_proportional_except_c(num_of_agents=self.num_of_agents, c=self.c)
 
+    def threshold_for_agent(self, agent: Agent)->int:
+        if not agent.has_integer_values():
+            return super().threshold_for_agent(agent)
+        # value >= remaining_value/n  iff  value*n >= remaining_value  iff  value >= ceil(remaining_value/n)
+        remaining_value = agent.value_except_best_c_goods(agent.desired_goods, self.c)
+        return -(-remaining_value // self.num_of_agents)
+
     def target_value_for_binary(self, total_value: int)->int:
         return max(0, math.ceil((total_value - self.c)/self.num_of_agents))
 
@@ -8,6 +8,8 @@ Classes that represent families (groups) of agents.
 from agents import *
 import fairness_criteria
 from fairness_criteria import FairnessCriterion
+from collections.abc import Sequence
+from array import array
 
 
 class Family:
@@ -30,10 +32,57 @@ class Family:
         :param fairness_criterion: the criterion by which each family member considers an allocation "fair".
         :param name: the family name, for display purposes.
         """
-        self.members = list(members)
+        self.members = members
         self.fairness_criterion = fairness_criterion
         self.name = name
-        self.num_of_members = sum([member.cardinality for member in self.members])
+
+    @property
+    def members(self)->list:
+        return self._members
+
+    @members.setter
+    def members(self, members:list):
+        """
+        Replacing the members invalidates the compiled thresholds.
+        NOTE: the list of members should be replaced, not changed in-place.
+        """
+        self._members = list(members)
+        self.num_of_members = sum([member.cardinality for member in self._members])
+        self._thresholds = None
+
+    @property
+    def fairness_criterion(self)->FairnessCriterion:
+        return self._fairness_criterion
+
+    @fairness_criterion.setter
+    def fairness_criterion(self, fairness_criterion:FairnessCriterion):
+        """
+        Replacing the fairness criterion invalidates the compiled thresholds.
+        """
+        self._fairness_criterion = fairness_criterion
+        self._thresholds = None
+
+    def thresholds(self)->list:
+        """
+        Returns the compiled threshold of each member - the smallest value that makes it happy
+        (None for criteria that are not based on a target value).
+        The thresholds are calculated once, and cached until the members or the criterion change.
+
+        >>> family1 = Family([BinaryAgent("xy",1), BinaryAgent("xyzw",2)], fairness_criteria.OneOfBestC(2), name="Family 1")
+        >>> family1.thresholds()
+        [1, 1]
+        >>> family1.fairness_criterion = fairness_criteria.MaximinShareOneOfC(2)
+        >>> family1.thresholds()
+        [1, 2]
+        >>> family1.members = family1.members + [BinaryAgent("xyzwv",1)]
+        >>> family1.thresholds()
+        [1, 2, 2]
+        >>> family1.num_of_members
+        4
+        """
+        if self._thresholds is None:
+            self._thresholds = self.fairness_criterion.compile(self.members)
+        return self._thresholds
 
     def num_of_members_with(self, predicate)->int:
         """
@@ -52,9 +101,20 @@ class Family:
         2
         >>> family1.num_of_happy_members(set("y"),[set("xz")])
         3
+        >>> family2 = Family([AdditiveAgent({"x":0.5, "y":0.7, "z":0.2})], fairness_criteria.MaximinShareOneOfC(2), name="Family 2")
+        >>> family2.num_of_happy_members(set("y"),[set("xz")])
+        1
         """
-        return self.num_of_members_with(lambda member:
-            self.fairness_criterion.is_fair_for(member, set(bundle), all_bundles))
+        bundle = set(bundle)
+        num_of_happy_members = 0
+        for member, threshold in zip(self.members, self.thresholds()):
+            if threshold is None:
+                is_happy = self.fairness_criterion.is_fair_for(member, bundle, all_bundles)
+            else:
+                is_happy = member.value(bundle) >= threshold
+            if is_happy:
+                num_of_happy_members += member.cardinality
+        return num_of_happy_members
 
     def fraction_of_happy_members(self, bundle:set, all_bundles:list):
         """
@@ -85,6 +145,182 @@ class Family:
         return "{} seeks {} and has:\n".format(self.name, self.fairness_criterion.name)+"\n".join([" * "+member.__repr__() for member in self.members])
 
 
+class ColumnarFamily(Family):
+    """
+    A memory-compact family of binary agents, for families with very many members.
+    The members are stored in columns: the desired goods of each member as a bit-mask over the family's goods,
+    and the cardinalities and thresholds in typed arrays.
+    Agent objects are created only when the members are accessed through family.members.
+
+    NOTE: for binary agents, the thresholds of all supported criteria depend only on the number of desired goods,
+    so the threshold is calculated once for each such number.
+
+    >>> family1 = ColumnarFamily.from_desired_goods("wxyz", ["xy","yz","wz"], [1,2,3], fairness_criteria.OneOfBestC(2), name="Family 1")
+    >>> family1
+    Family 1 seeks one-of-best-2 and has:
+     * 1 binary agent  who want ['x', 'y']
+     * 2 binary agents who want ['y', 'z']
+     * 3 binary agents who want ['w', 'z']
+    >>> family1.num_of_members
+    6
+    >>> family1.members[1]
+    2 binary agents who want ['y', 'z']
+    >>> family1.num_of_happy_members(set("xw"),[set("yz")])
+    4
+    >>> family1.num_of_happy_members(set("z"),[set("xyw")])
+    5
+    >>> family1.num_of_members_with(lambda member: "w" in member.desired_goods)
+    3
+    >>> family2 = ColumnarFamily([BinaryAgent("xy",1), BinaryAgent("yz",2)], fairness_criteria.EnvyFreeExceptC(1), name="Family 2")
+    >>> family2.num_of_happy_members(set("x"),[set("yz")])
+    1
+
+    Replacing the members extends the goods with new desired goods:
+    >>> family2.members = list(family2.members) + [BinaryAgent("vw",1)]
+    >>> family2.goods
+    ['x', 'y', 'z', 'v', 'w']
+    >>> family2.members[2]
+    1 binary agent  who want ['v', 'w']
+    >>> family2.goods_in_mask(family2.masks[2])
+    ['v', 'w']
+    """
+
+    def __init__(self, members:list, fairness_criterion:FairnessCriterion, name:str="Anonymous Family", goods:list=None):
+        """
+        Initialize a columnar family with the given list of binary agents.
+        :param goods: the goods that the members may desire; by default, the union of their desired goods.
+        """
+        members = list(members)
+        if goods is None:
+            goods = sorted(set().union(*[member.desired_goods for member in members]))
+        self.goods = list(goods)
+        super().__init__(members, fairness_criterion, name)
+
+    @classmethod
+    def from_desired_goods(cls, goods:list, desired_goods:list, cardinalities:list,
+                           fairness_criterion:FairnessCriterion, name:str="Anonymous Family")->'ColumnarFamily':
+        """
+        Initialize a columnar family directly from columns, without creating agent objects.
+        :param goods: all the goods that the members may desire.
+        :param desired_goods: an iterable with the set of desired goods of each member.
+        :param cardinalities: an iterable with the cardinality of each member.
+        """
+        family = cls.__new__(cls)
+        family.goods = list(goods)
+        family.name = name
+        family.fairness_criterion = fairness_criterion
+        family._set_columns(desired_goods, cardinalities)
+        return family
+
+    def _set_columns(self, desired_goods, cardinalities):
+        self.map_good_to_bit = {good: 1 << index for index,good in enumerate(self.goods)}
+        self.masks = array("Q") if len(self.goods) <= 64 else []   # longer masks are stored as Python ints
+        for member_desired_goods in desired_goods:
+            mask = self.bundle_mask(member_desired_goods)
+            if mask.bit_count() != len(member_desired_goods):
+                raise ValueError("Some of the desired goods {} are not in the family's goods".format(sorted(member_desired_goods)))
+            self.masks.append(mask)
+        self.cardinalities = array("q", cardinalities)
+        self.num_of_members = sum(self.cardinalities)
+        self._thresholds = None
+
+    @property
+    def members(self)->list:
+        return _ColumnarMembers(self)
+
+    @members.setter
+    def members(self, members:list):
+        members = list(members)
+        if not all([isinstance(member, BinaryAgent) for member in members]):
+            raise ValueError("A columnar family can contain only binary agents")
+        new_goods = set().union(*[member.desired_goods for member in members]).difference(self.goods)
+        self.goods = self.goods + sorted(new_goods)
+        self._set_columns([member.desired_goods for member in members], [member.cardinality for member in members])
+
+    def bundle_mask(self, bundle:set)->int:
+        """
+        The bit-mask of the given bundle. Goods that are not in the family's goods are ignored.
+        """
+        map_good_to_bit = self.map_good_to_bit
+        mask = 0
+        for good in bundle:
+            mask |= map_good_to_bit.get(good, 0)
+        return mask
+
+    def goods_in_mask(self, mask:int)->list:
+        """
+        The goods whose bits are set in the given mask, in the order of the family's goods.
+        """
+        goods = []
+        while mask:
+            lowest_bit = mask & -mask
+            goods.append(self.goods[lowest_bit.bit_length() - 1])
+            mask ^= lowest_bit
+        return goods
+
+    def member(self, index:int)->BinaryAgent:
+        """
+        Creates an agent object for the member in the given index.
+        """
+        mask = self.masks[index]
+        return BinaryAgent([good for good in self.goods if mask & self.map_good_to_bit[good]], self.cardinalities[index])
+
+    def thresholds(self)->list:
+        if self._thresholds is None:
+            map_total_value_to_threshold = {}
+            thresholds = []
+            for index,mask in enumerate(self.masks):
+                total_value = mask.bit_count()
+                if total_value not in map_total_value_to_threshold:
+                    map_total_value_to_threshold[total_value] = self.fairness_criterion.threshold_for_agent(self.member(index))
+                thresholds.append(map_total_value_to_threshold[total_value])
+            self._thresholds = thresholds if None in thresholds else array("q", thresholds)
+        return self._thresholds
+
+    def num_of_happy_members(self, bundle:set, all_bundles:list):
+        thresholds = self.thresholds()
+        if len(thresholds) > 0 and thresholds[0] is None:   # the criterion is not based on a target value
+            return super().num_of_happy_members(bundle, all_bundles)
+        bundle_mask = self.bundle_mask(bundle)
+        return sum([cardinality for mask,threshold,cardinality in zip(self.masks, thresholds, self.cardinalities)
+                    if (mask & bundle_mask).bit_count() >= threshold])
+
+
+class _ColumnarMembers(Sequence):
+    """
+    A read-only view of the members of a columnar family, that creates agent objects on demand.
+    """
+
+    def __init__(self, family:ColumnarFamily):
+        self.family = family
+
+    def __len__(self):
+        return len(self.family.masks)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.family.member(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        return self.family.member(index)
+
+
+def min_fraction_of_happy_members(families:list, bundles:list)->float:
+    """
+    Calculates the smallest fraction of happy members over all families,
+    when families[i] gets bundles[i].
+    This is the "democratic fairness" level of the allocation.
+
+    >>> family1 = Family([BinaryAgent("xy",1), BinaryAgent("yz",2)], fairness_criteria.OneOfBestC(2), name="Family 1")
+    >>> family2 = Family([BinaryAgent("xz",1), BinaryAgent("wz",1)], fairness_criteria.OneOfBestC(2), name="Family 2")
+    >>> min_fraction_of_happy_members([family1, family2], [set("y"), set("wxz")])
+    1.0
+    >>> min_fraction_of_happy_members([family1, family2], [set("x"), set("wyz")])
+    0.3333333333333333
+    """
+    return min([families[i].fraction_of_happy_members(bundles[i], bundles) for i in range(len(families))])
+
+
 
 if __name__ == "__main__":
     import doctest
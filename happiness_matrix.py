@@ -0,0 +1,168 @@
+#!python3
+
+"""
+A families x bundles happiness matrix of a given partition,
+and an assignment of bundles to families by bipartite matching.
+
+The value of each member to each bundle is calculated once,
+and then shared by all k! possible assignments of the bundles to the families.
+"""
+
+from agents import *
+from families import Family
+import fairness_criteria
+
+import logging, sys
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler(sys.stdout))
+# To enable tracing, logger.setLevel(logging.INFO)
+
+
+def has_additive_members(families:list)->bool:
+    """
+    :return: True iff all members of the given families have additive valuations (binary or additive).
+    """
+    return all([isinstance(member, (BinaryAgent, AdditiveAgent)) for family in families for member in family.members])
+
+
+class HappinessMatrix:
+    """
+    For each family f and bundle b in the partition:
+    * num_of_happy[f][b] - the (weighted) number of members of family f who are happy if family f gets bundle b;
+    * votes[f][b] - the (weighted) number of members of family f whose best bundle is b (ties go to the first index).
+
+    >>> fairness_1_of_best_2 = fairness_criteria.OneOfBestC(2)
+    >>> family1 = Family([BinaryAgent("wx",1), BinaryAgent("wxy",1), BinaryAgent("yz",1)], fairness_1_of_best_2, name="Family 1")
+    >>> family2 = Family([BinaryAgent("wx",1), BinaryAgent("xyz",1), BinaryAgent("yz",2)], fairness_1_of_best_2, name="Family 2")
+    >>> matrix = HappinessMatrix([family1, family2], [set("wx"), set("yz")])
+    >>> matrix.num_of_happy
+    [[2, 2], [2, 3]]
+    >>> matrix.fractions()
+    [[0.6666666666666666, 0.6666666666666666], [0.5, 0.75]]
+    >>> matrix.votes
+    [[2, 1], [1, 3]]
+    >>> matrix.is_fair(2/3)
+    [[True, True], [False, True]]
+    >>> matrix.assignment(2/3)
+    [0, 1]
+    >>> matrix.assignment(3/4) is None
+    True
+    >>> [sorted(bundle) for bundle in matrix.allocation(2/3)]
+    [['w', 'x'], ['y', 'z']]
+    >>> HappinessMatrix([Family([MonotoneAgent({"x":1, "y":2, "xy":3})], fairness_1_of_best_2)], [set("x"), set("y")])
+    Traceback (most recent call last):
+    ...
+    ValueError: HappinessMatrix supports only agents with additive valuations (binary or additive)
+    """
+
+    def __init__(self, families:list, partition:list):
+        """
+        :param families: a list of k Family objects, whose members have additive valuations (binary or additive).
+        :param partition: a list of bundles (sets of goods).
+        """
+        if not has_additive_members(families):
+            raise ValueError("HappinessMatrix supports only agents with additive valuations (binary or additive)")
+        self.families = families
+        self.partition = partition
+        self.votes = []
+        self._values = []    # _values[f] = a list of (member, threshold, values) - the member's value to each bundle
+        num_of_bundles = len(partition)
+        for family in families:
+            votes = [0] * num_of_bundles
+            family_values = []
+            for member, threshold in zip(family.members, family.thresholds()):
+                values = [member.value(bundle) for bundle in partition]
+                family_values.append((member, threshold, values))
+                votes[max(range(num_of_bundles), key=lambda b: values[b])] += member.cardinality
+            self._values.append(family_values)
+            self.votes.append(votes)
+        self._num_of_happy = None
+
+    @property
+    def num_of_happy(self)->list:
+        """
+        The happy counts are calculated on first use, since plurality voting needs only the votes.
+        """
+        if self._num_of_happy is None:
+            self._num_of_happy = []
+            for family, family_values in zip(self.families, self._values):
+                num_of_happy = [0] * len(self.partition)
+                for member, threshold, values in family_values:
+                    for b in range(len(self.partition)):
+                        if threshold is None:
+                            is_happy = family.fairness_criterion.is_fair_for(member, self.partition[b], self.partition)
+                        else:
+                            is_happy = values[b] >= threshold
+                        if is_happy:
+                            num_of_happy[b] += member.cardinality
+                self._num_of_happy.append(num_of_happy)
+        return self._num_of_happy
+
+    def fractions(self)->list:
+        """
+        :return: a matrix with the fraction of happy members of each family with each bundle.
+        """
+        return [[num_of_happy / family.num_of_members for num_of_happy in row]
+                for family, row in zip(self.families, self.num_of_happy)]
+
+    def is_fair(self, threshold:float)->list:
+        """
+        :return: a boolean matrix: is_fair[f][b] is True iff at least a fraction "threshold"
+                 of the members of family f are happy with bundle b.
+        """
+        return [[fraction >= threshold for fraction in row] for row in self.fractions()]
+
+    def assignment(self, threshold:float)->list:
+        """
+        Finds an assignment of different bundles to the families, such that
+        at least a fraction "threshold" of the members of each family are happy.
+        Uses augmenting paths in the bipartite graph of families and bundles,
+        instead of checking all k! permutations.
+        :return: a list with the bundle index of each family, or None if there is no such assignment.
+        """
+        is_fair = self.is_fair(threshold)
+        map_bundle_to_family = [None] * len(self.partition)
+
+        def augment(f:int, visited:set)->bool:
+            for b in range(len(self.partition)):
+                if is_fair[f][b] and b not in visited:
+                    visited.add(b)
+                    if map_bundle_to_family[b] is None or augment(map_bundle_to_family[b], visited):
+                        map_bundle_to_family[b] = f
+                        return True
+            return False
+
+        for f in range(len(self.families)):
+            if not augment(f, set()):
+                logger.info("{} cannot get a bundle with {} happy members".format(self.families[f].name, threshold))
+                return None
+        map_family_to_bundle = [None] * len(self.families)
+        for b,f in enumerate(map_bundle_to_family):
+            if f is not None:
+                map_family_to_bundle[f] = b
+        return map_family_to_bundle
+
+    def allocation(self, threshold:float)->list:
+        """
+        :return: a permutation of the partition in which families[i] gets a bundle that
+                 at least a fraction "threshold" of its members are happy with, or None if there is none.
+        """
+        assignment = self.assignment(threshold)
+        if assignment is None:
+            return None
+        return [self.partition[b] for b in assignment]
+
+    def best_index_by_plurality(self, family_index:int)->int:
+        """
+        :return: the index of the bundle that is best for a plurality of the members of the given family
+                 (the first one in case of a tie).
+        """
+        votes = self.votes[family_index]
+        return max(range(len(votes)), key=lambda b: votes[b])
+
+
+
+if __name__ == "__main__":
+    import doctest
+    (failures,tests) = doctest.testmod(report=True)
+    print ("{} failures, {} tests".format(failures,tests))
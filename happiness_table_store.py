@@ -0,0 +1,139 @@
+#!python3
+
+"""
+A persistent store of happiness tables, in a memory-mapped file.
+
+Each row of the table belongs to a single family, and contains the number of happy members
+of this family with each possible bundle (one byte per bundle).
+The rows are written once, and then shared by all runs, shards and worker processes:
+readers attach to the file read-only, and access the rows without copying them.
+Since the table contains the raw happy counts, it can be reused with any fraction threshold.
+
+The table is built incrementally: the number of completed rows is kept in the file header,
+so an interrupted build resumes from the first missing row.
+"""
+
+import mmap, os, re, struct, time
+
+import logging, sys
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler(sys.stdout))
+# To enable tracing, logger.setLevel(logging.INFO)
+
+
+MAGIC = b"HAPPYTBL"
+HEADER = struct.Struct("<8sQQQ")   # magic, num_of_rows, row_size, num_of_completed_rows
+
+
+class HappinessTableStore:
+    """
+    A table of num_of_rows rows of row_size bytes, in a memory-mapped file.
+
+    >>> import tempfile
+    >>> directory = tempfile.TemporaryDirectory()
+    >>> store = HappinessTableStore(directory.name, "3goods-one-of-best-2", num_of_rows=3, row_size=4)
+    >>> store.num_of_completed_rows
+    0
+    >>> store.build(lambda row_index: bytes([row_index]*4), max_rows=2)
+    False
+    >>> store.build(lambda row_index: bytes([row_index]*4))
+    True
+    >>> store.close()
+    >>> reader = HappinessTableStore(directory.name, "3goods-one-of-best-2", num_of_rows=3, row_size=4, read_only=True)
+    >>> reader.is_complete()
+    True
+    >>> list(reader.row(2))
+    [2, 2, 2, 2]
+    >>> reader.row(1)[3]
+    1
+    >>> reader.close()
+    >>> directory.cleanup()
+    """
+
+    def __init__(self, directory:str, key:str, num_of_rows:int, row_size:int, read_only:bool=False):
+        """
+        :param directory: the directory of the store files.
+        :param key: identifies the table, e.g. by the number of goods and the fairness criterion.
+        :param num_of_rows: the number of rows (e.g. families).
+        :param row_size: the number of bytes in each row (e.g. bundles).
+        :param read_only: if True, the file must already exist, and it is mapped read-only.
+        """
+        self.path = os.path.join(directory, re.sub(r"[^\w.-]", "_", key) + ".table")
+        self.num_of_rows = num_of_rows
+        self.row_size = row_size
+        self.read_only = read_only
+        size = HEADER.size + num_of_rows * row_size
+        if read_only:
+            self._file = open(self.path, "rb")
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            if not os.path.exists(self.path):
+                with open(self.path, "wb") as file:
+                    file.write(HEADER.pack(MAGIC, num_of_rows, row_size, 0))
+                    file.truncate(size)
+            self._file = open(self.path, "r+b")
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_WRITE)
+        (magic, stored_num_of_rows, stored_row_size, completed) = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or stored_num_of_rows != num_of_rows or stored_row_size != row_size or len(self._map) != size:
+            self.close()
+            raise ValueError("{} does not contain a table of {} rows of {} bytes".format(self.path, num_of_rows, row_size))
+        self._view = memoryview(self._map)
+
+    @property
+    def num_of_completed_rows(self)->int:
+        return HEADER.unpack_from(self._map, 0)[3]
+
+    def is_complete(self)->bool:
+        return self.num_of_completed_rows == self.num_of_rows
+
+    def build(self, compute_row, max_rows:int=None, time_limit:float=None, flush_every:int=1024)->bool:
+        """
+        Computes and writes the missing rows, starting from the first one that was not completed.
+        :param compute_row: a function that takes a row index and returns the row (a bytes-like object of row_size bytes).
+        :param max_rows: an optional maximum number of rows to compute in this call.
+        :param time_limit: an optional time limit in seconds.
+        :param flush_every: the number of rows between updates of the completed-rows counter.
+        :return: True iff the table is complete.
+        """
+        if self.read_only:
+            raise ValueError("Cannot build a read-only store")
+        deadline = None if time_limit is None else time.monotonic() + time_limit
+        first = self.num_of_completed_rows
+        last = self.num_of_rows if max_rows is None else min(self.num_of_rows, first + max_rows)
+        for row_index in range(first, last):
+            offset = HEADER.size + row_index * self.row_size
+            self._map[offset : offset + self.row_size] = compute_row(row_index)
+            if (row_index + 1 - first) % flush_every == 0 or row_index + 1 == last:
+                self._set_num_of_completed_rows(row_index + 1)
+                if deadline is not None and time.monotonic() > deadline:
+                    break
+        logger.info("{}: {}/{} rows completed".format(self.path, self.num_of_completed_rows, self.num_of_rows))
+        return self.is_complete()
+
+    def _set_num_of_completed_rows(self, num_of_completed_rows:int):
+        # The rows are flushed before the counter, so that the counter never covers rows that were not written.
+        self._map.flush()
+        HEADER.pack_into(self._map, 0, MAGIC, self.num_of_rows, self.row_size, num_of_completed_rows)
+        self._map.flush()
+
+    def row(self, row_index:int)->memoryview:
+        """
+        :return: a read-only view of the given row, without copying it.
+        """
+        if row_index >= self.num_of_completed_rows:
+            raise ValueError("Row {} has not been built yet".format(row_index))
+        offset = HEADER.size + row_index * self.row_size
+        return self._view[offset : offset + self.row_size].toreadonly()
+
+    def close(self):
+        if hasattr(self, "_view"):
+            self._view.release()
+        self._map.close()
+        self._file.close()
+
+
+
+if __name__ == "__main__":
+    import doctest
+    (failures,tests) = doctest.testmod(report=True)
+    print ("{} failures, {} tests".format(failures,tests))
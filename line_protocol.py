@@ -9,8 +9,9 @@ See: https://arxiv.org/abs/1709.02564 Theorems 4.2 and 5.8.
 """
 
 from agents import *
-from families import Family
+from families import Family, min_fraction_of_happy_members
 import fairness_criteria
+import multiprocessing, random, time
 
 
 import logging, sys
@@ -19,10 +20,12 @@ logger.addHandler(logging.StreamHandler(sys.stdout))
 # To enable tracing, logger.setLevel(logging.INFO)
 
 
-def allocate(families:list, goods:list)->list:
+def allocate(families:list, goods:list, cache:dict=None)->list:
     """
     Order the goods on a line and allocate them in 1/k-democratic fair way among k families,
     based on the fairness-criterion of each family.
+    :param cache: an optional dict, in which the numbers of happy members are memoized.
+       When the protocol runs on several orders of the same goods, orders with common prefixes share these numbers.
     :return a list of bundles - a bundle per family.
 
     NOTE: The algorithm is guaranteed to finish with an allocation in the following cases:
@@ -49,36 +52,217 @@ def allocate(families:list, goods:list)->list:
     >>> sorted(bundle2)
     ['w', 'x']
     """
-    k = len(families)
+    session = LineSession(families, goods, cache)
+    for event in session.steps():
+        pass
+    return session.bundles
 
-    if k==1:
-        family = families[0]
-        logger.info("   {} gets the remaining bundle".format(family.name))
-        return [set(goods)]
 
-    goods=list(goods)  # order the goods on a line
-    left_sequence = list()
-    right_sequence = list(goods)
-    for good in goods:
+class LineSession:
+    """
+    A run of the line protocol that advances one step at a time - a step either moves the cut one good to the right,
+    or gives the bundle left of the cut to the first family that accepts it.
+    It can be interleaved with other sessions, paused and resumed from a compact snapshot.
+
+    >>> fairness_PROP1 = fairness_criteria.ProportionalExceptC(num_of_agents=2,c=1)
+    >>> family1 = Family([BinaryAgent({"w","x"},1),BinaryAgent({"x","y"},2),BinaryAgent({"y","z"},3), BinaryAgent({"z","w"},4)], fairness_criterion=fairness_PROP1, name="Family 1")
+    >>> family2 = Family([BinaryAgent({"w","z"},2),BinaryAgent({"z","y"},3)], fairness_criterion=fairness_PROP1, name="Family 2")
+    >>> session = LineSession([family1, family2], ["w","x","y","z"])
+    >>> session.step()
+    ('cut', 1)
+    >>> snapshot = session.snapshot()
+    >>> snapshot
+    {'bundles': [None, None], 'remaining_family_indices': [0, 1], 'line': ['w', 'x', 'y', 'z'], 'cut': 1}
+    >>> resumed = LineSession.from_snapshot([family1, family2], snapshot)
+    >>> list(resumed.steps())
+    [('give', 0, ['w']), ('give', 1, ['x', 'y', 'z'])]
+    >>> [sorted(bundle) for bundle in resumed.bundles]
+    [['w'], ['x', 'y', 'z']]
+    """
+
+    def __init__(self, families:list, goods:list, cache:dict=None):
+        """
+        :param cache: an optional dict, in which the numbers of happy members are memoized (see allocate).
+        """
+        self.families = families
+        self.cache = cache
+        self.bundles = [None] * len(families)
+        self.remaining_family_indices = list(range(len(families)))
+        self.line = list(goods)   # the goods that are not allocated yet, in their order on the line
+        self.cut = 0              # the number of goods left of the cut
+
+    def is_finished(self)->bool:
+        return len(self.remaining_family_indices) == 0
+
+    def step(self)->tuple:
+        """
+        :return: ("give", family_index, left_goods) if a family got the bundle left of the cut,
+                 or ("cut", new_cut) if no family accepted it and the cut moved right.
+        """
+        families = self.families
+        k = len(self.remaining_family_indices)
+        if k==1:
+            family_index = self.remaining_family_indices.pop()
+            logger.info("   {} gets the remaining bundle".format(families[family_index].name))
+            self.bundles[family_index] = set(self.line)
+            return ("give", family_index, list(self.line))
+        if self.cut >= len(self.line):
+            raise AssertionError(
+                "No family is willing to accept the set of all goods - the fairness criteria are probably too strong")
+        left_sequence = self.line[:self.cut]
+        right_sequence = self.line[self.cut:]
         logger.info("\nCurrent partition:  {} | {}:".format(left_sequence,right_sequence))
         left_bundle = set(left_sequence)
         right_bundle = set(right_sequence)
-        for family_index in range(len(families)):
+        if self.cache is not None:
+            left_key, right_key = frozenset(left_bundle), frozenset(right_bundle)
+        for family_index in self.remaining_family_indices:
             family = families[family_index]
-            num_of_happy_members = family.num_of_happy_members(left_bundle, [right_bundle])
+            if self.cache is None:
+                num_of_happy_members = family.num_of_happy_members(left_bundle, [right_bundle])
+            else:
+                key = (id(family), left_key, right_key)
+                if key not in self.cache:
+                    self.cache[key] = family.num_of_happy_members(left_bundle, [right_bundle])
+                num_of_happy_members = self.cache[key]
             logger.info("   {}: {}/{} members think the left bundle is {}".format(
                 family.name, num_of_happy_members, family.num_of_members, family.fairness_criterion.abbreviation))
             if num_of_happy_members*k >= family.num_of_members:
                 logger.info("   {} gets the left bundle".format(family.name))
-                other_families = list(families)
-                del other_families[family_index]
-                bundles = allocate(other_families, right_sequence)
-                bundles.insert (family_index, left_bundle)
-                return bundles
-        left_sequence.append(good)
-        right_sequence.pop(0)
-    raise AssertionError(
-        "No family is willing to accept the set of all goods - the fairness criteria are probably too strong")
+                self.bundles[family_index] = left_bundle
+                self.remaining_family_indices.remove(family_index)
+                self.line = right_sequence
+                self.cut = 0
+                return ("give", family_index, left_sequence)
+        self.cut += 1
+        return ("cut", self.cut)
+
+    def steps(self):
+        """
+        Generates the result of each step (see step), until every family has a bundle.
+        """
+        while not self.is_finished():
+            yield self.step()
+
+    def snapshot(self)->dict:
+        """
+        :return: the state of the session, as a JSON-serializable dict (the families and the cache are not included).
+        """
+        return {"bundles": [None if bundle is None else sorted(bundle) for bundle in self.bundles],
+                "remaining_family_indices": list(self.remaining_family_indices), "line": list(self.line), "cut": self.cut}
+
+    @classmethod
+    def from_snapshot(cls, families:list, snapshot:dict, cache:dict=None)->'LineSession':
+        """
+        Resumes a session of the given families from a snapshot.
+        """
+        session = cls(families, snapshot["line"], cache)
+        session.bundles = [None if bundle is None else set(bundle) for bundle in snapshot["bundles"]]
+        session.remaining_family_indices = list(snapshot["remaining_family_indices"])
+        session.cut = snapshot["cut"]
+        return session
+
+
+def candidate_orders(families:list, goods:list, num_of_random_orders:int=100, seed:int=None):
+    """
+    Generates candidate orders of the goods for the line protocol:
+    the given order, orders sorted by approval count, a heuristic order, and random orders.
+    The approval count of a good is the sum, over all families, of the fraction of members who want it.
+    In the heuristic order, the goods wanted mostly by the same family are adjacent,
+    so that each family can find an acceptable bundle near the start of the line.
+
+    >>> family1 = Family([BinaryAgent("xy",1)], fairness_criteria.OneOfBestC(1))
+    >>> family2 = Family([BinaryAgent("yz",1), BinaryAgent("wz",1)], fairness_criteria.OneOfBestC(1))
+    >>> list(candidate_orders([family1,family2], "wxyz", num_of_random_orders=1, seed=1))
+    [['w', 'x', 'y', 'z'], ['y', 'x', 'z', 'w'], ['w', 'z', 'x', 'y'], ['x', 'y', 'z', 'w'], ['z', 'w', 'y', 'x']]
+    """
+    goods = list(goods)
+    def approval_fractions(good):
+        return [family.num_of_members_with(lambda member: good in member.desired_goods) / family.num_of_members
+                for family in families]
+    map_good_to_fractions = {good: approval_fractions(good) for good in goods}
+    yield goods
+    by_approval = sorted(goods, key=lambda good: (-sum(map_good_to_fractions[good]), good))
+    yield by_approval
+    yield list(reversed(by_approval))
+    def most_wanting_family(good):
+        fractions = map_good_to_fractions[good]
+        return max(range(len(families)), key=lambda i: fractions[i])
+    yield sorted(goods, key=lambda good: (most_wanting_family(good), -max(map_good_to_fractions[good]), good))
+    rand = random.Random(seed)
+    for i in range(num_of_random_orders):
+        order = list(goods)
+        rand.shuffle(order)
+        yield order
+
+
+def best_order(families:list, goods:list, num_of_random_orders:int=100, time_limit:float=None,
+               num_of_workers:int=1, seed:int=None)->list:
+    """
+    Evaluates many candidate orders of the goods (see candidate_orders), and returns the order
+    for which the line protocol gives the largest minimum fraction of happy members.
+    The search stops early if an order in which all members are happy is found.
+    :param num_of_random_orders: the number of random orders to evaluate, in addition to the heuristic orders.
+    :param time_limit: an optional time limit in seconds.
+    :param num_of_workers: the number of worker processes; each evaluates a part of the orders.
+    :param seed: a random seed, for reproducibility.
+    :return an order of the goods; to get the allocation, run allocate(families, order).
+
+    >>> fairness_PROP1 = fairness_criteria.ProportionalExceptC(num_of_agents=2,c=1)
+    >>> family1 = Family([BinaryAgent({"w","x"},1),BinaryAgent({"x","y"},2),BinaryAgent({"y","z"},3), BinaryAgent({"z","w"},4)], fairness_criterion=fairness_PROP1, name="Family 1")
+    >>> family2 = Family([BinaryAgent({"w","z"},2),BinaryAgent({"z","y"},3)], fairness_criterion=fairness_PROP1, name="Family 2")
+    >>> from families import min_fraction_of_happy_members
+    >>> min_fraction_of_happy_members([family1, family2], allocate([family1, family2], "wxyz"))
+    0.5
+    >>> order = best_order([family1, family2], "wxyz", seed=1)
+    >>> order
+    ['x', 'z', 'y', 'w']
+    >>> min_fraction_of_happy_members([family1, family2], allocate([family1, family2], order))
+    1.0
+    """
+    orders = list(candidate_orders(families, goods, num_of_random_orders, seed))
+    deadline = None if time_limit is None else time.time() + time_limit
+    if num_of_workers == 1:
+        (value, order) = _evaluate_orders(families, orders, deadline)
+    else:
+        # Each worker gets a contiguous part of the orders, so that it can share the prefix valuations of its orders.
+        chunk_size = -(-len(orders) // num_of_workers)
+        chunks = [orders[i:i+chunk_size] for i in range(0, len(orders), chunk_size)]
+        (value, order) = (-1, orders[0])
+        with multiprocessing.Pool(num_of_workers) as pool:
+            for (chunk_value, chunk_order) in pool.imap_unordered(_evaluate_orders_star, [(families, chunk, deadline) for chunk in chunks]):
+                if chunk_value > value:
+                    (value, order) = (chunk_value, chunk_order)
+                if value >= 1:
+                    pool.terminate()   # all members are happy - no need to wait for the other workers
+                    break
+    logger.info("The best order is {}, with minimum happy fraction {}".format(order, value))
+    return order
+
+
+def _evaluate_orders(families:list, orders:list, deadline:float=None):
+    """
+    Runs the line protocol on each order, and returns a pair (value, order) for the best order.
+    """
+    cache = {}
+    (best_value, best_order) = (-1, orders[0])
+    for order in orders:
+        if deadline is not None and time.time() > deadline:
+            break
+        try:
+            bundles = allocate(families, order, cache)
+        except AssertionError:   # no family accepts the set of all goods
+            continue
+        value = min_fraction_of_happy_members(families, bundles)
+        if value > best_value:
+            (best_value, best_order) = (value, order)
+            if best_value >= 1:
+                break
+    return (best_value, best_order)
+
+
+def _evaluate_orders_star(arguments:tuple):
+    return _evaluate_orders(*arguments)
 
 
 
@@ -0,0 +1,173 @@
+#!python3
+
+"""
+A local-search allocator, that improves a given allocation by moving single goods
+and swapping pairs of goods between families, as long as the fractions of happy members improve.
+
+It is intended for instances that are too large for the exact search of optimal_protocol.
+It supports agents with additive valuations (binary or additive),
+and fairness criteria that are based on a target value (e.g. 1-of-best-c, MMS, PROPc).
+"""
+
+from agents import *
+from families import Family
+import fairness_criteria, line_protocol
+from allocation_state import AllocationState
+from optimal_protocol import compiled_thresholds
+import multiprocessing, random, time
+
+import logging, sys
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler(sys.stdout))
+# To enable tracing, logger.setLevel(logging.INFO)
+
+
+def allocate(families:list, goods:list, initial_bundles:list=None, time_limit:float=None,
+             num_of_restarts:int=0, num_of_workers:int=1, seed:int=None)->list:
+    """
+    Improve an allocation by local search, to increase the minimum fraction of happy members over all families.
+    :param families: a list of k Family objects.
+    :param goods: a list of goods.
+    :param initial_bundles: the allocation to start from (e.g. the output of another protocol).
+       By default, the output of line_protocol.allocate is used.
+    :param time_limit: an optional time limit in seconds.
+    :param num_of_restarts: the number of random restarts (perturbations of the best allocation) in each worker.
+    :param num_of_workers: the number of worker processes; each worker starts with a different random seed.
+    :param seed: a random seed, for reproducibility.
+    :return a list of bundles - a bundle per family.
+
+    Improving an allocation of the line protocol:
+    >>> fairness_1_of_best_2 = fairness_criteria.OneOfBestC(2)
+    >>> family1 = Family([BinaryAgent({"w","x"},1),BinaryAgent({"x","y"},2),BinaryAgent({"y","z"},3), BinaryAgent({"z","w"},4)], fairness_1_of_best_2)
+    >>> family2 = Family([BinaryAgent({"w","z"},2),BinaryAgent({"z","y"},3)], fairness_1_of_best_2)
+    >>> from families import min_fraction_of_happy_members
+    >>> bundles = line_protocol.allocate([family1, family2], "wxyz")
+    >>> min_fraction_of_happy_members([family1, family2], bundles)
+    0.5
+    >>> bundles = allocate([family1, family2], "wxyz", initial_bundles=bundles, seed=1)
+    >>> sorted(bundles[0]), sorted(bundles[1])
+    (['w', 'y'], ['x', 'z'])
+    >>> min_fraction_of_happy_members([family1, family2], bundles)
+    1.0
+
+    Improving an allocation in which one family gets nothing:
+    >>> bundles = allocate([family1, family2], "wxyz", initial_bundles=[set(), set("wxyz")], seed=1)
+    >>> min_fraction_of_happy_members([family1, family2], bundles)
+    1.0
+    """
+    goods = list(goods)
+    if initial_bundles is None:
+        initial_bundles = line_protocol.allocate(families, goods)
+    if seed is None:
+        seed = random.randrange(2**32)
+    arguments = [(families, goods, initial_bundles, time_limit, num_of_restarts, seed + worker)
+                 for worker in range(num_of_workers)]
+    if num_of_workers == 1:
+        results = [_search(*arguments[0])]
+    else:
+        with multiprocessing.Pool(num_of_workers) as pool:
+            results = pool.starmap(_search, arguments)
+    (best_key, best_bundles) = max(results, key=lambda result: result[0])
+    return best_bundles
+
+
+def _search(families:list, goods:list, initial_bundles:list, time_limit:float, num_of_restarts:int, seed:int):
+    """
+    A single local-search worker: climbs from the initial allocation,
+    and then from random perturbations of the best allocation found so far.
+    :return a pair (key, bundles) for the best allocation found.
+    """
+    deadline = None if time_limit is None else time.monotonic() + time_limit
+    rand = random.Random(seed)
+    state = _LocalSearchState(families, goods, initial_bundles)
+    state.climb(rand, deadline)
+    best_key, best_bundles = state.key(), state.bundles_copy()
+    for restart in range(num_of_restarts):
+        if deadline is not None and time.monotonic() > deadline:
+            break
+        best_position = state.snapshot()   # the state is at the best allocation
+        state.perturb(rand)
+        state.climb(rand, deadline)
+        if state.key() > best_key:
+            logger.info("Restart {} improved the allocation to {}".format(restart + 1, state.key()))
+            best_key, best_bundles = state.key(), state.bundles_copy()
+            state.commit()
+        else:
+            state.rollback(best_position)
+    return (best_key, best_bundles)
+
+
+class _LocalSearchState(AllocationState):
+    """
+    The current allocation, with incremental happiness counts (see AllocationState).
+    The allocations are compared by their sorted vectors of happy fractions (leximin order),
+    so a move that improves one of several worst-off families is considered an improvement.
+    """
+
+    def __init__(self, families:list, goods:list, bundles:list=None):
+        for family in families:
+            compiled_thresholds(family)   # raises an error if the family's criterion is not based on a target value
+        super().__init__(families, goods, bundles)
+
+    def key(self)->tuple:
+        return tuple(sorted(self.fractions()))
+
+    def key_after(self, moves:list)->tuple:
+        return tuple(sorted(self.fractions(self.num_of_happy_after(moves))))
+
+    def wanted_by_unhappy(self, good, family_index:int)->bool:
+        return any([self.own_values[family_index][i] < self.targets[family_index][i]
+                    for (i, value) in self.map_good_to_wanters[good][family_index]])
+
+    def improving_moves(self, rand:random.Random):
+        """
+        Generates candidate moves (lists of (good, to_family) pairs) that may help a worst-off family:
+        first single-good moves into this family, then swaps with other families.
+        """
+        fractions = self.fractions(self.num_of_happy)
+        worst = min(range(self.num_of_families), key=lambda f: fractions[f])
+        candidates = [good for good in self.goods
+                      if self.map_good_to_owner[good] != worst and self.wanted_by_unhappy(good, worst)]
+        rand.shuffle(candidates)
+        for good in candidates:
+            yield [(good, worst)]
+        own_goods = list(self.bundles[worst])
+        rand.shuffle(own_goods)
+        for good2 in candidates:
+            other = self.map_good_to_owner[good2]
+            for good1 in own_goods:
+                if self.wanted_by_unhappy(good1, other):
+                    yield [(good1, other), (good2, worst)]
+
+    def climb(self, rand:random.Random, deadline:float=None):
+        """
+        Apply improving moves until a local optimum is reached or the deadline passes.
+        """
+        current_key = self.key()
+        while current_key[0] < 1:
+            for moves in self.improving_moves(rand):
+                if deadline is not None and time.monotonic() > deadline:
+                    return
+                new_key = self.key_after(moves)
+                if new_key > current_key:
+                    logger.info("Moving {}: {} -> {}".format(moves, current_key, new_key))
+                    self.apply(moves)
+                    current_key = new_key
+                    break
+            else:
+                return   # local optimum
+
+    def perturb(self, rand:random.Random):
+        """
+        Move about 10% of the goods to random families.
+        """
+        num_of_moves = max(1, len(self.goods) // 10)
+        self.apply([(good, rand.randrange(self.num_of_families))
+                    for good in rand.sample(self.goods, min(num_of_moves, len(self.goods)))])
+
+
+
+if __name__ == "__main__":
+    import doctest
+    (failures,tests) = doctest.testmod(report=True)
+    print ("{} failures, {} tests".format(failures,tests))
@@ -0,0 +1,201 @@
+#!python3
+
+"""
+A persistent, content-addressed cache of maximin-share values.
+
+Each value is keyed by a hash of the agent's valuation, c and the approximation factor,
+so the same agent valuation is computed only once across processes and runs.
+The cache is stored in an SQLite database, which is safe for concurrent readers and writers.
+When it grows beyond its size limit, the least-recently-used entries are evicted (down to 90% of the limit).
+The last-use times of cache hits are kept in memory and written in batches, so a cache hit does not cost a write transaction;
+the number of entries is also kept in memory, and counted again in the database every few hundred puts
+(so that the entries added by other processes are taken into account), or when the limit seems to be exceeded.
+The default cache is closed at exit, so the buffered last-use times are written.
+
+To use the cache in MaximinShareOneOfC, call set_default_cache(path),
+or set the environment variable MMS_CACHE_PATH (which is inherited by worker processes).
+"""
+
+import atexit, hashlib, json, os, sqlite3, time
+
+LAST_USE_BATCH_SIZE = 100   # the number of cache hits whose last-use times are written in a single transaction
+COUNT_INTERVAL = 256        # the number of puts after which the entries are counted again in the database
+
+
+class MMSCache:
+    """
+    An on-disk cache of maximin-share values.
+
+    >>> import tempfile
+    >>> from agents import AdditiveAgent
+    >>> directory = tempfile.TemporaryDirectory()
+    >>> cache = MMSCache(os.path.join(directory.name, "mms.sqlite"), max_entries=2)
+    >>> a = AdditiveAgent({"x": 1, "y": 2, "z": 4, "w":0})
+    >>> cache.get(a, c=2) is None
+    True
+    >>> cache.put(a, 3, c=2)
+    >>> cache.get(a, c=2)
+    3
+    >>> cache.get(AdditiveAgent({"z": 4, "y": 2, "x": 1, "w":0}, cardinality=5), c=2)  # the same valuation
+    3
+    >>> cache.get(a, c=3) is None
+    True
+    >>> cache.put(a, 1, c=3)
+    >>> cache.get(a, c=2)   # now (a,2) is more recently used than (a,3)
+    3
+    >>> cache.put(a, 1.5, c=2, approximation_factor=0.5)
+    >>> len(cache)
+    2
+    >>> cache.get(a, c=3) is None   # the least-recently-used entry was evicted
+    True
+    >>> cache.get(a, c=2, approximation_factor=0.5)
+    1.5
+    >>> cache.clear()
+    >>> len(cache)
+    0
+    >>> cache.close()
+    >>> directory.cleanup()
+    """
+
+    def __init__(self, path:str, max_entries:int=1000000):
+        """
+        :param path: the path of the database file (created if it does not exist).
+        :param max_entries: the maximum number of cached values.
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self._connection = None
+        self._pid = None
+        self._num_of_entries = None   # the number of entries in the database, as far as this process knows
+        self._num_of_puts = 0         # the number of puts since the entries were last counted in the database
+        self._last_uses = {}          # the last-use times of cache hits that were not written yet
+
+    def connection(self)->sqlite3.Connection:
+        # A connection must not be shared between processes, so each (forked) process opens its own connection.
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS mms (key TEXT PRIMARY KEY, value TEXT NOT NULL, last_used REAL NOT NULL)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS mms_last_used ON mms (last_used)")
+            self._pid = os.getpid()
+            self._num_of_entries = self._count()
+            self._num_of_puts = 0
+            self._last_uses = {}
+        return self._connection
+
+    def get(self, agent, c:int, approximation_factor:float=1):
+        """
+        :return: the cached maximin-share value, or None if it is not in the cache.
+        """
+        key = cache_key(agent, c, approximation_factor)
+        connection = self.connection()
+        row = connection.execute("SELECT value FROM mms WHERE key=?", (key,)).fetchone()
+        if row is None:
+            return None
+        self._last_uses[key] = time.time()
+        if len(self._last_uses) >= LAST_USE_BATCH_SIZE:
+            self.flush()
+        return json.loads(row[0])
+
+    def put(self, agent, value, c:int, approximation_factor:float=1):
+        """
+        Stores the given maximin-share value, evicting the least-recently-used values if the cache is full.
+        """
+        connection = self.connection()
+        connection.execute("INSERT OR REPLACE INTO mms (key, value, last_used) VALUES (?,?,?)",
+                           (cache_key(agent, c, approximation_factor), json.dumps(value), time.time()))
+        self._num_of_entries += 1   # an over-estimate if the key was already cached, or an under-estimate if other processes add entries
+        self._num_of_puts += 1
+        if self._num_of_puts >= COUNT_INTERVAL:
+            self._num_of_entries = self._count()
+        if self._num_of_entries > self.max_entries:
+            self.flush()   # so that the eviction order takes the recent cache hits into account
+            self._num_of_entries = self._count()
+            num_to_evict = self._num_of_entries - (self.max_entries - self.max_entries // 10)
+            if self._num_of_entries > self.max_entries and num_to_evict > 0:
+                connection.execute(
+                    "DELETE FROM mms WHERE key IN (SELECT key FROM mms ORDER BY last_used LIMIT ?)", (num_to_evict,))
+                self._num_of_entries -= num_to_evict
+
+    def flush(self):
+        """
+        Writes the last-use times of the recent cache hits, in a single transaction.
+        """
+        if len(self._last_uses) > 0:
+            connection = self.connection()
+            connection.execute("BEGIN")
+            connection.executemany("UPDATE mms SET last_used=? WHERE key=?",
+                                   [(last_used, key) for key,last_used in self._last_uses.items()])
+            connection.execute("COMMIT")
+            self._last_uses = {}
+
+    def clear(self):
+        self.connection().execute("DELETE FROM mms")
+        self._num_of_entries = 0
+        self._last_uses = {}
+
+    def close(self):
+        if self._connection is not None and self._pid == os.getpid():
+            self.flush()
+            self._connection.close()
+        self._connection = None
+
+    def _count(self)->int:
+        self._num_of_puts = 0
+        return self._connection.execute("SELECT COUNT(*) FROM mms").fetchone()[0]
+
+    def __len__(self):
+        self.connection()
+        self._num_of_entries = self._count()
+        return self._num_of_entries
+
+
+def cache_key(agent, c:int, approximation_factor:float=1)->str:
+    """
+    A canonical hash of the agent's valuation, c and the approximation factor.
+    It does not depend on the order of the goods or on the agent's cardinality.
+
+    >>> from agents import AdditiveAgent, BinaryAgent
+    >>> cache_key(AdditiveAgent({"x": 1, "y": 2}), 2) == cache_key(AdditiveAgent({"y": 2, "x": 1}, cardinality=3), 2)
+    True
+    >>> cache_key(AdditiveAgent({"x": 1, "y": 2}), 2) == cache_key(AdditiveAgent({"x": 1, "y": 2}), 3)
+    False
+    >>> cache_key(AdditiveAgent({"x": 1, "y": 1}), 2) == cache_key(BinaryAgent("xy"), 2)
+    False
+    """
+    description = [type(agent).__name__, agent.canonical_valuation(), c, approximation_factor]
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+_default_cache = None
+_default_cache_is_set = False
+
+def set_default_cache(path:str, max_entries:int=1000000):
+    """
+    Sets the cache consulted by MaximinShareOneOfC. If path is None, the cache is disabled.
+    """
+    global _default_cache, _default_cache_is_set
+    if _default_cache is not None:
+        _default_cache.close()
+        atexit.unregister(_default_cache.close)
+    _default_cache = None if path is None else MMSCache(path, max_entries)
+    if _default_cache is not None:
+        atexit.register(_default_cache.close)   # writes the buffered last-use times
+    _default_cache_is_set = True
+
+
+def default_cache()->MMSCache:
+    """
+    :return: the cache consulted by MaximinShareOneOfC, or None if there is no cache.
+    """
+    if not _default_cache_is_set and os.environ.get("MMS_CACHE_PATH"):
+        set_default_cache(os.environ["MMS_CACHE_PATH"], int(os.environ.get("MMS_CACHE_MAX_ENTRIES", 1000000)))
+    return _default_cache
+
+
+
+if __name__ == "__main__":
+    import doctest
+    (failures,tests) = doctest.testmod(report=True)
+    print ("{} failures, {} tests".format(failures,tests))
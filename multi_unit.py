@@ -0,0 +1,299 @@
+#!python3
+
+"""
+Allocation of goods with several identical units.
+
+An inventory is a dict that maps each good to its number of units,
+and a bundle is a count vector - a dict that maps each good to the number of its units in the bundle
+(goods with no units in the bundle are omitted).
+Each member values every unit of a good as the good itself (see optimal_protocol.good_values),
+so the units need not be expanded into separately named goods:
+* exhaustive_allocate visits the compositions of the inventory (the ways to split the units of each good),
+  instead of all assignments of the units;
+* line_allocate places blocks of units on a line, and finds the cut by binary search over the number of units;
+* rwav_allocate lets each family pick a unit of a good, so that each turn considers the goods and not their units.
+
+It supports agents with additive valuations (binary or additive; RWAV supports only binary agents),
+and fairness criteria that are based on a target value (e.g. 1-of-best-c, MMS, PROPc).
+"""
+
+from agents import *
+from families import Family
+import fairness_criteria, itertools
+from optimal_protocol import good_values
+from rwav_protocol import weight_table
+
+import logging, sys
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler(sys.stdout))
+# To enable tracing, logger.setLevel(logging.INFO)
+
+
+def expand(inventory:dict)->list:
+    """
+    Expands an inventory into separately named units - a pair (good, unit_index) for each unit.
+
+    >>> expand({"x": 2, "y": 1})
+    [('x', 0), ('x', 1), ('y', 0)]
+    """
+    return [(good, unit) for good,count in inventory.items() for unit in range(count)]
+
+
+def expanded_agent(member:Agent, inventory:dict)->Agent:
+    """
+    Creates an agent over the expanded units of the inventory (see expand), that values each unit as the member values its good.
+
+    >>> expanded_agent(BinaryAgent("xz", 2), {"x": 2, "y": 1})
+    2 binary agents who want [('x', 0), ('x', 1)]
+    """
+    values = good_values(member)
+    if isinstance(member, BinaryAgent):
+        return BinaryAgent([unit for unit in expand(inventory) if unit[0] in values], member.cardinality)
+    return AdditiveAgent({unit: values[unit[0]] for unit in expand(inventory) if unit[0] in values}, member.cardinality)
+
+
+class _UnitFamily:
+    """
+    The members of a family, compiled for count-vector bundles:
+    the value of each member to a unit of each good, and the threshold of each member with the given inventory.
+    The threshold of a member is calculated by its expanded agent (see expanded_agent);
+    for binary members, it depends only on the number of desired units, so it is calculated once for each such number.
+    """
+
+    def __init__(self, family:Family, inventory:dict):
+        self.family = family
+        self.member_values = [good_values(member) for member in family.members]
+        self.cardinalities = [member.cardinality for member in family.members]
+        criterion = family.fairness_criterion
+        map_num_of_units_to_threshold = {}
+        self.thresholds = []
+        for member, values in zip(family.members, self.member_values):
+            if isinstance(member, BinaryAgent):
+                num_of_units = sum([inventory.get(good, 0) for good in values])
+                if num_of_units not in map_num_of_units_to_threshold:
+                    map_num_of_units_to_threshold[num_of_units] = criterion.threshold_for_agent(expanded_agent(member, inventory))
+                threshold = map_num_of_units_to_threshold[num_of_units]
+            else:
+                threshold = criterion.threshold_for_agent(expanded_agent(member, inventory))
+            if threshold is None:
+                raise ValueError("Only fairness criteria that are based on a target value are supported, not {}".format(criterion.name))
+            self.thresholds.append(threshold)
+
+    def num_of_happy_members(self, bundle:dict)->int:
+        return sum([cardinality for values, threshold, cardinality in zip(self.member_values, self.thresholds, self.cardinalities)
+                    if sum([value * bundle.get(good, 0) for good,value in values.items()]) >= threshold])
+
+    def fraction_of_happy_members(self, bundle:dict)->float:
+        return self.num_of_happy_members(bundle) / self.family.num_of_members
+
+
+def num_of_happy_members(family:Family, bundle:dict, inventory:dict)->int:
+    """
+    Count the members who are happy with the given count-vector bundle.
+
+    >>> fairness_1_of_best_2 = fairness_criteria.OneOfBestC(2)
+    >>> family = Family([BinaryAgent("xy", 1), BinaryAgent("x", 2), BinaryAgent("z", 1)], fairness_1_of_best_2)
+    >>> num_of_happy_members(family, {"x": 1}, {"x": 2, "y": 1, "z": 2})   # the member who wants z needs a unit of z
+    3
+    >>> num_of_happy_members(family, {"x": 1}, {"x": 2, "y": 1, "z": 1})   # ... unless there is only a single unit of z
+    4
+    """
+    return _UnitFamily(family, inventory).num_of_happy_members(bundle)
+
+
+def compositions(count:int, num_of_parts:int):
+    """
+    Generates all ways to split the given number of units into the given number of (possibly empty) parts.
+
+    >>> list(compositions(2, 2))
+    [(0, 2), (1, 1), (2, 0)]
+    >>> len(list(compositions(5, 3)))
+    21
+    """
+    if num_of_parts == 1:
+        yield (count,)
+        return
+    for first in range(count + 1):
+        for rest in compositions(count - first, num_of_parts - 1):
+            yield (first,) + rest
+
+
+def allocations(inventory:dict, num_of_families:int):
+    """
+    Generates all allocations of the inventory to the given number of families, as lists of count-vector bundles.
+    There are prod_g C(n_g + k - 1, k - 1) such allocations, instead of k^(total number of units).
+
+    >>> len(list(allocations({"x": 3, "y": 2}, 2)))
+    12
+    >>> next(allocations({"x": 3, "y": 2}, 2))
+    [{}, {'x': 3, 'y': 2}]
+    """
+    goods = list(inventory.keys())
+    for parts in itertools.product(*[list(compositions(inventory[good], num_of_families)) for good in goods]):
+        yield [{good: part[f] for good,part in zip(goods, parts) if part[f] > 0} for f in range(num_of_families)]
+
+
+def exhaustive_allocate(families:list, inventory:dict)->list:
+    """
+    Find an allocation that maximizes the minimum fraction of happy members over all families.
+    :param families: a list of k Family objects.
+    :param inventory: a dict that maps each good to its number of units.
+    :return a list of count-vector bundles - a bundle per family.
+
+    >>> fairness_1_of_best_2 = fairness_criteria.OneOfBestC(2)
+    >>> family1 = Family([BinaryAgent("xy", 2), BinaryAgent("x", 1)], fairness_1_of_best_2)
+    >>> family2 = Family([BinaryAgent("xz", 1), BinaryAgent("y", 1)], fairness_1_of_best_2)
+    >>> exhaustive_allocate([family1, family2], {"x": 3, "y": 2, "z": 1})
+    [{'x': 1}, {'x': 2, 'y': 2, 'z': 1}]
+    """
+    unit_families = [_UnitFamily(family, inventory) for family in families]
+    best_value, best_bundles = -1, None
+    for bundles in allocations(inventory, len(families)):
+        value = min([unit_family.fraction_of_happy_members(bundle) for unit_family,bundle in zip(unit_families, bundles)])
+        if value > best_value:
+            best_value, best_bundles = value, bundles
+            if best_value >= 1:
+                break
+    logger.info("Best value: {}".format(best_value))
+    return best_bundles
+
+
+def line_allocate(families:list, line:list)->list:
+    """
+    Run the line protocol (see line_protocol.allocate) on a line of blocks of identical units.
+    The cut is the number of units left of it; the smallest cut that some family accepts is found by binary search,
+    since the number of happy members with the left bundle grows with the cut.
+    :param families: a list of k Family objects.
+    :param line: a list of pairs (good, num_of_units), in their order on the line (a good may appear in several blocks).
+    :return a list of count-vector bundles - a bundle per family.
+
+    >>> fairness_PROP1 = fairness_criteria.ProportionalExceptC(num_of_agents=2,c=1)
+    >>> family1 = Family([BinaryAgent({"w","x"},1),BinaryAgent({"x","y"},2),BinaryAgent({"y","z"},3), BinaryAgent({"z","w"},4)], fairness_criterion=fairness_PROP1, name="Family 1")
+    >>> family2 = Family([BinaryAgent({"w","z"},2),BinaryAgent({"z","y"},3)], fairness_criterion=fairness_PROP1, name="Family 2")
+    >>> line_allocate([family1, family2], [("w",1), ("x",1), ("y",1), ("z",1)])
+    [{'w': 1}, {'x': 1, 'y': 1, 'z': 1}]
+    >>> line_allocate([family1, family2], [("w",100), ("x",100), ("y",100), ("z",100)])
+    [{'w': 100}, {'x': 100, 'y': 100, 'z': 100}]
+    """
+    inventory = {}
+    for good,count in line:
+        inventory[good] = inventory.get(good, 0) + count
+    unit_families = [_UnitFamily(family, inventory) for family in families]
+    bundles = [None] * len(families)
+    remaining_family_indices = list(range(len(families)))
+    line = [(good,count) for good,count in line if count > 0]
+    while len(remaining_family_indices) > 1:
+        k = len(remaining_family_indices)
+        num_of_units = sum([count for good,count in line])
+
+        def accepting_family(cut:int):
+            left_bundle = _prefix(line, cut)
+            for family_index in remaining_family_indices:
+                if unit_families[family_index].num_of_happy_members(left_bundle) * k >= families[family_index].num_of_members:
+                    return family_index
+            return None
+
+        if num_of_units == 0 or accepting_family(num_of_units - 1) is None:
+            raise AssertionError(
+                "No family is willing to accept the set of all goods - the fairness criteria are probably too strong")
+        (low, high) = (0, num_of_units - 1)    # the smallest accepted cut is in [low, high]
+        while low < high:
+            middle = (low + high) // 2
+            if accepting_family(middle) is None:
+                low = middle + 1
+            else:
+                high = middle
+        family_index = accepting_family(low)
+        logger.info("{} gets the left {} units".format(families[family_index].name, low))
+        bundles[family_index] = _prefix(line, low)
+        remaining_family_indices.remove(family_index)
+        line = _suffix(line, low)
+    bundles[remaining_family_indices[0]] = _prefix(line, sum([count for good,count in line]))
+    return bundles
+
+
+def _prefix(line:list, num_of_units:int)->dict:
+    """
+    :return: the count-vector bundle of the first num_of_units units in the line.
+    """
+    bundle = {}
+    for good,count in line:
+        if num_of_units <= 0:
+            break
+        taken = min(count, num_of_units)
+        bundle[good] = bundle.get(good, 0) + taken
+        num_of_units -= taken
+    return bundle
+
+
+def _suffix(line:list, num_of_units:int)->list:
+    """
+    :return: the line without its first num_of_units units.
+    """
+    result = []
+    for good,count in line:
+        taken = min(count, num_of_units)
+        num_of_units -= taken
+        if count > taken:
+            result.append((good, count - taken))
+    return result
+
+
+def rwav_allocate(families:list, inventory:dict)->list:
+    """
+    Run the RWAV protocol (see rwav_protocol.allocate) on an inventory of identical units.
+    In each turn, the family picks a single unit of the good with the largest total weight;
+    the "r" of each member is its number of desired remaining units, and its "s" is the number of desired units it still needs.
+    :param families: a list of k Family objects, with binary agents.
+    :param inventory: a dict that maps each good to its number of units.
+    :return a list of count-vector bundles - a bundle per family.
+
+    >>> fairness_1_of_best_2 = fairness_criteria.OneOfBestC(2)
+    >>> family1 = Family([BinaryAgent({"w","x"},1),BinaryAgent({"x","y"},2),BinaryAgent({"y","z"},3), BinaryAgent({"z","w"},4)], fairness_1_of_best_2)
+    >>> family2 = Family([BinaryAgent({"w","z"},2),BinaryAgent({"z","y"},3)], fairness_1_of_best_2)
+    >>> rwav_allocate([family1, family2], {"w": 1, "x": 1, "y": 1, "z": 1})
+    [{'x': 1, 'z': 1}, {'w': 1, 'y': 1}]
+    >>> rwav_allocate([family1, family2], {"w": 2, "x": 2, "y": 2, "z": 2})
+    [{'w': 1, 'x': 1, 'y': 1, 'z': 1}, {'w': 1, 'x': 1, 'y': 1, 'z': 1}]
+    """
+    for family in families:
+        for member in family.members:
+            if not isinstance(member, BinaryAgent):
+                raise ValueError("RWAV supports only binary agents")
+    k = len(families)
+    table = weight_table(k)
+    remaining = dict(inventory)
+    bundles = [{} for family in families]
+    unit_families = [_UnitFamily(family, inventory) for family in families]
+    # The r (remaining desired units) and s (needed desired units) of each member of each family:
+    rs = [[sum([remaining.get(good, 0) for good in values]) for values in unit_family.member_values] for unit_family in unit_families]
+    ss = [list(unit_family.thresholds) for unit_family in unit_families]
+    num_of_units = sum(remaining.values())
+    for turn in range(num_of_units):
+        f = turn % k
+        unit_family = unit_families[f]
+        member_weights = table.weights(rs[f], ss[f])
+        map_good_to_total_weight = {good: 0 for good,count in remaining.items() if count > 0}
+        for values, cardinality, member_weight in zip(unit_family.member_values, unit_family.cardinalities, member_weights):
+            if member_weight > 0:
+                for good in values:
+                    if good in map_good_to_total_weight:
+                        map_good_to_total_weight[good] += member_weight * cardinality
+        good = min(map_good_to_total_weight, key=lambda good: (-map_good_to_total_weight[good], good))
+        logger.info("Turn #{}: {} picks a unit of {}".format(turn + 1, families[f].name, good))
+        bundles[f][good] = bundles[f].get(good, 0) + 1
+        remaining[good] -= 1
+        for g,other_family in enumerate(unit_families):
+            for i,values in enumerate(other_family.member_values):
+                if good in values:
+                    rs[g][i] -= 1
+                    if g == f:
+                        ss[g][i] -= 1
+    return [{good: bundle[good] for good in inventory if good in bundle} for bundle in bundles]
+
+
+
+if __name__ == "__main__":
+    import doctest
+    (failures,tests) = doctest.testmod(report=True)
+    print ("{} failures, {} tests".format(failures,tests))
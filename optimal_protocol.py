@@ -0,0 +1,248 @@
+#!python3
+
+"""
+An exact branch-and-bound allocator, that finds an allocation maximizing
+the minimum fraction of happy members over all families
+(the best possible democratic-fairness level of the instance).
+
+Unlike the other protocols, it gives no worst-case guarantee (such as 1/2 or 2/3),
+but it finds the optimal allocation of each specific instance.
+It is exponential in the worst case, so it is intended for small instances (up to about 30 goods).
+
+Currently it supports agents with additive valuations (binary or additive),
+and fairness criteria that are based on a target value (e.g. 1-of-best-c, MMS, PROPc).
+"""
+
+from agents import *
+from families import Family
+import fairness_criteria
+import time
+
+import logging, sys
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler(sys.stdout))
+# To enable tracing, logger.setLevel(logging.INFO)
+
+
+def allocate(families:list, goods:list, time_limit:float=None)->list:
+    """
+    Find an allocation that maximizes the minimum fraction of happy members over all families.
+    :param families: a list of k Family objects.
+    :param goods: a list of goods.
+    :param time_limit: an optional time limit in seconds (anytime mode).
+       If it expires before the search is completed, the best allocation found so far is returned.
+    :return a list of bundles - a bundle per family.
+
+    >>> fairness_1_of_best_2 = fairness_criteria.OneOfBestC(2)
+    >>> family1 = Family([BinaryAgent({"w","x"},1),BinaryAgent({"x","y"},2),BinaryAgent({"y","z"},3), BinaryAgent({"z","w"},4)], fairness_1_of_best_2)
+    >>> family2 = Family([BinaryAgent({"w","z"},2),BinaryAgent({"z","y"},3)], fairness_1_of_best_2)
+    >>> (bundle1,bundle2) = allocate([family1, family2], ["w","x","y","z"])
+    >>> sorted(bundle1), sorted(bundle2)
+    (['x', 'z'], ['w', 'y'])
+    >>> from families import min_fraction_of_happy_members
+    >>> min_fraction_of_happy_members([family1, family2], [bundle1, bundle2])
+    1.0
+
+    The 2/3 guarantee of the two-thirds protocol is tight for the following family:
+    >>> family3 = Family([BinaryAgent("xy",1), BinaryAgent("yz",1), BinaryAgent("zx",1)], fairness_1_of_best_2)
+    >>> bundles = allocate([family3, family3], "xyz")
+    >>> min_fraction_of_happy_members([family3, family3], bundles)
+    0.6666666666666666
+
+    >>> fairness_PROP1 = fairness_criteria.ProportionalExceptC(num_of_agents=2,c=1)
+    >>> family4 = Family([AdditiveAgent({"x":1,"y":2,"z":4},2), AdditiveAgent({"x":4,"y":2,"z":1},1)], fairness_PROP1)
+    >>> family5 = Family([AdditiveAgent({"x":1,"y":1,"z":1},1)], fairness_PROP1)
+    >>> (bundle4,bundle5) = allocate([family4, family5], "xyz")
+    >>> sorted(bundle4), sorted(bundle5)
+    (['x', 'y'], ['z'])
+    """
+    search = _BranchAndBound(families, list(goods), time_limit)
+    search.run()
+    return search.best_bundles
+
+
+class _BranchAndBound:
+    """
+    The state of a single branch-and-bound search.
+
+    For each member of each family, it keeps two values:
+    * own_value - the member's value of the goods already allocated to its family;
+    * optimistic_value - the member's value of these goods plus all unallocated goods.
+    A member is "happy" if own_value >= target, and "possibly happy" if optimistic_value >= target.
+    The number of possibly-happy members in each family is an upper bound on its number of happy members
+    in every completion of the current partial allocation.
+    Allocating a good updates only the members who want this good.
+    """
+
+    def __init__(self, families:list, goods:list, time_limit:float):
+        self.families = families
+        self.num_of_families = len(families)
+        self.deadline = None if time_limit is None else time.monotonic() + time_limit
+        self.timed_out = False
+
+        self.targets = []            # targets[f][i] = the target value of member i of family f
+        self.cardinalities = []      # cardinalities[f][i] = the cardinality of member i of family f
+        self.own_values = []
+        self.optimistic_values = []
+        self.num_of_happy = [0] * self.num_of_families           # weighted by cardinality
+        self.num_of_possibly_happy = [0] * self.num_of_families  # weighted by cardinality
+        map_good_to_wanters = {good: [] for good in goods}        # good -> list of (family_index, member_index, value)
+        for f,family in enumerate(families):
+            targets = compiled_thresholds(family)
+            self.targets.append(targets)
+            self.cardinalities.append([member.cardinality for member in family.members])
+            self.own_values.append([0] * len(family.members))
+            optimistic_values = [0] * len(family.members)
+            for i,member in enumerate(family.members):
+                for good,value in good_values(member).items():
+                    if good in map_good_to_wanters:
+                        map_good_to_wanters[good].append((f, i, value))
+                        optimistic_values[i] += value
+            self.optimistic_values.append(optimistic_values)
+            for i,member in enumerate(family.members):
+                if targets[i] <= 0:
+                    self.num_of_happy[f] += member.cardinality
+                if optimistic_values[i] >= targets[i]:
+                    self.num_of_possibly_happy[f] += member.cardinality
+        self.map_good_to_wanters = map_good_to_wanters
+
+        # Order the goods by contention: goods wanted by many families, and by large fractions of their members, come first.
+        def contention(good):
+            fractions = [0] * self.num_of_families
+            for (f, i, value) in map_good_to_wanters[good]:
+                fractions[f] += self.cardinalities[f][i] / families[f].num_of_members
+            return (-sum([1 for x in fractions if x > 0]), -sum(fractions), good)
+        self.goods = sorted(goods, key=contention)
+
+        self.bundles = [set() for f in families]
+        self.best_bundles = None
+        self.best_value = -1
+        self.num_of_nodes = 0
+
+    def assign(self, good, family_index:int):
+        self.bundles[family_index].add(good)
+        for (f, i, value) in self.map_good_to_wanters[good]:
+            if f == family_index:
+                old_value = self.own_values[f][i]
+                self.own_values[f][i] = old_value + value
+                if old_value < self.targets[f][i] <= old_value + value:
+                    self.num_of_happy[f] += self.cardinalities[f][i]
+            else:
+                old_value = self.optimistic_values[f][i]
+                self.optimistic_values[f][i] = old_value - value
+                if old_value - value < self.targets[f][i] <= old_value:
+                    self.num_of_possibly_happy[f] -= self.cardinalities[f][i]
+
+    def unassign(self, good, family_index:int):
+        self.bundles[family_index].remove(good)
+        for (f, i, value) in self.map_good_to_wanters[good]:
+            if f == family_index:
+                old_value = self.own_values[f][i]
+                self.own_values[f][i] = old_value - value
+                if old_value - value < self.targets[f][i] <= old_value:
+                    self.num_of_happy[f] -= self.cardinalities[f][i]
+            else:
+                old_value = self.optimistic_values[f][i]
+                self.optimistic_values[f][i] = old_value + value
+                if old_value < self.targets[f][i] <= old_value + value:
+                    self.num_of_possibly_happy[f] += self.cardinalities[f][i]
+
+    def upper_bound(self)->float:
+        return min([self.num_of_possibly_happy[f] / self.families[f].num_of_members for f in range(self.num_of_families)])
+
+    def gain(self, good, family_index:int)->int:
+        """
+        The number of members of the given family who want the given good and are not happy yet.
+        """
+        return sum([self.cardinalities[f][i] for (f, i, value) in self.map_good_to_wanters[good]
+                    if f == family_index and self.own_values[f][i] < self.targets[f][i]])
+
+    def non_symmetric_family_indices(self)->list:
+        """
+        When the same family appears several times and its copies have empty bundles,
+        giving the next good to each of these copies leads to symmetric allocations, so only the first copy is tried.
+        """
+        indices = []
+        for f in range(self.num_of_families):
+            if len(self.bundles[f]) == 0 and any([self.families[g] is self.families[f] and len(self.bundles[g]) == 0 for g in indices]):
+                continue
+            indices.append(f)
+        return indices
+
+    def is_relevant(self, good)->bool:
+        """
+        A good is relevant if some member who wants it is not happy yet, but may still become happy.
+        """
+        for (f, i, value) in self.map_good_to_wanters[good]:
+            if self.own_values[f][i] < self.targets[f][i] <= self.optimistic_values[f][i]:
+                return True
+        return False
+
+    def run(self):
+        self.search(0)
+        logger.info("Searched {} nodes{}; best value: {}".format(
+            self.num_of_nodes, " (timed out)" if self.timed_out else "", self.best_value))
+
+    def search(self, depth:int):
+        self.num_of_nodes += 1
+        if depth == len(self.goods):
+            value = min([self.num_of_happy[f] / self.families[f].num_of_members for f in range(self.num_of_families)])
+            if value > self.best_value:
+                logger.info("Found an allocation with value {}".format(value))
+                self.best_value = value
+                self.best_bundles = [set(bundle) for bundle in self.bundles]
+            return
+        if self.best_bundles is not None:
+            if self.best_value >= 1 or self.upper_bound() <= self.best_value:
+                return
+            if self.deadline is not None and (self.timed_out or time.monotonic() > self.deadline):
+                self.timed_out = True
+                return
+        good = self.goods[depth]
+        if not self.is_relevant(good):   # the good cannot change anyone's happiness - no need to branch
+            family_indices = [0]
+        else:
+            family_indices = sorted(self.non_symmetric_family_indices(), key=lambda f: -self.gain(good, f))
+        for f in family_indices:
+            self.assign(good, f)
+            self.search(depth + 1)
+            self.unassign(good, f)
+
+
+def compiled_thresholds(family:Family)->list:
+    """
+    Returns the compiled thresholds of the family members,
+    raising an error if the family's criterion is not based on a target value.
+    """
+    thresholds = family.thresholds()
+    if None in thresholds:
+        raise ValueError("Only fairness criteria that are based on a target value are supported, not {}".format(family.fairness_criterion.name))
+    return thresholds
+
+
+def good_values(member:Agent)->dict:
+    """
+    Returns a dict that maps each good desired by the given additive member to its value.
+
+    >>> good_values(BinaryAgent("xy"))
+    {'x': 1, 'y': 1}
+    >>> good_values(AdditiveAgent({"x":1, "y":0, "z":3}))
+    {'x': 1, 'z': 3}
+    >>> good_values(MonotoneAgent({"x": 1, "y": 2, "xy": 4}))
+    Traceback (most recent call last):
+    ...
+    ValueError: Only binary and additive agents are supported
+    """
+    if isinstance(member, BinaryAgent):
+        return {good: 1 for good in member.desired_goods_list}
+    elif isinstance(member, AdditiveAgent):
+        return {good: value for good,value in member.map_good_to_value.items() if value > 0}
+    else:
+        raise ValueError("Only binary and additive agents are supported")
+
+
+
+if __name__ == "__main__":
+    import doctest
+    (failures,tests) = doctest.testmod(report=True)
+    print ("{} failures, {} tests".format(failures,tests))
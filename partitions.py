@@ -69,6 +69,46 @@ def powerset(iterable):
     s = list(iterable)
     return itertools.chain.from_iterable(itertools.combinations(s, r) for r in range(len(s)+1))
 
+def gray_code_moves(num_of_goods:int, c:int):
+    """
+    Generates all c^n assignments of n goods to c bundles in a reflected Gray-code order,
+    so that consecutive assignments differ by moving a single good.
+    The first assignment gives all goods to bundle 0; the generator yields only the moves,
+    as triples (good_index, from_bundle, to_bundle).
+
+    >>> list(gray_code_moves(2, 2))
+    [(0, 0, 1), (1, 0, 1), (0, 1, 0)]
+    >>> len(list(gray_code_moves(3, 3)))
+    26
+    """
+    return mixed_radix_gray_code_moves([c] * num_of_goods)
+
+
+def mixed_radix_gray_code_moves(radices:list):
+    """
+    Generates all vectors of digits, in which digit i is in range(radices[i]), in a reflected Gray-code order,
+    so that consecutive vectors differ by a single digit, that changes by 1.
+    The first vector is all zeros; the generator yields only the changes, as triples (index, old_digit, new_digit).
+
+    >>> list(mixed_radix_gray_code_moves([3, 2]))
+    [(0, 0, 1), (0, 1, 2), (1, 0, 1), (0, 2, 1), (0, 1, 0)]
+    >>> len(list(mixed_radix_gray_code_moves([2, 3, 4])))
+    23
+    """
+    digits = [0] * len(radices)
+    directions = [1] * len(radices)
+    while True:
+        for index in range(len(radices)):
+            new_digit = digits[index] + directions[index]
+            if 0 <= new_digit < radices[index]:
+                yield (index, digits[index], new_digit)
+                digits[index] = new_digit
+                break
+            directions[index] = -directions[index]
+        else:
+            return
+
+
 if __name__ == "__main__":
     import doctest
     (failures,tests) = doctest.testmod(report=True)
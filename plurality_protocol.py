@@ -12,6 +12,8 @@ it includes only the construction of the final allocation from that subsimplex.
 from agents import *
 from families import Family
 import fairness_criteria
+from happiness_matrix import HappinessMatrix, has_additive_members
+import weakref
 
 
 import logging, sys
@@ -32,15 +34,106 @@ def best_index_by_plurality(family:Family, partition:list) -> int:
     >>> best_index_by_plurality(family1, ["xy","yz"])
     1
     """
-    votes = [0] * len(partition)
-    for member in family.members:
-        best = member.best_index(partition)
-        votes[best] += member.cardinality
-    winner = max(range(len(partition)), key=lambda i: votes[i])
+    ([votes], [winner]) = plurality_votes(family, [partition])
     logger.info("{}: votes={}, winner=allocation[{}]={}".format(family.name, votes, winner, partition[winner]))
     return winner
 
 
+def plurality_votes(family:Family, partitions:list) -> tuple:
+    """
+    Computes the plurality votes of the members of the given family over many partitions at once.
+    :param   family: a Family object, with several members.
+    :param   partitions: a list of partitions; each partition is a list of some k bundles.
+    :return: a pair (votes, winners): votes[p][b] is the (weighted) number of members whose best bundle in partitions[p] is b,
+    and winners[p] is the index of the bundle with the most votes (the first index in case of a tie).
+
+    The valuations are prepared once for all partitions:
+    binary members with the same desired goods are merged into a single bit-mask,
+    so the value of a bundle is the popcount of the intersection of two masks;
+    additive members keep only their non-zero values, so the value of all bundles is found in a single pass over the member's goods.
+
+    >>> family1 = Family([BinaryAgent("xy",1), BinaryAgent("yz",2), BinaryAgent("zy",1)], fairness_criteria.OneOfBestC(2), name="Family 1")
+    >>> plurality_votes(family1, [["xy","yz"], ["x", "yz"], ["xy", "z"]])
+    ([[1, 3], [1, 3], [4, 0]], [1, 1, 0])
+    >>> family2 = Family([AdditiveAgent({"x":1, "y":2, "z":3},2), AdditiveAgent({"x":3, "y":2, "z":-1},1)], fairness_criteria.OneOfBestC(2), name="Family 2")
+    >>> plurality_votes(family2, [["xy","z"], ["x", "yz"], ["xyz", ""]])
+    ([[3, 0], [1, 2], [3, 0]], [0, 1, 0])
+    """
+    return _plurality_voters(family).votes(partitions)
+
+
+class _PluralityVoters:
+    """
+    The valuations of the members of a family, prepared for plurality voting over many partitions.
+    """
+
+    def __init__(self, family:Family):
+        self.map_good_to_bit = {}
+        self.map_mask_to_cardinality = {}   # binary members
+        self.additive_members = []          # pairs (cardinality, list of (good,value))
+        self.other_members = []
+        for member in family.members:
+            if isinstance(member, BinaryAgent):
+                mask = 0
+                for good in member.desired_goods:
+                    mask |= self.map_good_to_bit.setdefault(good, 1 << len(self.map_good_to_bit))
+                self.map_mask_to_cardinality[mask] = self.map_mask_to_cardinality.get(mask, 0) + member.cardinality
+            elif isinstance(member, AdditiveAgent):
+                self.additive_members.append((member.cardinality, [(good, value) for good,value in member.map_good_to_value.items() if value != 0]))
+            else:
+                self.other_members.append(member)
+
+    def votes(self, partitions:list) -> tuple:
+        all_votes = []
+        winners = []
+        for partition in partitions:
+            num_of_bundles = len(partition)
+            votes = [0] * num_of_bundles
+            if len(self.map_mask_to_cardinality) > 0:
+                bundle_masks = [0] * num_of_bundles
+                for b,bundle in enumerate(partition):
+                    for good in bundle:
+                        bundle_masks[b] |= self.map_good_to_bit.get(good, 0)
+                for mask, cardinality in self.map_mask_to_cardinality.items():
+                    values = [(mask & bundle_mask).bit_count() for bundle_mask in bundle_masks]
+                    votes[values.index(max(values))] += cardinality
+            if len(self.additive_members) > 0:
+                map_good_to_bundle = {good: b for b,bundle in enumerate(partition) for good in bundle}
+                for cardinality, good_values in self.additive_members:
+                    values = [0] * num_of_bundles
+                    for good, value in good_values:
+                        b = map_good_to_bundle.get(good)
+                        if b is not None:
+                            values[b] += value
+                    votes[values.index(max(values))] += cardinality
+            for member in self.other_members:
+                votes[member.best_index(partition)] += member.cardinality
+            all_votes.append(votes)
+            winners.append(max(range(num_of_bundles), key=lambda b: votes[b]))
+        return (all_votes, winners)
+
+
+# Maps each family to a pair (members, voters), so that the voters are prepared once per family.
+# NOTE: Family.members is replaced, not changed in-place, when the members change; this invalidates the voters.
+_voters_of_families = weakref.WeakKeyDictionary()
+
+def _plurality_voters(family:Family) -> _PluralityVoters:
+    """
+    >>> family1 = Family([BinaryAgent("xy",1), BinaryAgent("yz",2)], fairness_criteria.OneOfBestC(2), name="Family 1")
+    >>> _plurality_voters(family1) is _plurality_voters(family1)
+    True
+    >>> family1.members = [BinaryAgent("xy",1)]
+    >>> _plurality_voters(family1).map_mask_to_cardinality
+    {3: 1}
+    """
+    members = family.members
+    cached = _voters_of_families.get(family)
+    if cached is None or cached[0] is not members:
+        cached = (members, _PluralityVoters(family))
+        _voters_of_families[family] = cached
+    return cached[1]
+
+
 def find_plurality_envy_free_allocation(families: list, partition:list) -> bool:
     """
     Find a permutation of the given partition in which
@@ -61,12 +154,18 @@ def find_plurality_envy_free_allocation(families: list, partition:list) -> bool:
     (['y', 'z'], ['w', 'x'])
     >>> find_plurality_envy_free_allocation([family1,family1], partition) is None
     True
+    >>> family3 = Family([MonotoneAgent({"x":1, "y":2, "xy":3}, 2), MonotoneAgent({"x":2, "y":1, "xy":3})], fairness_criteria.OneOfBestC(2), name="Family 3")
+    >>> family4 = Family([MonotoneAgent({"x":2, "y":1, "xy":3})], fairness_criteria.OneOfBestC(2), name="Family 4")
+    >>> find_plurality_envy_free_allocation([family3,family4], [{"x"},{"y"}])
+    [{'y'}, {'x'}]
     """
+    # With additive members, the values of all members to all bundles are calculated in a single pass.
+    matrix = HappinessMatrix(families, partition) if has_additive_members(families) else None
     allocation = [None]*len(families)
     best_indices = set()
     for i in range(len(families)):
         family = families[i]
-        i_best = best_index_by_plurality(family, partition)
+        i_best = best_index_by_plurality(family, partition) if matrix is None else matrix.best_index_by_plurality(i)
         if i_best in best_indices:
             logger.info("Two families vote for {} - no permutation is plurality-EF")
             return None
@@ -95,13 +194,25 @@ def find_plurality_EF2_allocation(families: list, subsimplex_vertices: list) ->
     >>> alloc = find_plurality_EF2_allocation([family1,family2], [partition2,partition1])
     >>> sorted(alloc[0]), sorted(alloc[1])
     (['w', 'x'], ['y', 'z'])
+    >>> alloc = find_plurality_EF2_allocation([family1,family1], [partition1,partition2])
+    >>> sorted(alloc[0]), sorted(alloc[1])
+    (['y', 'z'], ['w', 'x'])
     """
+    # A family that appears several times votes on all its vertices in a single call.
+    map_family_to_vertex_indices = {}
+    for i,family in enumerate(families):
+        map_family_to_vertex_indices.setdefault(family, []).append(i)
+    winners = [None]*len(families)
+    for family, vertex_indices in map_family_to_vertex_indices.items():
+        (votes, family_winners) = plurality_votes(family, [subsimplex_vertices[i] for i in vertex_indices])
+        for i, family_votes, winner in zip(vertex_indices, votes, family_winners):
+            logger.info("{}: votes={}, winner=allocation[{}]={}".format(family.name, family_votes, winner, subsimplex_vertices[i][winner]))
+            winners[i] = winner
+
     map_family_index_to_best_index = [None]*len(families)
     best_indices = set()
     for i in range(len(families)):
-        family = families[i]
-        partition = subsimplex_vertices[i]
-        i_best = best_index_by_plurality(family, partition)
+        i_best = winners[i]
         if i_best in best_indices:
             logger.info("Two families vote for {} - no permutation is plurality-EF")
             return None
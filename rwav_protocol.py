@@ -8,6 +8,8 @@ See: https://arxiv.org/abs/1709.02564 subsections 3.2 and 5.4 for details.
 
 from functools import lru_cache
 from collections import defaultdict
+from array import array
+import multiprocessing
 from families import *
 from utils import plural
 
@@ -30,32 +32,469 @@ def allocate(families:list, goods: set)->list:
     ['x', 'z']
     >>> sorted(bundle2)
     ['w', 'y']
+
+    With more than two families, members may need more than one good:
+    >>> fairness_1_of_3_MMS = fairness_criteria.MaximinShareOneOfC(3)
+    >>> family1 = Family([BinaryAgent("uvwxyz",2), BinaryAgent("stuv",1)], fairness_1_of_3_MMS)
+    >>> family2 = Family([BinaryAgent("stuvwx",1), BinaryAgent("wxyz",1)], fairness_1_of_3_MMS)
+    >>> family3 = Family([BinaryAgent("styz",1), BinaryAgent("stuvwxyz",1)], fairness_1_of_3_MMS)
+    >>> bundles = allocate([family1, family2, family3], "stuvwxyz")
+    >>> [sorted(bundle) for bundle in bundles]
+    [['u', 'v', 'y'], ['t', 'w', 'z'], ['s', 'x']]
+    >>> [family.num_of_happy_members(bundle, bundles) for family,bundle in zip([family1, family2, family3], bundles)]
+    [3, 2, 2]
+    """
+    session = RWAVSession(families, goods)
+    for good in session.steps():
+        pass
+    return session.bundles
+
+
+class RWAVSession:
+    """
+    A run of the RWAV protocol that advances one turn at a time, so it can be interleaved with other sessions,
+    paused (e.g. while waiting for a family to confirm its pick) and resumed from a compact snapshot.
+
+    >>> fairness_1_of_best_2 = fairness_criteria.OneOfBestC(2)
+    >>> family1 = Family([BinaryAgent({"w","x"},1),BinaryAgent({"x","y"},2),BinaryAgent({"y","z"},3), BinaryAgent({"z","w"},4)], fairness_1_of_best_2)
+    >>> family2 = Family([BinaryAgent({"w","z"},2),BinaryAgent({"z","y"},3)], fairness_1_of_best_2)
+    >>> session = RWAVSession([family1, family2], "wxyz")
+    >>> session.proposal()
+    'z'
+    >>> session.step()
+    'z'
+    >>> snapshot = session.snapshot()
+    >>> snapshot
+    {'bundles': [['z'], []], 'remaining_goods': ['w', 'x', 'y'], 'turn_index': 1, 'family_index': 1}
+    >>> resumed = RWAVSession.from_snapshot([family1, family2], snapshot)
+    >>> list(resumed.steps())
+    ['y', 'x', 'w']
+    >>> resumed.is_finished(), [sorted(bundle) for bundle in resumed.bundles]
+    (True, [['x', 'z'], ['w', 'y']])
+
+    A family may confirm a different pick than the proposal:
+    >>> session.step("w")
+    'w'
+    >>> session.step("z")
+    Traceback (most recent call last):
+    ...
+    ValueError: z is not a remaining good
+    """
+
+    def __init__(self, families:list, goods:set):
+        self.families = families
+        self.map_family_index_to_target_values = [target_values(family) for family in families]
+        self.remaining_goods = set(goods)
+        self.bundles = [set() for f in families]
+        self.turn_index = 0
+        self.family_index = 0
+
+    def is_finished(self)->bool:
+        return len(self.remaining_goods) == 0
+
+    def proposal(self):
+        """
+        :return: the good that the current family should pick, by weighted approval voting.
+        """
+        current_family = self.families[self.family_index]
+        logger.info("\nTurn #{}: {}'s turn to pick a good from {}:".format(self.turn_index + 1, current_family.name, sorted(self.remaining_goods)))
+        return choose_good(current_family, self.bundles[self.family_index], self.remaining_goods, len(self.families),
+                           self.map_family_index_to_target_values[self.family_index])
+
+    def step(self, good=None):
+        """
+        Let the current family pick a good, and pass the turn to the next family.
+        :param good: the good picked by the family; by default, the proposal.
+        :return: the picked good.
+        """
+        if good is None:
+            good = self.proposal()
+        elif good not in self.remaining_goods:
+            raise ValueError("{} is not a remaining good".format(good))
+        logger.info("{} picks {}".format(self.families[self.family_index].name, good))
+        self.bundles[self.family_index].add(good)
+        self.remaining_goods.remove(good)
+        self.turn_index += 1
+        self.family_index = (self.family_index + 1) % len(self.families)
+        return good
+
+    def steps(self):
+        """
+        Generates the picked goods, one turn at a time, until all goods are allocated.
+        """
+        while not self.is_finished():
+            yield self.step()
+
+    def snapshot(self)->dict:
+        """
+        :return: the state of the session, as a JSON-serializable dict (the families are not included).
+        """
+        return {"bundles": [sorted(bundle) for bundle in self.bundles], "remaining_goods": sorted(self.remaining_goods),
+                "turn_index": self.turn_index, "family_index": self.family_index}
+
+    @classmethod
+    def from_snapshot(cls, families:list, snapshot:dict)->'RWAVSession':
+        """
+        Resumes a session of the given families from a snapshot.
+        """
+        session = cls(families, snapshot["remaining_goods"])
+        session.bundles = [set(bundle) for bundle in snapshot["bundles"]]
+        session.turn_index = snapshot["turn_index"]
+        session.family_index = snapshot["family_index"]
+        return session
+
+
+
+
+class OnlineRWAVSession:
+    """
+    An online run of the RWAV protocol, for goods that are announced over time (e.g. in batches).
+    The r of each member counts only the goods that were announced and not allocated yet ("available"),
+    and it is updated incrementally: announcing or allocating a good touches only the members who want it.
+    The families pick in round-robin order, continuing from batch to batch.
+    If all goods are announced at once, the result is identical to that of allocate.
+
+    >>> fairness_1_of_best_2 = fairness_criteria.OneOfBestC(2)
+    >>> family1 = Family([BinaryAgent({"w","x"},1),BinaryAgent({"x","y"},2),BinaryAgent({"y","z"},3), BinaryAgent({"z","w"},4)], fairness_1_of_best_2)
+    >>> family2 = Family([BinaryAgent({"w","z"},2),BinaryAgent({"z","y"},3)], fairness_1_of_best_2)
+    >>> session = OnlineRWAVSession([family1, family2])
+    >>> session.announce(["w","x","y","z"])
+    >>> session.pick_all()
+    ['z', 'y', 'x', 'w']
+    >>> session.bundles == allocate([family1, family2], ["w","x","y","z"])
+    True
+
+    Goods that arrive in two batches, with a checkpoint between them:
+    >>> session = OnlineRWAVSession([family1, family2])
+    >>> session.announce(["w","x"])
+    >>> session.pick_all()
+    ['w', 'x']
+    >>> checkpoint = session.snapshot()
+    >>> session.announce(["y","z"])
+    >>> session.pick_all()
+    ['y', 'z']
+    >>> checkpoint["own_values"]   # the checkpoint is not changed when the session continues
+    [[1, 0, 0, 1], [0, 0]]
+    >>> resumed = OnlineRWAVSession.from_snapshot([family1, family2], checkpoint)
+    >>> resumed.announce(["y","z"])
+    >>> resumed.pick_all()
+    ['y', 'z']
+    >>> [sorted(bundle) for bundle in resumed.bundles]
+    [['w', 'y'], ['x', 'z']]
+    """
+
+    def __init__(self, families:list):
+        self.families = families
+        self.map_family_index_to_target_values = [target_values(family) for family in families]
+        self.bundles = [set() for f in families]
+        self.available_goods = set()
+        self.turn_index = 0
+        self.family_index = 0
+        # The "r" of each member, and its value of its family's bundle:
+        self.remaining_values = [[0] * len(family.members) for family in families]
+        self.own_values = [[0] * len(family.members) for family in families]
+        # map_good_to_wanters[good] = list of (family_index, member_index) for the members who want the good:
+        self.map_good_to_wanters = defaultdict(list)
+        for f,family in enumerate(families):
+            for i,(desired_goods, cardinality) in enumerate(_desired_goods_and_cardinalities(family)):
+                for good in desired_goods:
+                    self.map_good_to_wanters[good].append((f, i))
+
+    def announce(self, goods:list):
+        """
+        Make new goods available for picking.
+        """
+        for good in goods:
+            if good in self.available_goods or any([good in bundle for bundle in self.bundles]):
+                raise ValueError("{} was already announced".format(good))
+            self.available_goods.add(good)
+            for (f, i) in self.map_good_to_wanters.get(good, ()):
+                self.remaining_values[f][i] += 1
+
+    def proposal(self):
+        """
+        :return: the available good that the current family should pick, by weighted approval voting.
+        """
+        if len(self.available_goods) == 0:
+            raise ValueError("There are no available goods")
+        f = self.family_index
+        family = self.families[f]
+        logger.info("\nTurn #{}: {}'s turn to pick a good from {}:".format(self.turn_index + 1, family.name, sorted(self.available_goods)))
+        table = weight_table(len(self.families))
+        member_weights = table.weights(self.remaining_values[f],
+            [target_value - own_value for target_value, own_value in zip(self.map_family_index_to_target_values[f], self.own_values[f])])
+        map_good_to_total_weight = defaultdict(int)
+        for (desired_goods, cardinality), current_member_weight in zip(_desired_goods_and_cardinalities(family), member_weights):
+            if current_member_weight:
+                for good in desired_goods:
+                    if good in self.available_goods:
+                        map_good_to_total_weight[good] += current_member_weight * cardinality
+        return min(self.available_goods, key=lambda good: (-map_good_to_total_weight[good], good))
+
+    def pick(self, good=None):
+        """
+        Let the current family pick an available good, and pass the turn to the next family.
+        :param good: the good picked by the family; by default, the proposal.
+        :return: the picked good.
+        """
+        if good is None:
+            good = self.proposal()
+        elif good not in self.available_goods:
+            raise ValueError("{} is not an available good".format(good))
+        f = self.family_index
+        logger.info("{} picks {}".format(self.families[f].name, good))
+        self.available_goods.remove(good)
+        self.bundles[f].add(good)
+        for (g, i) in self.map_good_to_wanters.get(good, ()):
+            self.remaining_values[g][i] -= 1
+            if g == f:
+                self.own_values[g][i] += 1
+        self.turn_index += 1
+        self.family_index = (f + 1) % len(self.families)
+        return good
+
+    def pick_all(self)->list:
+        """
+        Let the families pick, in turn, all the available goods.
+        :return: the list of picked goods.
+        """
+        picks = []
+        while len(self.available_goods) > 0:
+            picks.append(self.pick())
+        return picks
+
+    def snapshot(self)->dict:
+        """
+        :return: a checkpoint of the session, as a JSON-serializable dict (the families are not included).
+        """
+        return {"bundles": [sorted(bundle) for bundle in self.bundles], "available_goods": sorted(self.available_goods),
+                "turn_index": self.turn_index, "family_index": self.family_index,
+                "remaining_values": [list(values) for values in self.remaining_values],
+                "own_values": [list(values) for values in self.own_values]}
+
+    @classmethod
+    def from_snapshot(cls, families:list, snapshot:dict)->'OnlineRWAVSession':
+        """
+        Resumes a session of the given families from a checkpoint.
+        """
+        session = cls(families)
+        session.bundles = [set(bundle) for bundle in snapshot["bundles"]]
+        session.available_goods = set(snapshot["available_goods"])
+        session.turn_index = snapshot["turn_index"]
+        session.family_index = snapshot["family_index"]
+        session.remaining_values = [list(values) for values in snapshot["remaining_values"]]
+        session.own_values = [list(values) for values in snapshot["own_values"]]
+        return session
+
+
+def allocate_batch(instances:list)->list:
+    """
+    Run the RWAV protocol on many independent instances, e.g. in simulations.
+    The results are identical to those of allocate (including the tie-breaking of choose_good),
+    but each instance is compiled into bit-masks over its goods, so a turn costs a few integer operations per member
+    instead of set operations, and all instances advance turn by turn in lockstep.
+    :param instances: a list of pairs (families, goods).
+    :return a list with the bundles of each instance.
+
+    >>> fairness_1_of_best_2 = fairness_criteria.OneOfBestC(2)
+    >>> family1 = Family([BinaryAgent({"w","x"},1),BinaryAgent({"x","y"},2),BinaryAgent({"y","z"},3), BinaryAgent({"z","w"},4)], fairness_1_of_best_2)
+    >>> family2 = Family([BinaryAgent({"w","z"},2),BinaryAgent({"z","y"},3)], fairness_1_of_best_2)
+    >>> results = allocate_batch([([family1, family2], "wxyz"), ([family2, family1], "wxyz")])
+    >>> [[sorted(bundle) for bundle in bundles] for bundles in results]
+    [[['x', 'z'], ['w', 'y']], [['x', 'z'], ['w', 'y']]]
+    >>> results[1] == allocate([family2, family1], "wxyz")
+    True
+    """
+    compiled_families = {}   # families that appear in several instances with the same goods are compiled once
+    states = [_BatchState(families, goods, compiled_families) for (families, goods) in instances]
+    active = [state for state in states if len(state.remaining_indices) > 0]
+    while len(active) > 0:
+        for state in active:
+            state.step()
+        active = [state for state in active if len(state.remaining_indices) > 0]
+    return [state.bundles() for state in states]
+
+
+class _BatchState:
+    """
+    The state of a single instance in allocate_batch.
+    The goods are indexed in sorted order, so the tie-breaking by the good (as in choose_good) is a tie-breaking by the index.
+    Each member is represented by the bit-mask of its desired goods, the list of their indices, its cardinality and its target value.
     """
-    # Calculate target value for each member in each family:
-    for family in families:
-        for member in family.members:
-            member.target_value = family.fairness_criterion.target_value_for_binary(member.total_value)
 
+    def __init__(self, families:list, goods:list, compiled_families:dict):
+        self.goods = sorted(set(goods))
+        self.num_of_families = len(families)
+        self.table = weight_table(self.num_of_families)
+        self.table.extend(len(self.goods))
+        goods_key = tuple(self.goods)
+        self.members = []   # members[f] = list of (mask, desired good indices, cardinality, target_value)
+        for family in families:
+            key = (id(family), goods_key)
+            if key not in compiled_families:
+                compiled_families[key] = (family, self._compile(family))   # the family is kept, so that its id is not reused
+            self.members.append(compiled_families[key][1])
+        self.remaining = (1 << len(self.goods)) - 1
+        self.remaining_indices = list(range(len(self.goods)))
+        self.owned = [0] * self.num_of_families
+        self.family_index = 0
+
+    def _compile(self, family:Family)->list:
+        map_good_to_index = {good: index for index,good in enumerate(self.goods)}
+        family_members = []
+        for member, target_value in zip(family.members, target_values(family)):
+            indices = sorted([map_good_to_index[good] for good in member.desired_goods if good in map_good_to_index])
+            mask = 0
+            for index in indices:
+                mask |= 1 << index
+            family_members.append((mask, indices, member.cardinality, target_value))
+        return family_members
+
+    def step(self):
+        """
+        The current family picks the remaining good with the largest total weight (the first good in case of a tie).
+        """
+        remaining = self.remaining
+        owned = self.owned[self.family_index]
+        weights = self.table._weights
+        total_weights = [0] * len(self.goods)
+        for (mask, indices, cardinality, target_value) in self.members[self.family_index]:
+            r = (mask & remaining).bit_count()
+            s = target_value - (mask & owned).bit_count()
+            if 0 < s <= r:
+                weighted = weights[r*(r+1)//2 + s] * cardinality
+                if weighted:   # members with zero weight do not change the totals
+                    for index in indices:   # the totals of goods that are not remaining are ignored
+                        total_weights[index] += weighted
+        best_index = max(self.remaining_indices, key=total_weights.__getitem__)   # the first one in case of a tie
+        self.remaining_indices.remove(best_index)
+        self.owned[self.family_index] |= 1 << best_index
+        self.remaining ^= 1 << best_index
+        self.family_index = (self.family_index + 1) % self.num_of_families
+
+    def bundles(self)->list:
+        return [set([good for index,good in enumerate(self.goods) if owned & (1 << index)]) for owned in self.owned]
+
+
+
+def allocate_sharded(families:list, goods:list, num_of_shards:int=2)->list:
+    """
+    Run the RWAV protocol with the members of each family sharded across worker processes, for very large families.
+    Each shard keeps the r and s of its members, and updates them incrementally after each pick.
+    In each turn, each shard writes the total weight of each good among its members of the current family
+    into its own row of a shared-memory array, and the coordinator sums the rows and picks the good
+    (the first good in case of a tie, as in choose_good).
+    So the per-turn communication is a short message to each shard, and a single weight vector from each shard.
+    NOTE: the totals are summed in a different order than in allocate, so goods whose totals differ only by rounding errors
+    might be picked in a different order.
+    :param num_of_shards: the number of worker processes.
+    :return a list of bundles - a bundle per family.
 
+    >>> fairness_1_of_best_2 = fairness_criteria.OneOfBestC(2)
+    >>> family1 = Family([BinaryAgent({"w","x"},1),BinaryAgent({"x","y"},2),BinaryAgent({"y","z"},3), BinaryAgent({"z","w"},4)], fairness_1_of_best_2)
+    >>> family2 = Family([BinaryAgent({"w","z"},2),BinaryAgent({"z","y"},3)], fairness_1_of_best_2)
+    >>> bundles = allocate_sharded([family1, family2], "wxyz", num_of_shards=2)
+    >>> [sorted(bundle) for bundle in bundles]
+    [['x', 'z'], ['w', 'y']]
+    >>> bundles == allocate([family1, family2], "wxyz")
+    True
+    """
+    goods = sorted(set(goods))
+    num_of_goods = len(goods)
     num_of_families = len(families)
-    remaining_goods=set(goods)
-    bundles = [set() for f in families]
-
-    turn_index = 0
-    family_index = 0
-    while len(remaining_goods) > 0:
-        current_family = families[family_index]
-        current_family_bundle = bundles[family_index]
-        logger.info("\nTurn #{}: {}'s turn to pick a good from {}:".format(turn_index + 1, current_family.name, sorted(remaining_goods)))
-        g = choose_good(current_family, current_family_bundle, remaining_goods, num_of_families)
-        logger.info("{} picks {}".format(current_family.name, g))
-        current_family_bundle.add(g)
-        remaining_goods.remove(g)
-        turn_index += 1
-        family_index = (family_index + 1) % num_of_families
+    shared_weights = multiprocessing.RawArray("d", num_of_shards * num_of_goods)   # a row per shard
+    connections = []
+    processes = []
+    for shard in range(num_of_shards):
+        shard_families = []
+        for family in families:
+            members = family.members
+            shard_size = -(-len(members) // num_of_shards)
+            shard_families.append((members[shard * shard_size : (shard + 1) * shard_size], family.fairness_criterion))
+        (connection, worker_connection) = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=_shard_worker,
+            args=(worker_connection, shared_weights, shard, shard_families, goods, num_of_families))
+        process.start()
+        connections.append(connection)
+        processes.append(process)
+    try:
+        bundles = [set() for family in families]
+        remaining_indices = list(range(num_of_goods))
+        last_pick = None
+        for turn in range(num_of_goods):
+            family_index = turn % num_of_families
+            for connection in connections:
+                connection.send((family_index, last_pick))
+            for connection in connections:
+                connection.recv()
+            total_weights = [0] * num_of_goods
+            for shard in range(num_of_shards):
+                row = shared_weights[shard * num_of_goods : (shard + 1) * num_of_goods]
+                for index in remaining_indices:
+                    total_weights[index] += row[index]
+            best_index = max(remaining_indices, key=total_weights.__getitem__)   # the first one in case of a tie
+            logger.info("{} picks {}".format(families[family_index].name, goods[best_index]))
+            remaining_indices.remove(best_index)
+            bundles[family_index].add(goods[best_index])
+            last_pick = (family_index, best_index)
+    finally:
+        for connection in connections:
+            connection.send(None)
+        for process in processes:
+            process.join()
     return bundles
 
 
+def _shard_worker(connection, shared_weights, shard:int, shard_families:list, goods:list, num_of_families:int):
+    """
+    The loop of a single shard in allocate_sharded.
+    :param shard_families: a list with a pair (members, fairness_criterion) for each family - the members of this shard.
+    Each message from the coordinator is a pair (family_index, last_pick), where last_pick is a pair
+    (family_index, good_index) or None; the shard applies the last pick, writes the weights of the goods among
+    its members of the given family into its row, and replies. A None message ends the loop.
+    """
+    num_of_goods = len(goods)
+    map_good_to_index = {good: index for index,good in enumerate(goods)}
+    table = weight_table(num_of_families)
+    table.extend(num_of_goods)
+    weights = table._weights
+    indices = []        # indices[f][i] = the indices of the goods desired by member i of family f
+    cardinalities = []
+    rs = []             # the "r" of each member: the number of desired remaining goods
+    ss = []             # the "s" of each member: the value it still needs
+    wanters = [[] for good in goods]   # wanters[g] = list of (family_index, member_index) for the members who want goods[g]
+    for f,(members, fairness_criterion) in enumerate(shard_families):
+        family_indices = [sorted([map_good_to_index[good] for good in member.desired_goods if good in map_good_to_index])
+                          for member in members]
+        for i,member_indices in enumerate(family_indices):
+            for index in member_indices:
+                wanters[index].append((f, i))
+        indices.append(family_indices)
+        cardinalities.append([member.cardinality for member in members])
+        rs.append([len(member_indices) for member_indices in family_indices])
+        ss.append([fairness_criterion.target_value_for_binary(member.total_value) for member in members])
+    row_start = shard * num_of_goods
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+        (family_index, last_pick) = message
+        if last_pick is not None:
+            (picking_family, picked_index) = last_pick
+            for (f, i) in wanters[picked_index]:
+                rs[f][i] -= 1
+                if f == picking_family:
+                    ss[f][i] -= 1
+        total_weights = [0] * num_of_goods
+        for member_indices, cardinality, r, s in zip(indices[family_index], cardinalities[family_index], rs[family_index], ss[family_index]):
+            if 0 < s <= r:
+                weighted = weights[r*(r+1)//2 + s] * cardinality
+                if weighted:
+                    for index in member_indices:
+                        total_weights[index] += weighted
+        shared_weights[row_start : row_start + num_of_goods] = total_weights
+        connection.send(True)
+    connection.close()
 
 
 # templates for printing to logger:
@@ -63,27 +502,70 @@ AGENT_WEIGHT_FORMAT = "{0: <12}{1: <12}{2: <3}{3: <3}{4: <9}"
 GOODS_WEIGHT_FORMAT = "{0: <6}{1: <9}"
 
 
+def target_values(family:Family)->list:
+    """
+    Calculate the target value of each member of the given family, based on the number of goods it wants.
+
+    >>> target_values(Family([BinaryAgent("xyz"), BinaryAgent("w")], fairness_criteria.OneOfBestC(2)))
+    [1, 0]
+    """
+    if isinstance(family, ColumnarFamily):   # read the columns, without creating agent objects
+        return [family.fairness_criterion.target_value_for_binary(mask.bit_count()) for mask in family.masks]
+    return [family.fairness_criterion.target_value_for_binary(member.total_value) for member in family.members]
+
+
+def _desired_goods_and_cardinalities(family:Family):
+    """
+    Generates a pair (desired goods, cardinality) for each member of the given family.
+    For a ColumnarFamily, the pairs are read from its columns, without creating agent objects.
+    """
+    if isinstance(family, ColumnarFamily):
+        for mask, cardinality in zip(family.masks, family.cardinalities):
+            yield (family.goods_in_mask(mask), cardinality)
+    else:
+        for member in family.members:
+            yield (member.desired_goods, member.cardinality)
+
+
 
-def choose_good(family:Family, owned_goods:set, remaining_goods:set, num_of_families:int=2)->str:
+def choose_good(family:Family, owned_goods:set, remaining_goods:set, num_of_families:int=2, member_target_values:list=None)->str:
     """
     Calculate the good that the family chooses from the set of remaining goods.
     It uses weighted-approval-voting.
+    :param member_target_values: the target value of each member; by default, calculated by target_values(family).
 
     >>> agent1 = BinaryAgent({"x","y"})
     >>> agent2 = BinaryAgent({"z","w"})
     >>> fairness_1_of_best_2 = fairness_criteria.OneOfBestC(2)
     >>> family = Family([agent1,agent2], fairness_criterion=fairness_1_of_best_2, name="Family 1")
-    >>> agent1.target_value = agent2.target_value = 1
-    >>> choose_good(family, set(), {"x","y","z"})
+    >>> choose_good(family, set(), {"x","y","z"}, member_target_values=[1,1])
+    'z'
+    >>> columnar_family = ColumnarFamily([agent1,agent2], fairness_criterion=fairness_1_of_best_2, name="Family 1")
+    >>> choose_good(columnar_family, set(), {"x","y","z"})   # reads the columns, without creating agent objects
     'z'
     """
+    if member_target_values is None:
+        member_target_values = target_values(family)
     map_good_to_total_weight = defaultdict(int)
     choose_good.logger.info("Member weights:")
     choose_good.logger.info(AGENT_WEIGHT_FORMAT.format("","Desired set","r","s","weight"))
-    for member in family.members:
-        current_member_weight           = member_weight(member, member.target_value, owned_goods, remaining_goods, num_of_families)
-        for good in member.desired_goods:
-            map_good_to_total_weight[good] += current_member_weight * member.cardinality
+    if isinstance(family, ColumnarFamily):   # the values of binary members are popcounts of their masks
+        (remaining_mask, owned_mask) = (family.bundle_mask(remaining_goods), family.bundle_mask(owned_goods))
+        member_remaining_values = [(mask & remaining_mask).bit_count() for mask in family.masks]
+        member_should_get_values = [target_value - (mask & owned_mask).bit_count()
+                                    for mask, target_value in zip(family.masks, member_target_values)]
+    else:
+        members = list(family.members)
+        member_remaining_values = [member.value(remaining_goods) for member in members]   # the "r" of each member
+        member_should_get_values = [target_value - member.value(owned_goods)
+                                    for member, target_value in zip(members, member_target_values)]  # the "s" of each member
+    member_weights = weight_table(num_of_families).weights(member_remaining_values, member_should_get_values)
+    for (desired_goods, cardinality), current_member_weight in zip(_desired_goods_and_cardinalities(family), member_weights):
+        for good in desired_goods:
+            map_good_to_total_weight[good] += current_member_weight * cardinality
+    if member_weight.logger.isEnabledFor(logging.INFO):
+        for member, r, s, current_member_weight in zip(family.members, member_remaining_values, member_should_get_values, member_weights):
+            log_member_weight(member, r, s, current_member_weight)
 
     choose_good.logger.info("Remaining good weights:")
     choose_good.logger.info(GOODS_WEIGHT_FORMAT.format("","Weight"))
@@ -107,14 +589,18 @@ def member_weight(member: BinaryAgent, target_value: int, owned_goods: set, rema
     member_remaining_value = member.value(remaining_goods)  # the "r" of the member
     member_current_value = member.value(owned_goods)
     member_should_get_value = target_value - member_current_value  # the "s" of the member
-    the_member_weight = weight(member_remaining_value, member_should_get_value, num_of_families)
+    the_member_weight = weight_table(num_of_families).weight(member_remaining_value, member_should_get_value)
+    log_member_weight(member, member_remaining_value, member_should_get_value, the_member_weight)
+    return the_member_weight
+member_weight.logger = logging.getLogger("member_weight")
+
+
+def log_member_weight(member: BinaryAgent, member_remaining_value:int, member_should_get_value:int, the_member_weight:float):
     members_string = "{} member{}".format(member.cardinality, plural(member.cardinality))
     desired_goods_string = ",".join(sorted(member.desired_goods))
     member_weight.logger.info(AGENT_WEIGHT_FORMAT.format(
         members_string, desired_goods_string,
         member_remaining_value, member_should_get_value, the_member_weight))
-    return the_member_weight
-member_weight.logger = logging.getLogger("member_weight")
 
 
 
@@ -144,6 +630,10 @@ def balance(r:int, s:int, k:int=2)->float:
     1
     >>> balance(0,1,k=3)
     0
+    >>> balance(3,2,k=3)
+    0
+    >>> balance(5,2,k=3)
+    0.375
     """
     if (s<=0):
         return 1
@@ -154,11 +644,15 @@ def balance(r:int, s:int, k:int=2)->float:
         val2 = balance(r-2,s-1)
         return min(val1,val2)
     elif k>2:
-        if s>1:
-            raise(ValueError("When there are more than 2 families, we do not know how to calculate weights for members with s>1"))
-        elif s==1:
+        if s==1:
             Lk = math.pow(2,1/(k-1))
             return 1 - 1/math.pow(Lk,r)
+        else:
+            # In each round, the family picks one good and the other k-1 families pick k-1 goods.
+            # With k=2, this is the recurrence above; with s=1, it is solved by the closed formula above.
+            val1 = (balance(r-(k-1),s,k)+balance(r-1,s-1,k))/2
+            val2 = balance(r-k,s-1,k)
+            return min(val1,val2)
     raise(ValueError("Illegal values: r={} s={} k={}").format(r,s,k))
 
 
@@ -188,6 +682,120 @@ def weight(r:int, s:int, k:int=2)->float:
     return balance(r, s, k) - balance(r - 1, s, k)
 
 
+class WeightTable:
+    """
+    A table of the voting weights w_k(r,s) for a fixed number of families k,
+    computed by dynamic programming over the (r,s) states, in increasing order of r.
+    The values are identical to those of the function weight(r,s,k).
+    The table is stored compactly in a triangular array (0 <= s <= r),
+    and it is extended on demand when a larger r is needed.
+
+    >>> table = WeightTable(k=2)
+    >>> table.weight(1,1), table.weight(4,2), table.weight(4,3), table.weight(4,-2), table.weight(0,2)
+    (0.5, 0.25, 0.0, 0, 0)
+    >>> table.weights([1,4,4], [1,2,3])
+    [0.5, 0.25, 0.0]
+    >>> all([WeightTable(k).weight(r,s) == weight(r,s,k) for k in [2,3,5] for r in range(12) for s in range(r+1)])
+    True
+    """
+
+    def __init__(self, k:int, max_r:int=32):
+        self.k = k
+        self.max_r = -1
+        self.balances = array("d")   # balances[r*(r+1)//2 + s] = B_k(r,s), for 0 <= s <= r <= max_r
+        self._weights = array("d")   # _weights[r*(r+1)//2 + s] = w_k(r,s),  for 0 <= s <= r <= max_r
+        self.extend(max_r)
+
+    def balance(self, r:int, s:int)->float:
+        if s<=0:
+            return 1
+        if s>r:
+            return 0
+        return self.balances[r*(r+1)//2 + s]
+
+    def extend(self, max_r:int):
+        """
+        Extends the table to all states with r <= max_r.
+        """
+        k = self.k
+        for r in range(self.max_r+1, max_r+1):
+            self.balances.append(1)   # s=0
+            for s in range(1, r+1):
+                if k>2 and s==1:
+                    self.balances.append(balance(r, s, k))
+                else:
+                    val1 = (self.balance(r-(k-1),s)+self.balance(r-1,s-1))/2
+                    val2 = self.balance(r-k,s-1)
+                    self.balances.append(min(val1,val2))
+            for s in range(0, r+1):
+                self._weights.append(self.balance(r,s) - self.balance(r-1,s))
+            self.max_r = r
+
+    def weight(self, r:int, s:int)->float:
+        if s<=0 or s>r:
+            return 0
+        if r>self.max_r:
+            self.extend(max(r, 2*self.max_r))
+        return self._weights[r*(r+1)//2 + s]
+
+    def weights(self, rs:list, ss:list)->list:
+        """
+        Looks up the weights of several members at once (e.g. all members of a family in a single turn).
+        :param rs: the r of each member.
+        :param ss: the s of each member.
+        """
+        if len(rs)>0 and max(rs)>self.max_r:
+            self.extend(max(max(rs), 2*self.max_r))
+        table = self._weights
+        return [table[r*(r+1)//2 + s] if 0<s<=r else 0 for r,s in zip(rs,ss)]
+
+    def save(self, path:str):
+        """
+        Saves the table to a file, so that it can be shared with other runs and processes.
+        """
+        with open(path, "wb") as file:
+            array("q", [self.k, self.max_r]).tofile(file)
+            self.balances.tofile(file)
+            self._weights.tofile(file)
+
+    @staticmethod
+    def load(path:str)->'WeightTable':
+        """
+        Loads a table saved by WeightTable.save, and makes it the table used by weight_table(k).
+
+        >>> import tempfile, os
+        >>> directory = tempfile.TemporaryDirectory()
+        >>> WeightTable(k=4, max_r=10).save(os.path.join(directory.name, "weights4"))
+        >>> table = WeightTable.load(os.path.join(directory.name, "weights4"))
+        >>> table.max_r, table.weight(10,3) == weight(10,3,k=4), weight_table(4) is table
+        (10, True, True)
+        >>> directory.cleanup()
+        """
+        table = WeightTable.__new__(WeightTable)
+        with open(path, "rb") as file:
+            header = array("q")
+            header.fromfile(file, 2)
+            (table.k, table.max_r) = header
+            size = (table.max_r+1)*(table.max_r+2)//2
+            table.balances = array("d")
+            table.balances.fromfile(file, size)
+            table._weights = array("d")
+            table._weights.fromfile(file, size)
+        _weight_tables[table.k] = table
+        return table
+
+
+_weight_tables = {}
+
+def weight_table(k:int)->WeightTable:
+    """
+    Returns the weight table for k families. It is computed once per process (and inherited by forked processes).
+    """
+    if k not in _weight_tables:
+        _weight_tables[k] = WeightTable(k)
+    return _weight_tables[k]
+
+
 if __name__ == "__main__":
     import doctest
     (failures,tests) = doctest.testmod(report=True)
@@ -7,11 +7,18 @@ See: https://arxiv.org/abs/1709.02564 Conjecture 3.12 for details.
 """
 
 import fairness_criteria
+from fairness_criteria import FairnessCriterion
 from agents import BinaryAgent
 from families import Family
-import copy, itertools, utils
+import copy, heapq, itertools, json, math, os, utils
+from collections import Counter
+from fractions import Fraction
+from array import array
 from partitions import powerset, partitions_to_exactly_c
 import twothirds_protocol
+import exhaustive_protocol
+from happiness_matrix import HappinessMatrix, has_additive_members
+from happiness_table_store import HappinessTableStore
 
 fairness_1_of_best_2 = fairness_criteria.OneOfBestC(2)
 
@@ -61,7 +68,22 @@ FRACTION_THRESHOLD = 2/3
 def is_conjecture_true_for(family1:Family, family2:Family, goods:set)->bool:
     """
     Checks if the 2/3 conjecture true for the given two families.
+
+    >>> family = Family([BinaryAgent("xy",1), BinaryAgent("yz",1), BinaryAgent("xz",1)], fairness_1_of_best_2)
+    >>> is_conjecture_true_for(family, family, "xyz")
+    True
+    >>> family = Family([BinaryAgent("xy",1), BinaryAgent("yz",1), BinaryAgent("xz",1)], fairness_criteria.EnvyFreeExceptC(0))
+    >>> is_conjecture_true_for(family, family, "xyz")
+    True
     """
+    if exhaustive_protocol.is_supported([family1, family2]):
+        # Both orientations of each 2-partition are visited in a Gray-code order, with incremental happiness counts.
+        return exhaustive_protocol.fair_allocation([family1, family2], list(goods), FRACTION_THRESHOLD, nonempty_bundles=True) is not None
+    if has_additive_members([family1, family2]):
+        for allocation in partitions_to_exactly_c(list(goods), c=2):
+            if HappinessMatrix([family1, family2], allocation).assignment(FRACTION_THRESHOLD) is not None:
+                return True # Allocation (0,1) or (1,0) is 2/3-democratic fair
+        return False
     for allocation in partitions_to_exactly_c(list(goods), c=2):
         if family1.fraction_of_happy_members(allocation[0], allocation)>=FRACTION_THRESHOLD \
             and family2.fraction_of_happy_members(allocation[1], allocation)>=FRACTION_THRESHOLD:
@@ -72,22 +94,484 @@ def is_conjecture_true_for(family1:Family, family2:Family, goods:set)->bool:
     return False
 
 
-def check_conjecture_for(goods:str):
+class FamilyIndex:
+    """
+    A precomputed index of all possible families of agents that want exactly two goods,
+    with at most one agent of each type.
+
+    Each agent type (a pair of goods) is represented by a bit, and each family by an integer mask over the agent types.
+    The families are numbered in the same order as all_families, so family_masks[i] corresponds to the family named i+1.
+    Agent and Family objects are created only on demand, e.g. for printing a counterexample.
+
+    >>> index = FamilyIndex("xyz")
+    >>> index.agent_types
+    [('x', 'y'), ('x', 'z'), ('y', 'z')]
+    >>> list(index.total_values), list(index.targets)
+    ([2, 2, 2], [1, 1, 1])
+    >>> index.num_of_families
+    7
+    >>> [bin(mask) for mask in index.family_masks]
+    ['0b1', '0b10', '0b100', '0b11', '0b101', '0b110', '0b111']
+    >>> index.family(3)
+    4 seeks one-of-best-2 and has:
+     * 1 binary agent  who want ['x', 'y']
+     * 1 binary agent  who want ['x', 'z']
+    >>> bin(index.happy_types[index.bundle_mask("x")])
+    '0b11'
+    """
+
+    def __init__(self, goods:list, fairness_criterion:FairnessCriterion=fairness_1_of_best_2):
+        self.goods = list(goods)
+        self.fairness_criterion = fairness_criterion
+        self.map_good_to_bit = {good: 1 << index for index,good in enumerate(self.goods)}
+        self.agent_types = list(itertools.combinations(self.goods, 2))
+        self.agent_type_masks = [self.bundle_mask(desired_goods) for desired_goods in self.agent_types]
+        self.total_values = array("q", [len(desired_goods) for desired_goods in self.agent_types])
+        self.targets = array("q", [fairness_criterion.threshold_for_agent(BinaryAgent(desired_goods, 1))
+                                   for desired_goods in self.agent_types])
+        self._family_masks = None
+        # happy_types[bundle_mask] = the mask of agent types that are happy with the given bundle.
+        self.happy_types = [
+            sum([1 << t for t,type_mask in enumerate(self.agent_type_masks)
+                 if (type_mask & bundle_mask).bit_count() >= self.targets[t]])
+            for bundle_mask in range(1 << len(self.goods))]
+
+    @property
+    def family_masks(self)->list:
+        """
+        The masks of all families, in the order of all_families.
+        They are created on first use, so that an index of many goods can be used without its families.
+        """
+        if self._family_masks is None:
+            self._family_masks = [sum([1 << t for t in types]) for types in powerset(range(len(self.agent_types)))][1:]
+        return self._family_masks
+
+    @property
+    def num_of_families(self)->int:
+        return (1 << len(self.agent_types)) - 1
+
+    def bundle_mask(self, bundle:set)->int:
+        mask = 0
+        for good in bundle:
+            mask |= self.map_good_to_bit[good]
+        return mask
+
+    def family(self, family_index:int)->Family:
+        """
+        Creates a Family object for the family in the given index.
+        """
+        family_mask = self.family_masks[family_index]
+        members = [BinaryAgent(desired_goods, 1) for t,desired_goods in enumerate(self.agent_types) if family_mask & (1 << t)]
+        return Family(members, self.fairness_criterion, name=family_index + 1)
+
+    def happy_counts(self, family_mask:int)->bytes:
+        """
+        Returns the number of happy members of the given family with each bundle, indexed by the bundle mask.
+        The counts are kept in one byte per bundle (as in a happiness-table store), so the family can have at most 255 members.
+
+        >>> index = FamilyIndex("xyz")
+        >>> list(index.happy_counts(0b111))
+        [0, 2, 2, 3, 2, 3, 3, 3]
+        >>> index.happy_counts((1 << 256) - 1)
+        Traceback (most recent call last):
+        ...
+        ValueError: The happy counts are kept in one byte per bundle, so a family can have at most 255 members, not 256
+        """
+        num_of_members = family_mask.bit_count()
+        if num_of_members > 255:
+            raise ValueError("The happy counts are kept in one byte per bundle, so a family can have at most 255 members, not {}".format(num_of_members))
+        return bytes([(family_mask & happy_types).bit_count() for happy_types in self.happy_types])
+
+    def fair_bundles(self, family_mask:int, threshold:float=None, happy_counts:bytes=None)->int:
+        """
+        Returns a mask over all bundle masks: bit b is set iff at least a fraction "threshold" of the family members
+        (by default, FRACTION_THRESHOLD) are happy with the bundle whose mask is b.
+        :param happy_counts: the happy counts of the family, if they were already calculated (e.g. from a happiness-table store).
+
+        >>> index = FamilyIndex("xyz")
+        >>> bin(index.fair_bundles(0b111))   # 2/3 of the members are happy with any non-empty bundle
+        '0b11111110'
+        >>> bin(index.fair_bundles(0b111, threshold=1))
+        '0b11101000'
+        """
+        if threshold is None:
+            threshold = FRACTION_THRESHOLD
+        if happy_counts is None:
+            happy_counts = self.happy_counts(family_mask)
+        num_of_members = family_mask.bit_count()
+        result = 0
+        for bundle_mask,num_of_happy in enumerate(happy_counts):
+            if num_of_happy / num_of_members >= threshold:
+                result |= 1 << bundle_mask
+        return result
+
+    def complement_bundles(self, bundles:int)->int:
+        """
+        Maps a mask over bundle masks to the mask over their complements.
+        """
+        all_goods = (1 << len(self.goods)) - 1
+        result = 0
+        for bundle_mask in range(1 << len(self.goods)):
+            if bundles & (1 << bundle_mask):
+                result |= 1 << (all_goods ^ bundle_mask)
+        return result
+
+
+def happiness_table_store(index:FamilyIndex, directory:str, read_only:bool=False)->HappinessTableStore:
+    """
+    Returns the store of the happy counts of all families in the given index,
+    keyed by the number of goods and the fairness criterion.
+    """
+    key = "{}goods-{}".format(len(index.goods), index.fairness_criterion.name)
+    return HappinessTableStore(directory, key, num_of_rows=index.num_of_families, row_size=1 << len(index.goods), read_only=read_only)
+
+
+def complete_happiness_table_store(index:FamilyIndex, directory:str)->HappinessTableStore:
+    """
+    Builds the store of the happy counts of all families in the given index (or resumes an interrupted build),
+    and returns it reopened read-only, so that its rows can be used without copying them.
+    NOTE: the rows must not be used after the store is closed.
+    """
+    store = happiness_table_store(index, directory)
+    store.build(lambda family_index: index.happy_counts(index.family_masks[family_index]))
+    store.close()
+    return happiness_table_store(index, directory, read_only=True)
+
+
+def check_conjecture_for(goods:str, threshold:float=None, store_directory:str=None):
     """
     Checks  the 2/3 conjecture for the given set of goods.
+    :param threshold: the fraction of happy members required in each family (by default, FRACTION_THRESHOLD).
+    :param store_directory: an optional directory of a happiness-table store.
+       The happy counts of all families are built there once (or resumed), and reused by later runs with any threshold.
+
+    >>> check_conjecture_for("wxyz")
+    Checking the 2/3 conjecture for 4 goods...
+    The 2/3 conjecture is true for 4 goods
+    >>> import tempfile
+    >>> directory = tempfile.TemporaryDirectory()
+    >>> check_conjecture_for("wxyz", store_directory=directory.name)
+    Checking the 2/3 conjecture for 4 goods...
+    The 2/3 conjecture is true for 4 goods
+    >>> check_conjecture_for("wxyz", threshold=0.7, store_directory=directory.name)
+    Checking the 0.7 conjecture for 4 goods...
+    The 0.7 conjecture is false for the following families:
+    24 seeks one-of-best-2 and has:
+     * 1 binary agent  who want ['w', 'x']
+     * 1 binary agent  who want ['w', 'y']
+     * 1 binary agent  who want ['x', 'z']
+    26 seeks one-of-best-2 and has:
+     * 1 binary agent  who want ['w', 'x']
+     * 1 binary agent  who want ['w', 'z']
+     * 1 binary agent  who want ['x', 'y']
+    >>> directory.cleanup()
+    """
+    if threshold is None:
+        threshold = FRACTION_THRESHOLD
+    name = "2/3" if threshold == 2/3 else str(threshold)
+    print("Checking the {} conjecture for {} goods...".format(name, len(goods)))
+    index = FamilyIndex(goods)
+    if store_directory is None:
+        fair_bundles = [index.fair_bundles(family_mask, threshold) for family_mask in index.family_masks]
+    else:
+        store = complete_happiness_table_store(index, store_directory)
+        fair_bundles = [index.fair_bundles(family_mask, threshold, happy_counts=store.row(family_index))
+                        for family_index, family_mask in enumerate(index.family_masks)]
+        store.close()
+    all_goods = (1 << len(index.goods)) - 1
+    # Partitions into two non-empty bundles: the bundle masks except the empty bundle and the full bundle.
+    proper_bundles = ((1 << (1 << len(index.goods))) - 1) ^ 1 ^ (1 << all_goods)
+    fair_bundles = [bundles & proper_bundles for bundles in fair_bundles]
+    fair_complements = [index.complement_bundles(bundles) for bundles in fair_bundles]
+    for i in range(index.num_of_families):
+        for j in range(i + 1, index.num_of_families):
+            if fair_bundles[i] & fair_complements[j] == 0:
+                print("The {} conjecture is false for the following families:".format(name))
+                print(index.family(i))
+                print(index.family(j))
+                return
+            else:
+                logger.info("Conjecture is true for family {} vs family {}".format(i + 1, j + 1))
+    print("The {} conjecture is true for {} goods".format(name, len(goods)))
+
+
+def best_fraction(counts1:bytes, num_of_members1:int, sorted_bundles1:list, counts2:bytes, num_of_members2:int)->Fraction:
+    """
+    Calculates the largest fraction that is achievable for two families: the maximum, over all partitions into two
+    non-empty bundles, of the minimum fraction of happy members of the two families (the first family gets the first bundle).
+    :param counts1, counts2: the happy counts of each family, indexed by the bundle mask (see FamilyIndex.happy_counts).
+    :param num_of_members1, num_of_members2: the number of members in each family.
+    :param sorted_bundles1: the non-empty, non-full bundle masks, sorted by decreasing counts1.
+       A bundle is examined only if the fraction of the first family with it may beat the best fraction found so far,
+       so the scan stops at the first bundle that cannot.
+
+    >>> index = FamilyIndex("xyz")
+    >>> counts = index.happy_counts(0b111)
+    >>> best_fraction(counts, 3, sorted_bundles(counts, 3), counts, 3)
+    Fraction(2, 3)
+    >>> counts1 = index.happy_counts(0b001)   # a single agent, who wants x and y
+    >>> best_fraction(counts1, 1, sorted_bundles(counts1, 3), counts, 3)   # e.g. {y} and {x,z}
+    Fraction(1, 1)
+    """
+    all_goods = len(counts1) - 1
+    best_value, best_bundle = -1, None
+    for bundle in sorted_bundles1:
+        fraction1 = counts1[bundle] / num_of_members1
+        if fraction1 <= best_value:
+            break   # the following bundles cannot beat the best one
+        fraction2 = counts2[all_goods ^ bundle] / num_of_members2
+        value = fraction1 if fraction1 < fraction2 else fraction2
+        if value > best_value:
+            best_value, best_bundle = value, bundle
+            if best_value >= 1:
+                break
+    return min(Fraction(counts1[best_bundle], num_of_members1), Fraction(counts2[all_goods ^ best_bundle], num_of_members2))
+
+
+def sorted_bundles(counts:bytes, num_of_goods:int)->list:
+    """
+    :return: the bundle masks of all partitions into two non-empty bundles, sorted by decreasing happy counts.
+    """
+    return sorted(range(1, (1 << num_of_goods) - 1), key=lambda bundle: -counts[bundle])
+
+
+def conjecture_statistics(goods:str, output_directory:str, num_of_worst_pairs:int=10, store_directory:str=None):
+    """
+    Calculates the best achievable fraction (see best_fraction) of every pair of different families,
+    so that the conjecture can be checked for every threshold from a single run.
+    After each family, the histogram of the best fractions and the worst pairs found so far are written together
+    to statistics.json in the output directory (in a single atomic replacement); an interrupted run resumes from this file.
+    :param num_of_worst_pairs: the number of pairs with the smallest best fractions to keep.
+    :param store_directory: an optional directory of a happiness-table store (see check_conjecture_for).
+    :return: a pair (histogram, worst_pairs). The histogram is a Counter that maps each fraction to its number of pairs;
+       worst_pairs is a list of (fraction, family_name, family_name), from worst to best.
+
+    >>> import tempfile
+    >>> directory = tempfile.TemporaryDirectory()
+    >>> (histogram, worst_pairs) = conjecture_statistics("wxyz", directory.name, num_of_worst_pairs=2)
+    >>> sorted(histogram.items())
+    [(Fraction(2, 3), 6), (Fraction(3, 4), 90), (Fraction(4, 5), 126), (Fraction(5, 6), 40), (Fraction(1, 1), 1691)]
+    >>> worst_pairs
+    [(Fraction(2, 3), 24, 26), (Fraction(2, 3), 25, 32)]
+    >>> pairs_below(histogram, 2/3), pairs_below(histogram, 0.7), pairs_below(histogram, 1)
+    (0, 6, 262)
+    >>> statistics = json.load(open(os.path.join(directory.name, "statistics.json")))
+    >>> statistics["num_of_completed_families"], statistics["histogram"]["2/3"], statistics["worst_pairs"][0]
+    (63, 6, ['2/3', 24, 26])
+    >>> conjecture_statistics("wxyz", directory.name, num_of_worst_pairs=2) == (histogram, worst_pairs)   # resumed from the file
+    True
+    >>> store_directory = tempfile.TemporaryDirectory()
+    >>> conjecture_statistics("wxyz", store_directory.name, num_of_worst_pairs=2, store_directory=store_directory.name) == (histogram, worst_pairs)
+    True
+    >>> store_directory.cleanup()
+    >>> directory.cleanup()
+    """
+    index = FamilyIndex(goods)
+    statistics_path = os.path.join(output_directory, "statistics.json")
+    histogram = Counter()
+    worst_pairs_heap = []   # a max-heap (by negated keys) of the worst pairs found so far
+    first_family = 0
+    if os.path.exists(statistics_path):
+        with open(statistics_path) as file:
+            saved = json.load(file)
+        if saved["goods"] == list(index.goods):
+            first_family = saved["num_of_completed_families"]
+            histogram = Counter({Fraction(fraction): count for fraction,count in saved["histogram"].items()})
+            worst_pairs_heap = [(-Fraction(fraction), -i, -j) for (fraction, i, j) in saved["worst_pairs"]]
+            heapq.heapify(worst_pairs_heap)
+            logger.info("Resuming after {} families".format(first_family))
+
+    if store_directory is None:
+        store = None
+        all_counts = [index.happy_counts(family_mask) for family_mask in index.family_masks]
+    else:
+        store = complete_happiness_table_store(index, store_directory)
+        all_counts = [store.row(family_index) for family_index in range(index.num_of_families)]
+    sizes = [family_mask.bit_count() for family_mask in index.family_masks]
+
+    for i in range(first_family, index.num_of_families):
+        sorted_bundles_i = sorted_bundles(all_counts[i], len(index.goods))
+        for j in range(i + 1, index.num_of_families):
+            fraction = best_fraction(all_counts[i], sizes[i], sorted_bundles_i, all_counts[j], sizes[j])
+            histogram[fraction] += 1
+            key = (-fraction, -(i + 1), -(j + 1))
+            if len(worst_pairs_heap) < num_of_worst_pairs:
+                heapq.heappush(worst_pairs_heap, key)
+            elif key > worst_pairs_heap[0]:
+                heapq.heapreplace(worst_pairs_heap, key)
+        # The histogram and the worst pairs are written in a single file, so that they always cover the same families.
+        _write_json(statistics_path, {"goods": list(index.goods), "num_of_completed_families": i + 1,
+            "histogram": {str(fraction): count for fraction,count in sorted(histogram.items())},
+            "worst_pairs": [(str(fraction), i, j) for (fraction, i, j) in _worst_pairs(worst_pairs_heap)]})
+    if store is not None:
+        all_counts = None   # the views of the rows must be released before the store is closed
+        store.close()
+    return (histogram, _worst_pairs(worst_pairs_heap))
+
+
+def _worst_pairs(worst_pairs_heap:list)->list:
+    return sorted([(-fraction, -i, -j) for (fraction, i, j) in worst_pairs_heap])
+
+
+def _write_json(path:str, data):
+    # Written to a temporary file and then renamed, so that an interrupted run never leaves a partial file.
+    with open(path + ".tmp", "w") as file:
+        json.dump(data, file)
+    os.replace(path + ".tmp", path)
+
+
+def pairs_below(histogram:Counter, threshold:float)->int:
+    """
+    :return: the number of family pairs for which no allocation gives a fraction of at least "threshold" to both families;
+       the conjecture holds for the threshold iff it is 0.
+    """
+    return sum([count for fraction,count in histogram.items() if fraction < threshold])
+
+
+class MultiplicityFamilyIndex:
+    """
+    An index of families of agents that want exactly two goods, with any number of agents of each type,
+    up to a given total number of members.
+    Each family is represented by its multiplicity vector - the number of agents of each type.
+
+    The families are reduced before the pair check:
+    * Families with the same happiness profile (the fraction of happy members with each bundle),
+      e.g. a family and its multiples, are kept only once (the one with the fewest members).
+    * A family whose profile dominates another one (it has at least the same fraction of happy members with every bundle)
+      is pruned: every pair that contains it is at least as easy as the same pair with the dominated family.
+    * Permuting the goods does not change the best fraction of a pair, so the first family of each pair is only
+      a representative of its orbit (the family whose profile is the smallest under all permutations of the goods).
+
+    >>> index = MultiplicityFamilyIndex("xyz", max_members=3)
+    >>> index.num_of_vectors, index.num_of_families
+    (19, 13)
+    >>> index.vectors[:6]
+    [(1, 0, 0), (0, 1, 0), (0, 0, 1), (1, 1, 0), (1, 0, 1), (0, 1, 1)]
+    >>> (2, 2, 2) in index.vectors      # the same profile as (1, 1, 1)
+    False
+    >>> (2, 0, 0) in index.vectors
+    False
+    >>> [list(index.happy_counts[i]) for i in [0, 9]]
+    [[0, 1, 1, 1, 0, 1, 1, 1], [0, 2, 2, 3, 2, 3, 3, 3]]
+    >>> index.representatives
+    [2, 5, 9, 12]
+    >>> index.family(9)
+    10 seeks one-of-best-2 and has:
+     * 1 binary agent  who want ['x', 'y']
+     * 1 binary agent  who want ['x', 'z']
+     * 1 binary agent  who want ['y', 'z']
+    """
+
+    def __init__(self, goods:list, max_members:int, fairness_criterion:FairnessCriterion=fairness_1_of_best_2):
+        """
+        :param goods: the goods.
+        :param max_members: the largest total number of members in a family.
+        """
+        self.family_index = FamilyIndex(goods, fairness_criterion)
+        self.goods = self.family_index.goods
+        self.max_members = max_members
+        num_of_goods = len(self.goods)
+        num_of_types = len(self.family_index.agent_types)
+        # happy_type_lists[bundle_mask] = the list of agent types that are happy with the given bundle.
+        happy_type_lists = [[t for t in range(num_of_types) if happy_types & (1 << t)]
+                            for happy_types in self.family_index.happy_types]
+
+        # Keep the first (smallest) family of each profile:
+        map_profile_to_vector = {}
+        self.num_of_vectors = 0
+        for num_of_members in range(1, max_members + 1):
+            for types in itertools.combinations_with_replacement(range(num_of_types), num_of_members):
+                self.num_of_vectors += 1
+                vector = [0] * num_of_types
+                for t in types:
+                    vector[t] += 1
+                counts = [sum([vector[t] for t in happy_type_list]) for happy_type_list in happy_type_lists]
+                divisor = math.gcd(num_of_members, *counts)
+                profile = (num_of_members // divisor,) + tuple([count // divisor for count in counts])
+                if profile not in map_profile_to_vector:
+                    map_profile_to_vector[profile] = (tuple(vector), array("q", counts))
+        families = list(map_profile_to_vector.values())
+        logger.info("{} multiplicity vectors, {} different profiles".format(self.num_of_vectors, len(families)))
+
+        # Prune the families whose profile dominates another profile:
+        proper_bundles = range(1, (1 << num_of_goods) - 1)
+        def dominates(family1, family2)->bool:
+            (vector1, counts1), (vector2, counts2) = family1, family2
+            (size1, size2) = (sum(vector1), sum(vector2))
+            return all([counts1[b] * size2 >= counts2[b] * size1 for b in proper_bundles])
+        families = [family1 for family1 in families
+                    if not any([family2 is not family1 and dominates(family1, family2) for family2 in families])]
+        self.vectors = [vector for (vector, counts) in families]
+        self.happy_counts = [counts for (vector, counts) in families]
+        self.sizes = [sum(vector) for vector in self.vectors]
+        self.num_of_families = len(families)
+        logger.info("{} families remain after dominance pruning".format(self.num_of_families))
+
+        # Find a representative of each orbit under permutations of the goods:
+        bundle_permutations = []
+        for permutation in itertools.permutations(range(num_of_goods)):
+            bundle_permutations.append([sum([1 << permutation[g] for g in range(num_of_goods) if bundle & (1 << g)])
+                                        for bundle in range(1 << num_of_goods)])
+        self.representatives = []
+        for f,counts in enumerate(self.happy_counts):
+            profile = [Fraction(count, self.sizes[f]) for count in counts]
+            permuted_profiles = []
+            for bundle_permutation in bundle_permutations:
+                permuted_profile = [None] * len(profile)
+                for bundle,fraction in enumerate(profile):
+                    permuted_profile[bundle_permutation[bundle]] = fraction
+                permuted_profiles.append(permuted_profile)
+            if profile == min(permuted_profiles):
+                self.representatives.append(f)
+        logger.info("{} orbit representatives".format(len(self.representatives)))
+
+    def family(self, family_index:int)->Family:
+        """
+        Creates a Family object for the family in the given index.
+        """
+        members = [BinaryAgent(desired_goods, multiplicity)
+                   for desired_goods,multiplicity in zip(self.family_index.agent_types, self.vectors[family_index])
+                   if multiplicity > 0]
+        return Family(members, self.family_index.fairness_criterion, name=family_index + 1)
+
+
+def check_conjecture_with_multiplicities(goods:str, max_members:int, threshold:float=None):
+    """
+    Checks the 2/3 conjecture for the given set of goods, and families with up to max_members members
+    (with any number of agents of each type).
+    :param threshold: the fraction of happy members required in each family (by default, FRACTION_THRESHOLD).
+
+    >>> check_conjecture_with_multiplicities("wxyz", max_members=5)
+    Checking the 2/3 conjecture for 4 goods and up to 5 members...
+    The 2/3 conjecture is true for 4 goods and up to 5 members
+    >>> check_conjecture_with_multiplicities("xyz", max_members=3, threshold=0.7)
+    Checking the 0.7 conjecture for 3 goods and up to 3 members...
+    The 0.7 conjecture is false for the following families:
+    10 seeks one-of-best-2 and has:
+     * 1 binary agent  who want ['x', 'y']
+     * 1 binary agent  who want ['x', 'z']
+     * 1 binary agent  who want ['y', 'z']
+    10 seeks one-of-best-2 and has:
+     * 1 binary agent  who want ['x', 'y']
+     * 1 binary agent  who want ['x', 'z']
+     * 1 binary agent  who want ['y', 'z']
     """
-    print("Checking the 2/3 conjecture for {} goods...".format(len(goods)))
-    for family1 in all_families(goods):
-        for family2 in all_families(goods):
-            if family1.name < family2.name:
-                if not is_conjecture_true_for(family1,family2, goods):
-                    print("The 2/3 conjecture is false for the following families:")
-                    print(family1)
-                    print(family2)
-                    return
-                else:
-                    logger.info("Conjecture is true for family {} vs family {}".format(family1.name, family2.name))
-    print("The 2/3 conjecture is true for {} goods".format(len(goods)))
+    if threshold is None:
+        threshold = FRACTION_THRESHOLD
+    name = "2/3" if threshold == 2/3 else str(threshold)
+    print("Checking the {} conjecture for {} goods and up to {} members...".format(name, len(goods), max_members))
+    index = MultiplicityFamilyIndex(goods, max_members)
+    for i in index.representatives:
+        sorted_bundles_i = sorted_bundles(index.happy_counts[i], len(index.goods))
+        for j in range(index.num_of_families):
+            if best_fraction(index.happy_counts[i], index.sizes[i], sorted_bundles_i, index.happy_counts[j], index.sizes[j]) < threshold:
+                print("The {} conjecture is false for the following families:".format(name))
+                print(index.family(i))
+                print(index.family(j))
+                return
+            else:
+                logger.info("Conjecture is true for family {} vs family {}".format(i + 1, j + 1))
+    print("The {} conjecture is true for {} goods and up to {} members".format(name, len(goods), max_members))
 
 
 if __name__ == "__main__":
@@ -99,4 +583,5 @@ if __name__ == "__main__":
     # check_conjecture_for("wxyz")
     # check_conjecture_for("vwxyz")
     # check_conjecture_for("uvwxyz")
+    # check_conjecture_with_multiplicities("wxyz", max_members=6)
 
@@ -11,6 +11,7 @@ from collections import defaultdict
 import fairness_criteria
 from agents import *
 from families import Family
+from allocation_state import AllocationState
 
 import logging, sys
 logger = logging.getLogger(__name__)
@@ -32,40 +33,127 @@ def allocate(families:list, goods: set):
     2
     >>> len(bundle2)
     2
+    >>> family2 = Family([BinaryAgent("wx",1),BinaryAgent("yz",1),BinaryAgent("xy",1)], fairness_criteria.EnvyFreeExceptC(1))
+    >>> sorted([len(bundle) for bundle in allocate([family2, family2], "wxyz")])   # a criterion without a target value
+    [2, 2]
     """
-    if len(families)!=2:
-        raise("Currently only 2 families are supported")
-
-    goods = set(goods)
-    bundles = [set(), goods] # start, arbitrarily, with an allocation that gives all goods to family 2.
-
-    total_num_of_members = sum([family.num_of_members for family in families])
-    num_of_iterations = 2*total_num_of_members   # this should be sufficient to convergence if the families are identical
-    for iteration in range(num_of_iterations):
-        # If there is a good $g\in G_1$ for which $q_0(g) > q_1(g)$, move $g$ to $G_2$.
-        logger.info("Currently, {} holds {} and {} holds {}".format(families[0].name, bundles[0], families[1].name, bundles[1]))
-        change=False
-        for g in list(bundles[0]):
-            poor_in_2  = families[1].num_of_members_with(lambda member: member.value(g)>0 and member.value(bundles[1])==0)
-            poor_in_1  = families[0].num_of_members_with(lambda member: member.value(g)>0 and member.value(bundles[0])==1)
-            if poor_in_2>poor_in_1:
-                logger.info("Moving {} from {} to {}, harming {} members in and helping {}.".format(g, families[0].name, families[1].name, poor_in_1, poor_in_2))
-                bundles[0].remove(g)
-                bundles[1].add(g)
-                change=True
-        for g in list(bundles[1]):
-            poor_in_1 = families[0].num_of_members_with(lambda member: member.value(g)>0 and member.value(bundles[0])==0)
-            poor_in_2 = families[1].num_of_members_with(lambda member: member.value(g)>0 and member.value(bundles[1])==1)
-            if poor_in_1>poor_in_2:
-                logger.info("Moving {} from {} to {}, harming {} members and helping {}.".format(g, families[1].name, families[0].name, poor_in_2, poor_in_1))
-                bundles[1].remove(g)
-                bundles[0].add(g)
-                change=True
-        if not change:
-            break
-    return bundles
+    session = TwoThirdsSession(families, goods)
+    for move in session.steps():
+        pass
+    return session.bundles
 
 
+class TwoThirdsSession:
+    """
+    A run of the two-thirds protocol that advances one step at a time - a step examines a single good,
+    and moves it to the other family if this helps more members than it harms.
+    It can be interleaved with other sessions, paused and resumed from a compact snapshot.
+
+    >>> fairness_1_of_best_2 = fairness_criteria.OneOfBestC(2)
+    >>> family1 = Family([BinaryAgent("wx",1),BinaryAgent("yz",1)], fairness_1_of_best_2)
+    >>> session = TwoThirdsSession([family1, family1], "wxyz")
+    >>> session.step() is None   # the first bundle is empty, so there is nothing to examine
+    True
+    >>> move = session.step()
+    >>> move[1:]
+    (1, 0)
+    >>> snapshot = session.snapshot()
+    >>> sorted(snapshot.keys())
+    ['bundles', 'changed', 'iteration', 'pending', 'side']
+    >>> resumed = TwoThirdsSession.from_snapshot([family1, family1], snapshot)
+    >>> moves = list(resumed.steps())
+    >>> resumed.is_finished(), [len(bundle) for bundle in resumed.bundles]
+    (True, [2, 2])
+    """
+
+    def __init__(self, families:list, goods:set):
+        if len(families)!=2:
+            raise ValueError("Currently only 2 families are supported")
+        self.families = families
+        self.bundles = [set(), set(goods)]  # start, arbitrarily, with an allocation that gives all goods to family 2.
+        total_num_of_members = sum([family.num_of_members for family in families])
+        self.num_of_iterations = 2*total_num_of_members   # this should be sufficient to convergence if the families are identical
+        self.iteration = 0
+        self.side = 0          # the index of the bundle whose goods are examined in the current pass
+        self.pending = None    # the goods that remain to be examined in the current pass (None before the pass starts)
+        self.changed = False   # whether a good was moved in the current iteration
+
+    @property
+    def bundles(self)->list:
+        return self.state.bundles
+
+    @bundles.setter
+    def bundles(self, bundles:list):
+        """
+        The value of each member to its family's bundle is tracked by an AllocationState,
+        so examining a good touches only the members who want it.
+        """
+        self.state = AllocationState(self.families, [good for bundle in bundles for good in bundle], bundles)
+        self.state.bundles = bundles   # keep the given sets, so that the goods are examined in the same order
+
+    def is_finished(self)->bool:
+        return self.iteration >= self.num_of_iterations
+
+    def step(self):
+        """
+        Examine the next good.
+        :return: a triple (good, from_index, to_index) if the good was moved, or None otherwise.
+        """
+        families, bundles = self.families, self.bundles
+        if self.pending is None:
+            if self.side == 0:
+                logger.info("Currently, {} holds {} and {} holds {}".format(families[0].name, bundles[0], families[1].name, bundles[1]))
+            self.pending = list(bundles[self.side])
+        move = None
+        if len(self.pending) > 0:
+            g = self.pending.pop(0)
+            (own, other) = (self.side, 1 - self.side)
+            # If there is a good $g\in G_1$ for which $q_0(g) > q_1(g)$, move $g$ to $G_2$ (and vice versa).
+            (wanters, own_values, cardinalities) = (self.state.map_good_to_wanters[g], self.state.own_values, self.state.cardinalities)
+            poor_in_other = sum([cardinalities[other][i] for (i, value) in wanters[other] if own_values[other][i]==0])
+            poor_in_own   = sum([cardinalities[own][i] for (i, value) in wanters[own] if own_values[own][i]==1])
+            if poor_in_other>poor_in_own:
+                logger.info("Moving {} from {} to {}, harming {} members and helping {}.".format(g, families[own].name, families[other].name, poor_in_own, poor_in_other))
+                self.state.move(g, other)
+                self.changed = True
+                move = (g, own, other)
+        if len(self.pending) == 0:   # the pass is over
+            self.pending = None
+            if self.side == 0:
+                self.side = 1
+            else:
+                self.side = 0
+                self.iteration = self.iteration + 1 if self.changed else self.num_of_iterations
+                self.changed = False
+        return move
+
+    def steps(self):
+        """
+        Generates the result of each step (see step), until the allocation does not change.
+        """
+        while not self.is_finished():
+            yield self.step()
+
+    def snapshot(self)->dict:
+        """
+        :return: the state of the session, as a JSON-serializable dict (the families are not included).
+        """
+        return {"bundles": [sorted(bundle) for bundle in self.bundles], "iteration": self.iteration, "side": self.side,
+                "pending": None if self.pending is None else list(self.pending), "changed": self.changed}
+
+    @classmethod
+    def from_snapshot(cls, families:list, snapshot:dict)->'TwoThirdsSession':
+        """
+        Resumes a session of the given families from a snapshot.
+        """
+        session = cls(families, [])
+        session.bundles = [set(bundle) for bundle in snapshot["bundles"]]
+        session.iteration = snapshot["iteration"]
+        session.side = snapshot["side"]
+        session.pending = None if snapshot["pending"] is None else list(snapshot["pending"])
+        session.changed = snapshot["changed"]
+        return session
+
 
 
 